@@ -0,0 +1,42 @@
+'''
+#   ^           _
+#  /_\  |\  /| |_
+# /   \ | \/ | |_
+#
+
+    Description  : HTTP entry point of the long running activity runs extraction (Durable Functions).
+                   POST starts ActivityRunsOrchestrator with the GetActivityRuns payload and returns the status query URLs.
+                   GET  ActivityRunsDurable/<instance_id> returns the status and progress of an orchestration.
+    Deployment      : Terraform
+'''
+
+import json
+import logging
+import azure.functions as func
+import azure.durable_functions as df
+
+
+async def main(req: func.HttpRequest, starter: str) -> func.HttpResponse:
+    try:
+        client = df.DurableOrchestrationClient(starter)
+        instance_id = req.route_params.get('instance_id')
+
+        if req.method == 'GET':
+            if not instance_id:
+                return func.HttpResponse("instance_id is required.",status_code=400)
+            status = await client.get_status(instance_id)
+            if status is None or status.runtime_status is None:
+                return func.HttpResponse(f"Orchestration {instance_id} not found.",status_code=404)
+            return func.HttpResponse(json.dumps(status.to_json(),default=str),mimetype='application/json',status_code=200)
+
+        payload = json.loads(req.get_body().decode())
+        if not payload.get('factory_name') or not payload.get('resource_group'):
+            return func.HttpResponse("factory_name and resource_group are required.",status_code=400)
+        instance_id = await client.start_new('ActivityRunsOrchestrator', None, payload)
+        logging.info(f"Started ActivityRunsOrchestrator : {instance_id}")
+        return client.create_check_status_response(req, instance_id)
+    except Exception as e:
+        return func.HttpResponse(
+                str(e),
+                status_code=400
+            )
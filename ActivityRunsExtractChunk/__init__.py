@@ -0,0 +1,19 @@
+'''
+#   ^           _
+#  /_\  |\  /| |_
+# /   \ | \/ | |_
+#
+
+    Description  : Durable activity. Extracts, stages and merges the activity runs of one chunk of pipeline runs.
+                   Async, so that the chunks of a round run side by side on the extraction executor of one worker.
+    Deployment      : Terraform
+'''
+
+import azure.functions as func
+from PBIMetaExtractorCore.extractors import run_blocking
+
+
+async def main(payload: dict, context: func.Context) -> dict:
+    ### Imported on the first call, not when the host loads the function app (see PBIMetaExtractorCore.extractors).
+    from PBIMetaExtractorCore.get_activity_runs import extract_activity_chunk
+    return await run_blocking(extract_activity_chunk,payload,context=context)
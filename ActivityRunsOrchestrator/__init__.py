@@ -0,0 +1,58 @@
+'''
+#   ^           _
+#  /_\  |\  /| |_
+# /   \ | \/ | |_
+#
+
+    Description  : Drains the activity runs backlog in rounds. Each round claims up to max_chunks chunks of pipeline runs
+                   (ActivityRunsPlanChunks), extracts them in parallel (ActivityRunsExtractChunk), waits for the ADF rate
+                   limit window and continues as new until no pending pipeline run is left.
+    Deployment      : Terraform
+'''
+
+import logging
+from datetime import timedelta
+import azure.durable_functions as df
+from PBIMetaExtractorCore.common_variables import DURABLE_MAX_ROUNDS,DURABLE_ROUND_INTERVAL_SECONDS
+
+
+def orchestrator_function(context: df.DurableOrchestrationContext):
+    payload  = dict(context.get_input())
+    progress = payload.pop('progress',None) or {"rounds" : 0, "pipeline_runs" : 0, "impacted_rows" : 0, "failed_chunks" : 0, "skipped_runs" : 0}
+
+    plan = yield context.call_activity('ActivityRunsPlanChunks', payload)
+    if plan['status_code'] != 200:
+        return {**progress, "status" : 'Exception', "message" : plan['message']}
+
+    chunks = plan['message']['chunks']
+    if not chunks:
+        return {**progress, "status" : 'Success', "message" : 'No pending pipeline runs'}
+
+    tasks = []
+    for chunk_no,chunk in enumerate(chunks):
+        chunk_payload = {**payload, **chunk, "chunk_no" : chunk_no,
+                         "previous_time" : plan['message']['previous_time'], "current_time" : plan['message']['current_time']}
+        tasks.append(context.call_activity('ActivityRunsExtractChunk', chunk_payload))
+    results = yield context.task_all(tasks)
+
+    for result in results:
+        if result['status_code'] == 200:
+            progress['pipeline_runs'] += result['message']['pipeline_runs']
+            progress['impacted_rows'] += result['message']['impacted_rows']
+            progress['skipped_runs']  += result['message']['skipped_runs']   # Out of time budget, released for the next round.
+        else:
+            progress['failed_chunks'] += 1   # The claim expires and the pipeline runs are picked up again.
+    progress['rounds'] += 1
+    context.set_custom_status(progress)
+    if not context.is_replaying:
+        logging.info(f"Round {progress['rounds']} complete : {progress}")
+
+    if progress['rounds'] >= (payload.get('max_rounds') or DURABLE_MAX_ROUNDS):
+        return {**progress, "status" : 'Stopped', "message" : 'max_rounds reached'}
+
+    ### Next round after the ADF rate limit window. continue_as_new keeps the orchestration history small.
+    yield context.create_timer(context.current_utc_datetime + timedelta(seconds=DURABLE_ROUND_INTERVAL_SECONDS))
+    context.continue_as_new({**payload, "progress" : progress})
+
+
+main = df.Orchestrator.create(orchestrator_function)
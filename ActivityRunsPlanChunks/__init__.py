@@ -0,0 +1,16 @@
+'''
+#   ^           _
+#  /_\  |\  /| |_
+# /   \ | \/ | |_
+#
+
+    Description  : Durable activity. Queues new pipeline runs and claims the chunks of the next round.
+    Deployment      : Terraform
+'''
+
+
+
+def main(payload: dict) -> dict:
+    ### Imported on the first call, not when the host loads the function app (see PBIMetaExtractorCore.extractors).
+    from PBIMetaExtractorCore.get_activity_runs import plan_activity_chunks
+    return plan_activity_chunks(payload)
@@ -0,0 +1,316 @@
+'''
+#   ^           _
+#  /_\  |\  /| |_
+# /   \ | \/ | |_
+#
+
+Name : bench_extractors
+Desc : Offline throughput benchmark of the extractors. Synthetic (or recorded) ADF responses are served by a fake ADF client
+       and the loads go to a fake Snowflake connection, so nothing touches Azure or Snowflake. The Arrow/Parquet spool
+       still runs for real (in a temporary directory), only PUT/COPY/MERGE are answered by the fake cursor.
+       Scenarios : parse_ds_object, get_datasets (full load), generate_activity_frames, load_activity_runs.
+       Reports rows/s, the time spent in the Snowflake sink (Arrow build, spool, PUT/COPY) and in fetch + transform, and the peak RSS of
+       the process after each scenario. With --baseline, exits with 1 when a scenario is slower than the baseline by more
+       than --max-regression.
+
+Usage : python Benchmarks/bench_extractors.py [--datasets 20000] [--pipeline-runs 500] [--repeat 3]
+                                              [--recording responses.json] [--save-baseline baseline.json]
+                                              [--baseline baseline.json] [--max-regression 0.15]
+        A recording is a JSON file {"dataset_pages" : [<list_by_factory page>, ..], "activity_responses" : [<query_by_pipeline_run response>, ..]}
+'''
+import os
+import sys
+import glob
+import json
+import shutil
+import tempfile
+import time
+import random
+import logging
+import argparse
+import datetime
+import importlib
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+for variable in ['AME_SNW_USERNAME','AME_SNW_PASSWORD','AME_SNW_ACCOUNT','AME_SNW_DATABASE','AME_SNW_SCHEMA',
+                 'AME_SNW_WAREHOUSE','AME_CLIENT_ID','AME_SECRET','AME_TENANT','AME_SUBSCRIPTION_ID']:
+    os.environ.setdefault(variable, 'benchmark')
+
+import pyarrow.parquet
+from azure.mgmt.datafactory.models import ActivityRunsQueryResponse
+from bench_sanitizer import make_activity_run
+from PBIMetaExtractorCore import adf_api,common_functions,snowflake_statements
+from PBIMetaExtractorCore.common_variables import *
+from PBIMetaExtractorCore.instrumentation import StageMetrics
+from PBIMetaExtractorCore.parquet_spool import ParquetSpool,rows_to_arrow,frame_to_arrow,copy_spool_into_snowflake,cleanup_spool
+ds_module = importlib.import_module('PBIMetaExtractorCore.get_datasets')
+ar_module = importlib.import_module('PBIMetaExtractorCore.get_activity_runs')
+try:
+    import resource # Not available on Windows
+except ImportError:
+    resource = None
+
+FACTORY_NAME   = 'benchfactory'
+RESOURCE_GROUP = 'bench.rg'
+DS_PAGE_SIZE   = 50     # list_by_factory returns 50 datasets per page
+
+
+## Synthetic ADF responses (REST shape) ####################################################################################
+def make_dataset_pages(rnd:random.Random,datasets:int)->list:
+    pages = []
+    for start in range(0,datasets,DS_PAGE_SIZE):
+        value = [{"id": f"/subscriptions/benchmark/resourceGroups/{RESOURCE_GROUP}/providers/Microsoft.DataFactory/factories/{FACTORY_NAME}/datasets/DS_{i}",
+                  "name": f"DS_{i}", "type": "Microsoft.DataFactory/factories/datasets", "etag": f"{rnd.getrandbits(64):016x}",
+                  "properties": {"type": "SnowflakeTable", "linkedServiceName": {"referenceName": "LS_SNOWFLAKE", "type": "LinkedServiceReference"},
+                                 "parameters": {f"p{p}": {"type": "string"} for p in range(rnd.randint(0,5))}, "annotations": [],
+                                 "schema": [{"name": f"COL_{c}", "type": "VARCHAR"} for c in range(rnd.randint(5,40))],
+                                 "typeProperties": {"schema": "SCHEMA", "table": f"TABLE_{i}"}}}
+                 for i in range(start,min(start+DS_PAGE_SIZE,datasets))]
+        pages.append({"value": value})
+    return pages
+
+def make_activity_responses(rnd:random.Random,pipeline_runs:int,activities_per_run:int)->list:
+    responses = []
+    for run_no in range(pipeline_runs):
+        value = []
+        for activity_no in range(activities_per_run):
+            additional_properties, input, output, error = make_activity_run(rnd)
+            start = datetime.datetime(2021,3,11,10,0,0) + datetime.timedelta(seconds=rnd.randint(0,3600))
+            value.append({"pipelineName": f"PL_{run_no % 50}", "pipelineRunId": f"pipeline-run-{run_no}", "activityName": f"Copy_{activity_no}",
+                          "activityType": "Copy", "activityRunId": f"activity-run-{run_no}-{activity_no}", "linkedServiceName": "LS_SNOWFLAKE",
+                          "status": "Failed" if error else "Succeeded", "activityRunStart": start.isoformat()+'Z',
+                          "activityRunEnd": (start + datetime.timedelta(seconds=90)).isoformat()+'Z', "durationInMs": 90000,
+                          "input": input, "output": output, "error": error, **additional_properties})
+        responses.append({"value": value})
+    return responses
+
+
+## Fake ADF client ######################################################################################################
+class FakePage:
+    def __init__(self,page_json:dict):
+        self.page_json = page_json
+        self.content   = json.dumps(page_json).encode()
+    def json(self)->dict:
+        return self.page_json
+
+class FakePager:
+    def __init__(self,served_pages:list):
+        self.served_pages = served_pages
+    def _get_next(self,next_link:str=None)->FakePage:
+        return self.served_pages[int(next_link) if next_link else 0]
+
+class FakeDatasetsOperations:
+    def __init__(self,pages:list):
+        self.pages        = pages
+        self.served_pages = [FakePage({**page, "nextLink": str(page_no+1) if page_no+1 < len(pages) else None}) for page_no,page in enumerate(pages)]
+    def list_by_factory(self,rg:str,factory_name:str)->FakePager:
+        return FakePager(self.served_pages)
+
+class FakeActivityRunsOperations:
+    def __init__(self,responses:dict):
+        self.responses = responses
+    def query_by_pipeline_run(self,rg:str,factory_name:str,run_id:str,filter_parameters:object)->object:
+        return self.responses[run_id]
+
+class FakeAdfClient:
+    def __init__(self,dataset_pages:list,activity_responses:dict):
+        self.datasets      = FakeDatasetsOperations(dataset_pages)
+        self.activity_runs = FakeActivityRunsOperations(activity_responses)
+
+class NoRateLimit:
+    def acquire(self):
+        pass
+
+
+## Fake Snowflake connection. COPY INTO reports the row count of the Parquet file PUT before it. ############################
+class FakeCursor:
+    async_results = {}
+    def __init__(self):
+        self.result      = []
+        self.staged_rows = 0
+        self.sfqid       = None
+        self.description = []
+    def __enter__(self):
+        return self
+    def __exit__(self,*exc_details):
+        pass
+    def execute(self,sql:str,params:object=None)->object:
+        statement = sql.strip().upper()
+        self.description = []
+        if statement.startswith('PUT'):
+            self.staged_rows = sum(pyarrow.parquet.read_metadata(file_path).num_rows for file_path in glob.glob(sql.split("'")[1][len('file://'):]))
+            self.result = []
+        elif statement.startswith('COPY INTO'):
+            self.result = [('file', 'LOADED', self.staged_rows, self.staged_rows)]
+            self.description = [('file',), ('status',), ('rows_parsed',), ('rows_loaded',)]
+        elif statement.startswith('SELECT ID') or statement.startswith('SELECT STATE'):
+            self.result = []    # No stored ETAGs, no checkpoint
+        elif statement.startswith('MERGE') or statement.startswith('SELECT PIPELINE_RUN_ID'):
+            self.result = [(0,0)]
+        else:
+            self.result = [(0,)]
+        return self
+    def execute_async(self,sql:str,params:object=None)->dict:
+        self.execute(sql,params)
+        FakeCursor.async_results[sql] = self.result
+        return {'queryId' : sql}     # The statement is its own query ID
+    def get_results_from_sfqid(self,query_id:str):
+        self.result = FakeCursor.async_results.pop(query_id)
+    def fetchall(self)->list:
+        return self.result
+    def fetchmany(self,size:int)->list:
+        records,self.result = self.result[:size],self.result[size:]
+        return records
+    def fetchone(self)->tuple:
+        return self.result[0] if self.result else None
+
+class FakeConnection:
+    def cursor(self)->FakeCursor:
+        return FakeCursor()
+    def is_closed(self)->bool:
+        return False
+    def close(self):
+        pass
+
+class FakeSnowflakePool:
+    @contextmanager
+    def connection(self):
+        yield FakeConnection()
+
+## Sink timing. The Parquet spool and its PUT/COPY are the boundary between the extractor and Snowflake. ###################
+class SinkTimer:
+    def __init__(self):
+        self.seconds = 0.0
+    def wrap(self,function)->object:
+        def timed(*args,**kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args,**kwargs)
+            finally:
+                self.seconds += time.perf_counter() - started
+        return timed
+
+def install_fakes(adf_client:FakeAdfClient,spool_dir:str)->SinkTimer:
+    sink_timer = SinkTimer()
+    common_functions.SNOWFLAKE_POOL  = FakeSnowflakePool()
+    snowflake_statements.SNOWFLAKE_POOL = common_functions.SNOWFLAKE_POOL
+    common_functions.ParquetSpool    = lambda table_name : ParquetSpool(table_name,spool_dir)
+    common_functions.cleanup_spool   = lambda : cleanup_spool(spool_dir,retention_hours=0)
+    common_functions.rows_to_arrow   = sink_timer.wrap(rows_to_arrow)
+    common_functions.frame_to_arrow  = sink_timer.wrap(frame_to_arrow)
+    ParquetSpool.write               = sink_timer.wrap(ParquetSpool.write)
+    common_functions.copy_spool_into_snowflake = sink_timer.wrap(copy_spool_into_snowflake)
+    adf_api.ADF_RATE_LIMITER         = NoRateLimit()
+    ds_module.get_adf_client         = lambda *args : adf_client
+    ar_module.get_adf_client         = lambda *args : adf_client
+    return sink_timer
+
+
+## Scenarios. Each returns the number of rows produced. ####################################################################
+def run_parse_ds_object(adf_client:FakeAdfClient,args:object)->int:
+    pages = (page['value'] for page in adf_client.datasets.pages)
+    return sum(1 for _ in ds_module.parse_ds_object(pages))
+
+def run_get_datasets(adf_client:FakeAdfClient,args:object)->int:
+    result = ds_module.get_datasets({"factory_name": FACTORY_NAME, "resource_group": RESOURCE_GROUP, "api_limit": 10**6, "batch_size": args.batch_size})
+    assert result['status_code'] == 200, result
+    return sum(len(page['value']) for page in adf_client.datasets.pages)
+
+def run_activity_transform(adf_client:FakeAdfClient,args:object)->int:
+    responses = adf_client.activity_runs.responses.values()
+    return sum(len(df) for df in ar_module.generate_activity_frames(responses,args.batch_size,StageMetrics()))
+
+def run_load_activity_runs(adf_client:FakeAdfClient,args:object)->int:
+    run_ids = list(adf_client.activity_runs.responses)
+    now     = datetime.datetime.now(datetime.timezone.utc)
+    result  = ar_module.load_activity_runs(adf_client,RESOURCE_GROUP,FACTORY_NAME,'benchmark',run_ids,now - datetime.timedelta(days=1),now,
+                                           T_ADF_META_ACTIVITY_RUNS_STG,ADF_API_MAX_WORKERS,args.batch_size)
+    assert result['status_code'] == 200, result
+    return sum(len(response.value) for response in adf_client.activity_runs.responses.values())
+
+SCENARIOS = [('parse_ds_object', run_parse_ds_object), ('get_datasets', run_get_datasets),
+             ('activity_transform', run_activity_transform), ('load_activity_runs', run_load_activity_runs)]
+
+
+def peak_rss_mib()->float:
+    if resource is None:
+        return float('nan')
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak/1024/1024 if sys.platform == 'darwin' else peak/1024    # bytes on macOS, KiB on Linux
+
+def load_responses(args:object)->tuple:
+    if args.recording:
+        with open(args.recording) as recording:
+            recorded = json.load(recording)
+        return recorded.get('dataset_pages',[]), recorded.get('activity_responses',[])
+    rnd = random.Random(42)
+    return make_dataset_pages(rnd,args.datasets), make_activity_responses(rnd,args.pipeline_runs,args.activities_per_run)
+
+def check_regression(results:dict,baseline_path:str,max_regression:float)->list:
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    regressions = []
+    for name,result in results.items():
+        if name not in baseline:
+            continue
+        change = result['rows_per_sec']/baseline[name]['rows_per_sec'] - 1
+        print(f"{name:20} : {change*100:+6.1f}% vs baseline")
+        if change < -max_regression:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--datasets', type=int, default=20000, help='Synthetic datasets in the factory')
+    parser.add_argument('--pipeline-runs', type=int, default=500, help='Synthetic pipeline runs')
+    parser.add_argument('--activities-per-run', type=int, default=10, help='Activity runs per pipeline run')
+    parser.add_argument('--batch-size', type=int, default=LOAD_BATCH_SIZE, help='Rows per load batch')
+    parser.add_argument('--repeat', type=int, default=3, help='Measurements per scenario, best is reported')
+    parser.add_argument('--recording', help='Replay recorded ADF responses instead of synthetic ones')
+    parser.add_argument('--save-baseline', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='Compare the results with this JSON file')
+    parser.add_argument('--max-regression', type=float, default=0.15, help='Allowed rows/s drop against the baseline (0.15 = 15%%)')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    dataset_pages, activity_responses = load_responses(args)
+    activity_responses = {response['value'][0]['pipelineRunId'] : ActivityRunsQueryResponse.deserialize(response)
+                          for response in activity_responses if response['value']}
+    adf_client = FakeAdfClient(dataset_pages,activity_responses)
+    spool_dir  = tempfile.mkdtemp(prefix='bench_spool_')
+    sink_timer = install_fakes(adf_client,spool_dir)
+    print(f"Datasets : {sum(len(page['value']) for page in dataset_pages)} in {len(dataset_pages)} pages | "
+          f"Activity runs : {sum(len(response.value) for response in activity_responses.values())} of {len(activity_responses)} pipeline runs")
+
+    results = {}
+    for name,scenario in SCENARIOS:
+        best = None
+        for _ in range(args.repeat):
+            sink_timer.seconds = 0.0
+            started = time.perf_counter()
+            rows    = scenario(adf_client,args)
+            seconds = time.perf_counter() - started
+            if best is None or seconds < best['seconds']:
+                best = {'rows': rows, 'seconds': seconds, 'sink_seconds': sink_timer.seconds}
+        best['rows_per_sec']  = best['rows']/best['seconds']
+        best['peak_rss_mib']  = peak_rss_mib()
+        results[name] = best
+        print(f"{name:20} : {best['rows']:8} rows | {best['seconds']*1000:9.1f} ms | {best['rows_per_sec']:10.0f} rows/s | "
+              f"fetch + transform {(best['seconds']-best['sink_seconds'])*1000:9.1f} ms | sink {best['sink_seconds']*1000:9.1f} ms | "
+              f"peak RSS {best['peak_rss_mib']:7.1f} MiB")
+    shutil.rmtree(spool_dir,ignore_errors=True)
+
+    if args.save_baseline:
+        with open(args.save_baseline,'w') as baseline_file:
+            json.dump(results,baseline_file,indent=2)
+    if args.baseline:
+        regressions = check_regression(results,args.baseline,args.max_regression)
+        if regressions:
+            print(f"Throughput regression above {args.max_regression*100:.0f}% : {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
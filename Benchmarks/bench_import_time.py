@@ -0,0 +1,119 @@
+'''
+#   ^           _
+#  /_\  |\  /| |_
+# /   \ | \/ | |_
+#
+
+Name : bench_import_time
+Desc : Cold start benchmark of the function app. Every measurement runs in a fresh Python process, like a cold worker.
+       Scenarios : cold_start (import of every function of the app, as the host loads them all when it starts),
+       invalid_request (import of the entry point + routing of an unknown api_name), first_GetDatasets / first_GetActivityRuns
+       (import of the entry point + import of the extractor of the first request) and durable_extract_chunk (import of the
+       durable chunk activity + import of the extractor of its first call).
+       Reports the median time of each scenario and, from python -X importtime, the modules with the largest cumulative
+       import time at cold start. With --baseline, exits with 1 when a scenario is slower than the baseline by more than
+       --max-regression.
+
+Usage : python Benchmarks/bench_import_time.py [--repeat 5] [--top 10] [--save-baseline baseline.json]
+                                               [--baseline baseline.json] [--max-regression 0.25]
+'''
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+ENVIRONMENT = {**os.environ, 'PYTHONDONTWRITEBYTECODE' : '1'}
+for variable in ['AME_SNW_USERNAME','AME_SNW_PASSWORD','AME_SNW_ACCOUNT','AME_SNW_DATABASE','AME_SNW_SCHEMA',
+                 'AME_SNW_WAREHOUSE','AME_CLIENT_ID','AME_SECRET','AME_TENANT','AME_SUBSCRIPTION_ID']:
+    ENVIRONMENT.setdefault(variable, 'benchmark')
+
+## Functions of the app : folders with a function.json.
+FUNCTIONS = sorted(name for name in os.listdir(ROOT) if os.path.isfile(os.path.join(ROOT, name, 'function.json')))
+
+## Code timed in the child process, by scenario.
+INVALID_REQUEST = '''
+import asyncio, azure.functions as func
+request = func.HttpRequest('POST', '/api/ADFMetaExtractorCore', body=b'{"api_name" : "GetNothing"}')
+asyncio.run(PBIMetaExtractorCore.main(request, None))
+'''
+SCENARIOS = {
+    'cold_start'            : '\n'.join(f'import {function}' for function in FUNCTIONS),
+    'invalid_request'       : 'import PBIMetaExtractorCore' + INVALID_REQUEST,
+    'first_GetDatasets'     : "import PBIMetaExtractorCore\nPBIMetaExtractorCore.EXTRACTORS['GetDatasets']\nimport PBIMetaExtractorCore.fan_out",
+    'first_GetActivityRuns' : "import PBIMetaExtractorCore\nPBIMetaExtractorCore.EXTRACTORS['GetActivityRuns']\nimport PBIMetaExtractorCore.fan_out",
+    'durable_extract_chunk' : 'import ActivityRunsExtractChunk\nimport PBIMetaExtractorCore.get_activity_runs',
+}
+TIMER = '''
+import time
+started = time.perf_counter()
+{code}
+print(time.perf_counter() - started)
+'''
+
+
+## Seconds taken by code in a fresh interpreter ##########################################################################
+def time_in_child(code:str)->float:
+    completed = subprocess.run([sys.executable, '-c', TIMER.format(code=code)], cwd=ROOT, env=ENVIRONMENT,
+                               capture_output=True, text=True, check=True)
+    return float(completed.stdout.strip().splitlines()[-1])
+
+## Modules with the largest cumulative import time (us) at cold start, from -X importtime ##################################
+def slowest_imports(top:int)->list:
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', SCENARIOS['cold_start']], cwd=ROOT, env=ENVIRONMENT,
+                               capture_output=True, text=True, check=True)
+    modules = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _,cumulative,module = line[len('import time:'):].split('|')
+        modules.append((int(cumulative), module.rstrip()))
+    return sorted(modules, reverse=True)[:top]
+
+def check_regression(results:dict,baseline_path:str,max_regression:float)->list:
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    regressions = []
+    for name,result in results.items():
+        if name not in baseline:
+            continue
+        change = result['median_ms']/baseline[name]['median_ms'] - 1
+        print(f"{name:22} : {change*100:+6.1f}% vs baseline")
+        if change > max_regression:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help='Fresh processes per scenario, the median is reported')
+    parser.add_argument('--top', type=int, default=10, help='Slowest cold start imports to list')
+    parser.add_argument('--save-baseline', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='Compare the results with this JSON file')
+    parser.add_argument('--max-regression', type=float, default=0.25, help='Allowed slowdown against the baseline (0.25 = 25%%)')
+    args = parser.parse_args()
+
+    results = {}
+    for name,code in SCENARIOS.items():
+        timings = [time_in_child(code)*1000 for _ in range(args.repeat)]
+        results[name] = {'median_ms' : statistics.median(timings), 'min_ms' : min(timings), 'max_ms' : max(timings)}
+        print(f"{name:22} : median {results[name]['median_ms']:8.1f} ms | min {results[name]['min_ms']:8.1f} ms | max {results[name]['max_ms']:8.1f} ms")
+
+    print(f"\nSlowest imports at cold start (cumulative) :")
+    for cumulative,module in slowest_imports(args.top):
+        print(f"{cumulative/1000:8.1f} ms | {module}")
+
+    if args.save_baseline:
+        with open(args.save_baseline,'w') as baseline_file:
+            json.dump(results,baseline_file,indent=2)
+    if args.baseline:
+        regressions = check_regression(results,args.baseline,args.max_regression)
+        if regressions:
+            print(f"Cold start regression above {args.max_regression*100:.0f}% : {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+'''
+#   ^           _
+#  /_\  |\  /| |_
+# /   \ | \/ | |_
+#
+
+Name : bench_sanitizer
+Desc : Micro-benchmark of the per activity run JSON cleaning. Compares the json.dumps -> json.loads(object_pairs_hook=dict_clean)
+       -> str() path with the single walk to_json_column, on activity run payloads shaped like Copy/Lookup/ExecutePipeline runs.
+
+Usage : python Benchmarks/bench_sanitizer.py [--runs 2000] [--repeat 5]
+'''
+import os
+import sys
+import json
+import random
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+for variable in ['AME_SNW_USERNAME','AME_SNW_PASSWORD','AME_SNW_ACCOUNT','AME_SNW_DATABASE','AME_SNW_SCHEMA',
+                 'AME_SNW_WAREHOUSE','AME_CLIENT_ID','AME_SECRET','AME_TENANT','AME_SUBSCRIPTION_ID']:
+    os.environ.setdefault(variable, 'benchmark')
+
+from PBIMetaExtractorCore.common_functions import dict_clean,to_json_column,orjson
+
+
+## Synthetic activity run attributes ######################################################################################
+def make_copy_input(rnd:random.Random)->dict:
+    columns = [{"source": {"name": f"COL_{i}", "type": "String"}, "sink": {"name": f"COL_{i}", "type": None}} for i in range(rnd.randint(10,60))]
+    return {
+        "source": {"type": "SnowflakeSource", "query": "select * from DB.SCHEMA.TABLE where ETL_UPDATE_TS > '2021-01-01'", "exportSettings": {"type": None}},
+        "sink": {"type": "ParquetSink", "storeSettings": {"type": "AzureBlobFSWriteSettings", "copyBehavior": None}, "formatSettings": {"type": "ParquetWriteSettings"}},
+        "enableStaging": False,
+        "translator": {"type": "TabularTranslator", "mappings": columns, "typeConversion": True},
+        "parameters": {f"p{i}": (None if i % 3 == 0 else f"value_{i}") for i in range(20)},
+    }
+
+def make_copy_output(rnd:random.Random)->dict:
+    return {
+        "dataRead": rnd.randint(0,10**9), "dataWritten": rnd.randint(0,10**9), "rowsRead": rnd.randint(0,10**7),
+        "rowsCopied": rnd.randint(0,10**7), "copyDuration": rnd.randint(1,5000), "throughput": rnd.random()*1000,
+        "errors": [], "effectiveIntegrationRuntime": "AutoResolveIntegrationRuntime (East US)", "billingReference": {
+            "activityType": "DataMovement", "billableDuration": [{"meterType": "AzureIR", "duration": rnd.random(), "unit": "DIUHours"}]},
+        "executionDetails": [{"source": {"type": "Snowflake"}, "sink": {"type": "AzureBlobFS", "region": None}, "status": "Succeeded",
+                              "start": "2021-03-11T10:00:00Z", "duration": rnd.randint(1,5000), "usedDataIntegrationUnits": 4,
+                              "detailedDurations": {"queuingDuration": 3, "timeToFirstByte": None, "transferDuration": 20}}] * rnd.randint(1,4),
+    }
+
+def make_activity_run(rnd:random.Random)->tuple:
+    failed = rnd.random() < 0.1
+    additional_properties = {"retryAttempt": None, "iterationHash": "", "userProperties": {}, "recoveryStatus": "None"}
+    error = {"errorCode": "2200", "message": "Failure happened on 'Sink' side." * 5, "failureType": "UserError", "target": "Copy", "details": None} if failed else None
+    return additional_properties, make_copy_input(rnd), make_copy_output(rnd), error
+
+
+## Cleaning paths ########################################################################################################
+def legacy_clean(obj:object)->str:
+    dict_str = json.dumps(obj)
+    obj_clean = json.loads(dict_str, object_pairs_hook=dict_clean)
+    if obj_clean=='None' or obj_clean is None:
+        obj_clean={}
+    return str(obj_clean)
+
+def clean_runs(runs:list,clean_function)->None:
+    for run in runs:
+        for attribute in run:
+            clean_function(attribute)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=2000, help='Activity runs per measurement')
+    parser.add_argument('--repeat', type=int, default=5, help='Measurements per path, best is reported')
+    args = parser.parse_args()
+
+    rnd  = random.Random(42)
+    runs = [make_activity_run(rnd) for _ in range(args.runs)]
+    payload_bytes = sum(len(json.dumps(attribute)) for run in runs for attribute in run)
+
+    ## Both paths must clean the same values; only the new one produces JSON.
+    for run in runs[:50]:
+        for attribute in run:
+            legacy = json.loads(json.dumps(attribute), object_pairs_hook=dict_clean)
+            assert json.loads(to_json_column(attribute)) == (legacy if legacy not in (None,'None') else {})
+
+    print(f"Activity runs : {args.runs} | JSON payload : {payload_bytes/1024/1024:.1f} MiB | encoder : {'orjson' if orjson is not None else 'json'}")
+    results = {}
+    for name,clean_function in [('dumps/loads + dict_clean + str', legacy_clean), ('to_json_column', to_json_column)]:
+        best = min(timeit.repeat(lambda: clean_runs(runs, clean_function), number=1, repeat=args.repeat))
+        results[name] = best
+        print(f"{name:32} : {best*1000:9.1f} ms | {best/args.runs*1e6:8.1f} us/run | {args.runs/best:10.0f} runs/s")
+    legacy_time, new_time = results.values()
+    print(f"Speed-up : {legacy_time/new_time:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
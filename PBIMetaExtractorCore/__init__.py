@@ -11,6 +11,8 @@
     Deployment      : Terraform
     Updated by   : Thomas Mathew.
     This is the entry point for ADFMetaExtractor. The HTTP Body is evaluated and routed based on api_name parameter
+    The handler is async : extractions run on the worker's extraction executor, so one host serves many requests at once.
+    Only light modules are imported at cold start. Extractor modules are imported on the first request for their API.
    
 '''
 
@@ -18,32 +20,37 @@ import logging
 import json
 import azure.functions as func
 from .common_variables import *
-from .get_pipelines import get_pipelines,get_exception_message
-from .get_datasets import get_datasets
+from .extractors import EXTRACTORS,run_blocking
 
 
-def main(req: func.HttpRequest) -> func.HttpResponse:
+async def main(req: func.HttpRequest, context: func.Context) -> func.HttpResponse:
     try:
         func_response = {}
         status_code = 400
         logging.info('****** ADF Meta Extractor API ******')
         req_body = req.get_body().decode()
         payload = json.loads(req_body)
-        requested_api_name = payload.get('api_name')
-        if requested_api_name not in AVAILABLE_API_LIST:
-            invalid_req_mesg = f"Invalid API name. Available APIs : {str(AVAILABLE_API_LIST)}"
-            return func.HttpResponse(invalid_req_mesg,mimetype='application/json',status_code=400)
-
-        if requested_api_name == 'GetDatasets' : 
-            logging.info(f"Invoking {requested_api_name} API")
-            func_response = get_pipelines(payload)
-        elif requested_api_name == 'GetTriggers' :
-            logging.info(f"Invoking {requested_api_name} API")
-            func_response = get_triggers(payload)
-        output_json = json.dumps(func_response)
+
+        if payload.get('factories') is not None:  # Batch request for many factories
+            from .fan_out import run_fan_out
+            logging.info(f"Invoking fan out for {len(payload.get('factories'))} factories")
+            func_response = await run_blocking(run_fan_out,payload,EXTRACTORS,context=context)
+        else:
+            requested_api_name = payload.get('api_name')
+            if requested_api_name not in AVAILABLE_API_LIST:
+                invalid_req_mesg = f"Invalid API name. Available APIs : {str(AVAILABLE_API_LIST)}"
+                return func.HttpResponse(invalid_req_mesg,mimetype='application/json',status_code=400)
+            if requested_api_name not in EXTRACTORS:
+                invalid_req_mesg = f"{requested_api_name} is not deployed. Deployed APIs : {str(list(EXTRACTORS))}"
+                return func.HttpResponse(invalid_req_mesg,mimetype='application/json',status_code=501)
+
+            from .fan_out import run_extractor
+            func_response = await run_blocking(run_extractor,EXTRACTORS,requested_api_name,payload,context=context)
+        output_json = json.dumps(func_response, default=str)
         status_code = func_response['status_code']
         return func.HttpResponse(
                 output_json,
+                mimetype='application/json',
                 status_code=status_code
             )
     except Exception as e:
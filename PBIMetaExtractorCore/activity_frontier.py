@@ -0,0 +1,167 @@
+'''
+#   ^           _
+#  /_\  |\  /| |_
+# /   \ | \/ | |_
+#
+
+Name : activity_frontier
+Desc : Work queue of pipeline run IDs whose activity runs still need to be extracted (T_ADF_META_ACTIVITY_FRONTIER).
+       A pipeline run is PENDING until its activities are extracted, IN_PROGRESS while an invocation holds it and DONE once
+       all its activities reached a terminal status. Runs are re-queued when the pipeline run is updated again.
+       Every run carries the FACTORY_NAME of its pipeline run : claims, completions and the backlog are scoped to the factory
+       of the request, as activity runs can only be queried on the factory of their pipeline run.
+       LAST_POLLED_TS is the end of the filter window of the last successful poll of a run, so the next poll only asks ADF for
+       the activities updated since then instead of every activity of a long running pipeline.
+Deployment      : Terraform
+Functions    : 1.  enqueue_pending_runs   | Queue the new and updated pipeline runs of a factory and release expired claims.
+               2.  claim_pending_runs     | Claim the next batch of PENDING pipeline runs of a factory, with their LAST_POLLED_TS.
+               3.  complete_claimed_runs  | Mark the claimed runs DONE, or PENDING again when activities are still running.
+               4.  select_completed_runs  | Pipeline run IDs, out of a list, whose pipeline run reached a terminal status.
+               5.  count_pending_runs     | Residual backlog : number of PENDING pipeline runs of a factory.
+               6.  select_claimed_runs    | Pipeline runs held by a claim, optionally renewing it to resume an interrupted invocation.
+'''
+import sys
+import logging
+from .common_variables import *
+from .common_functions import execute_snowflake_sql,get_exception_message
+
+FRONTIER_TABLE = f"{AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{T_ADF_META_ACTIVITY_FRONTIER}"
+CURRENT_TS     = "to_timestamp_ntz(convert_timezone('UTC', current_timestamp()))"
+
+
+## Queue new and updated pipeline runs of factory_name #########################################################################
+## Pipeline runs missing from the frontier, or updated since they were queued, are queued. Only the pipeline runs updated within
+## FRONTIER_ENQUEUE_OVERLAP_MINUTES before the newest run queued for the factory are compared, so the cost follows the delta and
+## not the history. The overlap covers concurrent GetPipelineRuns loads : inserted runs carry the start time of their
+## invocation, and a slower load can commit runs older than the ones a faster load queued already. Without any run queued for
+## the factory, only the overlap before now is queued : older pipeline runs are seeded explicitly (see README).
+def enqueue_pending_runs(factory_name:str,overlap_minutes:int=FRONTIER_ENQUEUE_OVERLAP_MINUTES,
+                         claim_timeout_minutes:int=FRONTIER_CLAIM_TIMEOUT_MINUTES)->dict:
+    enqueue_sql = f'''
+        MERGE into {FRONTIER_TABLE} tgt
+        USING
+        ( select RUN_ID, max(FACTORY_NAME) as FACTORY_NAME, max(ETL_UPDATE_TS) as ETL_UPDATE_TS
+          from {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{T_ADF_META_PIPELINE_RUNS}
+          where FACTORY_NAME = %s
+          and ETL_UPDATE_TS >= dateadd(minute, -{int(overlap_minutes)},
+                                       (select nvl(max(PIPELINE_ETL_UPDATE_TS),{CURRENT_TS}) from {FRONTIER_TABLE} where FACTORY_NAME = %s))
+          group by RUN_ID ) src
+        ON tgt.PIPELINE_RUN_ID = src.RUN_ID
+
+        WHEN matched AND (src.ETL_UPDATE_TS > tgt.PIPELINE_ETL_UPDATE_TS OR tgt.FACTORY_NAME IS NULL) THEN UPDATE SET
+        tgt.STATE = iff(tgt.STATE = '{FRONTIER_IN_PROGRESS}', tgt.STATE, '{FRONTIER_PENDING}'),
+        tgt.FACTORY_NAME = src.FACTORY_NAME,
+        tgt.PIPELINE_ETL_UPDATE_TS = src.ETL_UPDATE_TS,
+        tgt.ETL_UPDATE_TS = {CURRENT_TS}
+
+        WHEN NOT matched THEN INSERT (PIPELINE_RUN_ID,FACTORY_NAME,STATE,PIPELINE_ETL_UPDATE_TS,ETL_INSERT_TS,ETL_UPDATE_TS)
+        VALUES (src.RUN_ID,src.FACTORY_NAME,'{FRONTIER_PENDING}',src.ETL_UPDATE_TS,{CURRENT_TS},{CURRENT_TS})
+    '''
+    execution_result = execute_snowflake_sql(enqueue_sql,(factory_name,factory_name))
+    if execution_result['status_code'] != 200:
+        return execution_result
+    logging.info(f"Pipeline runs queued (inserted, updated) : {execution_result['message'][0]}")
+
+    ### Claims of invocations that timed out or failed before completing them.
+    release_sql = f'''update {FRONTIER_TABLE} set STATE = '{FRONTIER_PENDING}', CLAIM_ID = null, ETL_UPDATE_TS = {CURRENT_TS}
+                      where STATE = '{FRONTIER_IN_PROGRESS}' and CLAIMED_TS < dateadd(minute, -{int(claim_timeout_minutes)}, {CURRENT_TS})'''
+    execution_result = execute_snowflake_sql(release_sql)
+    if execution_result['status_code'] != 200:
+        return execution_result
+    logging.info(f"Expired claims released : {execution_result['message'][0][0]}")
+    return execution_result
+
+
+## Claim up to api_limit PENDING pipeline runs of factory_name, oldest first, and return their run IDs #######################
+def claim_pending_runs(api_limit:int,claim_id:str,factory_name:str)->dict:
+    claim_sql = f'''update {FRONTIER_TABLE} set STATE = '{FRONTIER_IN_PROGRESS}', CLAIM_ID = %s, CLAIMED_TS = {CURRENT_TS}, ETL_UPDATE_TS = {CURRENT_TS}
+                    where PIPELINE_RUN_ID in ( select PIPELINE_RUN_ID from {FRONTIER_TABLE} where STATE = '{FRONTIER_PENDING}' and FACTORY_NAME = %s
+                                               order by PIPELINE_ETL_UPDATE_TS ASC LIMIT {int(api_limit)} )'''
+    execution_result = execute_snowflake_sql(claim_sql,(claim_id,factory_name))
+    if execution_result['status_code'] != 200:
+        return execution_result
+    return select_claimed_runs(claim_id,factory_name)
+
+
+## Pipeline runs held by a claim, with their LAST_POLLED_TS. With renew, the claim is taken over again (eg. to resume an ######
+## invocation that timed out) and does not expire before FRONTIER_CLAIM_TIMEOUT_MINUTES from now.
+def select_claimed_runs(claim_id:str,factory_name:str,renew:bool=False)->dict:
+    if renew:
+        renew_sql = f'''update {FRONTIER_TABLE} set CLAIMED_TS = {CURRENT_TS}, ETL_UPDATE_TS = {CURRENT_TS}
+                        where STATE = '{FRONTIER_IN_PROGRESS}' and CLAIM_ID = %s and FACTORY_NAME = %s'''
+        execution_result = execute_snowflake_sql(renew_sql,(claim_id,factory_name))
+        if execution_result['status_code'] != 200:
+            return execution_result
+
+    select_sql = f"select PIPELINE_RUN_ID,LAST_POLLED_TS from {FRONTIER_TABLE} where CLAIM_ID = %s and FACTORY_NAME = %s order by PIPELINE_ETL_UPDATE_TS ASC"
+    execution_result = execute_snowflake_sql(select_sql,(claim_id,factory_name))
+    if execution_result['status_code'] != 200:
+        return execution_result
+    ### last_polled : run ID -> LAST_POLLED_TS (naive UTC) of the runs polled before.
+    execution_result['last_polled'] = {tuples[0] : tuples[1] for tuples in execution_result['message'] if tuples[1] is not None}
+    execution_result['message'] = [tuples[0] for tuples in execution_result['message']]
+    logging.info(f"Claimed pipeline runs : {len(execution_result['message'])}")
+    return execution_result
+
+
+## Close a claim. pending_run_ids go back to PENDING, every other claimed run becomes DONE. ###################################
+## LAST_POLLED_TS is set to polled_ts (naive UTC), except for unpolled_run_ids : runs whose activities were not read from ADF
+## in this poll (failed fetch, cached response), which keep their previous LAST_POLLED_TS.
+def complete_claimed_runs(claim_id:str,factory_name:str,pending_run_ids:list,polled_ts:object=None,unpolled_run_ids:list=None)->dict:
+    try:
+        pending_run_ids  = set(pending_run_ids)
+        unpolled_run_ids = set(unpolled_run_ids or [])
+        run_id_groups = [(pending_run_ids - unpolled_run_ids, FRONTIER_PENDING, True),
+                         (pending_run_ids & unpolled_run_ids, FRONTIER_PENDING, False),
+                         (unpolled_run_ids - pending_run_ids, FRONTIER_DONE,    False)]
+        for run_ids,state,set_polled in run_id_groups:
+            run_ids = sorted(run_ids)
+            for start in range(0,len(run_ids),FRONTIER_UPDATE_BATCH_SIZE):
+                run_id_batch = run_ids[start:start+FRONTIER_UPDATE_BATCH_SIZE]
+                update_sql = f'''update {FRONTIER_TABLE} set STATE = '{state}', CLAIM_ID = null, ETL_UPDATE_TS = {CURRENT_TS},
+                                 LAST_POLLED_TS = {'nvl(%s, LAST_POLLED_TS)' if set_polled else 'LAST_POLLED_TS'}
+                                 where CLAIM_ID = %s and FACTORY_NAME = %s and PIPELINE_RUN_ID in ({','.join(['%s']*len(run_id_batch))})'''
+                execution_result = execute_snowflake_sql(update_sql,([polled_ts] if set_polled else [])+[claim_id,factory_name]+run_id_batch)
+                if execution_result['status_code'] != 200:
+                    return execution_result
+
+        done_sql = f'''update {FRONTIER_TABLE} set STATE = '{FRONTIER_DONE}', CLAIM_ID = null, ETL_UPDATE_TS = {CURRENT_TS},
+                       LAST_POLLED_TS = nvl(%s, LAST_POLLED_TS)
+                       where CLAIM_ID = %s and FACTORY_NAME = %s'''
+        execution_result = execute_snowflake_sql(done_sql,(polled_ts,claim_id,factory_name))
+        if execution_result['status_code'] != 200:
+            return execution_result
+        logging.info(f"Pipeline runs done : {execution_result['message'][0][0]} | Pending again : {len(pending_run_ids)}")
+        return execution_result
+    except Exception as e:
+        error_message = str(e)
+        function_name = sys._getframe().f_code.co_name
+        output_error = get_exception_message(function_name ,error_message)
+        return output_error
+
+
+## Pipeline runs of run_ids that reached a terminal status in T_ADF_META_PIPELINE_RUNS. Their activity runs no longer change.
+def select_completed_runs(run_ids:list)->dict:
+    completed_run_ids = []
+    execution_result  = {"status" : 'Success', "status_code":200, "message" : completed_run_ids}
+    run_ids = list(run_ids)
+    for start in range(0,len(run_ids),FRONTIER_UPDATE_BATCH_SIZE):
+        run_id_batch = run_ids[start:start+FRONTIER_UPDATE_BATCH_SIZE]
+        select_sql = f'''select distinct RUN_ID from {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{T_ADF_META_PIPELINE_RUNS}
+                         where RUN_ID in ({','.join(['%s']*len(run_id_batch))})
+                         and STATUS not in ({','.join(f"'{status}'" for status in NON_TERMINAL_PIPELINE_STATUSES)})'''
+        execution_result = execute_snowflake_sql(select_sql,run_id_batch)
+        if execution_result['status_code'] != 200:
+            return execution_result
+        completed_run_ids.extend(tuples[0] for tuples in execution_result['message'])
+    execution_result['message'] = completed_run_ids
+    return execution_result
+
+
+## Residual backlog of factory_name left for the next invocations
+def count_pending_runs(factory_name:str)->dict:
+    execution_result = execute_snowflake_sql(f"select count(*) from {FRONTIER_TABLE} where STATE = '{FRONTIER_PENDING}' and FACTORY_NAME = %s",(factory_name,))
+    if execution_result['status_code'] != 200:
+        return execution_result
+    execution_result['message'] = execution_result['message'][0][0]
+    return execution_result
@@ -0,0 +1,270 @@
+'''
+#   ^           _
+#  /_\  |\  /| |_
+# /   \ | \/ | |_
+#
+
+Name : adf_api
+Desc : Helpers for calling the Azure Data Factory REST APIs within the server side limit of ~1000 requests/min.
+Deployment      : Terraform
+Functions    : 1.  TokenBucket        | Thread safe token bucket rate limiter.
+               2.  call_with_backoff  | Invoke an ADF API call, backing off on throttled (429) responses.
+               3.  fetch_ordered      | Run an ADF API call for many inputs on a bounded thread pool and yield (input, result) in input order.
+                                        Inputs answered by the lookup function (eg. the response cache) are not sent to the API.
+               4.  generate_factory_pages | Page through a list_by_factory API on a background thread while the caller parses earlier pages.
+                                            Pages are served from the response cache when one is given.
+               5.  BatchController    | Stops fetch_ordered / generate_factory_pages early when the observed API throughput projects
+                                        the fetch past the time budget of the invocation, keeping time to load what was fetched.
+'''
+import sys
+import time
+import queue
+import random
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor,Future
+from .common_variables import *
+from .common_functions import get_exception_message,get_factory_resource_id
+from .instrumentation import StageMetrics
+from .response_cache import ResponseCache
+
+RETRYABLE_STATUS_CODES = (429,503)
+
+
+class TokenBucket:
+
+    def __init__(self,rate_per_min:int,capacity:int=None):
+        self.rate_per_sec = rate_per_min/60.0
+        self.capacity     = capacity if capacity is not None else max(1,int(self.rate_per_sec))
+        self._tokens      = float(self.capacity)
+        self._updated     = time.monotonic()
+        self._lock        = threading.Lock()
+
+    ## Block until a token is available ######################################################################################
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens  = min(self.capacity, self._tokens + (now - self._updated)*self.rate_per_sec)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_seconds = (1 - self._tokens)/self.rate_per_sec
+            time.sleep(wait_seconds)
+
+
+## Shared by every extractor in the worker process, since the ADF limit applies to the caller and not to a request.
+ADF_RATE_LIMITER = TokenBucket(ADF_API_RATE_PER_MIN)
+
+
+class BatchController:
+
+    def __init__(self,budget_seconds:float=TIME_BUDGET_SECONDS,load_reserve_seconds:float=LOAD_RESERVE_SECONDS):
+        self.deadline      = time.monotonic() + budget_seconds - load_reserve_seconds
+        self.stopped       = False
+        self.skipped       = []     # items of fetch_ordered that were not fetched
+        self.latency       = None   # moving average of the call latency (s)
+        self._completed    = 0
+        self._first_call   = None
+        self._lock         = threading.Lock()
+
+    ## Latency of one API call, including rate limit waits and retries
+    def observe(self,seconds:float):
+        with self._lock:
+            self._completed += 1
+            self.latency = seconds if self.latency is None else 0.8*self.latency + 0.2*seconds
+
+    ## Whether one more call can start. The calls in flight and the next one must complete before the deadline, at the
+    ## throughput observed so far and no sooner than one call latency from now. Once stopped, no call is allowed.
+    def allow(self,in_flight:int=0)->bool:
+        with self._lock:
+            now = time.monotonic()
+            if self._first_call is None:
+                self._first_call = now
+            if not self.stopped and self._completed > 0:
+                throughput = self._completed/max(now - self._first_call,1e-6)
+                projected  = now + max(self.latency,(in_flight+1)/throughput)
+                if projected > self.deadline:
+                    logging.warning(f"Time budget reached after {self._completed} calls. Stopping the fetch.")
+                    self.stopped = True
+            elif now >= self.deadline:
+                self.stopped = True
+            return not self.stopped
+
+    def summary(self)->dict:
+        return {'stopped_early' : self.stopped, 'skipped' : len(self.skipped)}
+
+
+## Time budget of an invocation (payload "time_budget_seconds" / "load_reserve_seconds"), counted from now.
+def get_batch_controller(payload:dict)->BatchController:
+    return BatchController(payload.get('time_budget_seconds') or TIME_BUDGET_SECONDS,
+                           payload.get('load_reserve_seconds') or LOAD_RESERVE_SECONDS)
+
+
+def call_observed(controller:BatchController,fn,*args,**kwargs):
+    started = time.monotonic()
+    try:
+        return call_with_backoff(fn,*args,**kwargs)
+    finally:
+        controller.observe(time.monotonic() - started)
+
+
+## Status code and Retry-After of msrest CloudError / azure-core HttpResponseError ##########################################
+def get_retry_hint(error:Exception)->tuple:
+    response    = getattr(error,'response',None)
+    status_code = getattr(error,'status_code',None) or getattr(response,'status_code',None)
+    retry_after = None
+    headers     = getattr(response,'headers',None)
+    if headers is not None and headers.get('Retry-After') is not None:
+        try:
+            retry_after = float(headers.get('Retry-After'))
+        except ValueError:
+            retry_after = None
+    return status_code,retry_after
+
+
+## Invoke fn(*args) once a rate limit token is available. Retries throttled calls with exponential backoff. ##################
+## Every call is recorded as an api_fetch stage execution, with api_calls, api_throttled, api_retries and api_errors counters.
+def call_with_backoff(fn,*args,limiter:TokenBucket=None,max_retries:int=ADF_API_MAX_RETRIES,metrics:StageMetrics=None):
+    limiter = limiter or ADF_RATE_LIMITER
+    metrics = metrics or StageMetrics()
+    attempt = 0
+    while True:
+        limiter.acquire()
+        metrics.increment('api_calls')
+        try:
+            with metrics.stage('api_fetch'):
+                return fn(*args)
+        except Exception as e:
+            status_code,retry_after = get_retry_hint(e)
+            if status_code in RETRYABLE_STATUS_CODES:
+                metrics.increment('api_throttled')
+            if status_code not in RETRYABLE_STATUS_CODES or attempt >= max_retries:
+                metrics.increment('api_errors')
+                raise
+            metrics.increment('api_retries')
+            backoff_seconds = retry_after if retry_after is not None else (2**attempt) + random.uniform(0,1)
+            logging.warning(f"ADF API returned {status_code}. Retrying in {backoff_seconds:.1f}s (attempt {attempt+1} of {max_retries})")
+            time.sleep(backoff_seconds)
+            attempt += 1
+
+
+## Run fn(item) for every item concurrently and yield (item, result) in the order of items. #################################
+## At most 2 * max_workers results are held in memory. Failed items are logged and yielded with a None result.
+## lookup(item), when given, returns a result that is already known (or None), so that no rate limit token is spent on it.
+## With a controller, items are no longer fetched once it stops; they are added to controller.skipped and not yielded.
+def fetch_ordered(fn,items,max_workers:int=ADF_API_MAX_WORKERS,limiter:TokenBucket=None,metrics:StageMetrics=None,lookup=None,
+                  controller:BatchController=None)->tuple:
+    max_in_flight = max_workers*2
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = deque()
+        for item in items:
+            result = lookup(item) if lookup is not None else None
+            if result is not None:
+                future = Future()
+                future.set_result(result)
+            elif controller is None:
+                future = executor.submit(call_with_backoff,fn,item,limiter=limiter,metrics=metrics)
+            elif controller.allow(sum(1 for _,queued in in_flight if not queued.done())):
+                future = executor.submit(call_observed,controller,fn,item,limiter=limiter,metrics=metrics)
+            else:
+                controller.skipped.append(item)
+                continue
+            in_flight.append((item,future))
+            if len(in_flight) >= max_in_flight:
+                yield get_fetch_result(*in_flight.popleft())
+        while in_flight:
+            yield get_fetch_result(*in_flight.popleft())
+
+
+def get_fetch_result(item:object,future:object)->tuple:
+    try:
+        return item,future.result()
+    except Exception as e:
+        error_message = f"{item} : {str(e)}"
+        function_name = sys._getframe().f_code.co_name
+        get_exception_message(function_name ,error_message)
+        return item,None
+
+
+## Page through a list_by_factory API (pipelines, datasets, linked services, triggers ...). ###################################
+## One pager is reused for every page. A producer thread fetches up to prefetch_pages pages ahead of the consumer, so the
+## network fetch of page N+1 overlaps with the parsing of page N. Yields the 'value' list of each page.
+## page_state, when given, is filled with the number of pages read and whether the last page of the factory was reached.
+## With a cache, page N is served from the cache (key factory resource ID/api_name/pageN) only while pages 1 to N-1 were too.
+## After the first miss the listing continues from the API with the nextLink of the last page read, and fresh pages are
+## cached. Cached pages can be up to the TTL old and ADF list APIs do not validate ETags : do not pass a cache when the
+## listing must be current (eg. the incremental datasets load, whose missing datasets are soft deleted).
+## With a controller, no page is fetched once it stops : the scan ends there, incomplete.
+## A scan is resumed (checkpoint.py) from resume_link, the nextLink after the resume_pages pages read before; api_limit then
+## counts the pages of this call only. With with_links, (page, nextLink) tuples are yielded, nextLink None after the last page.
+def generate_factory_pages(list_by_factory,rg:str,factory_name:str,api_limit:int,prefetch_pages:int=ADF_API_PREFETCH_PAGES,
+                           limiter:TokenBucket=None,page_state:dict=None,metrics:StageMetrics=None,
+                           cache:ResponseCache=None,api_name:str=None,controller:BatchController=None,
+                           resume_link:str=None,resume_pages:int=0,with_links:bool=False)->list:
+    pager      = list_by_factory(rg,factory_name)
+    pages      = queue.Queue(maxsize=prefetch_pages)
+    stop       = threading.Event()
+    end_marker = object()
+    page_state = page_state if page_state is not None else {}
+    page_state.update({'pages' : resume_pages, 'complete' : False})
+    metrics    = metrics or StageMetrics()
+    factory_id = get_factory_resource_id(rg,factory_name)
+
+    def put_page(item)->bool:
+        while not stop.is_set():
+            try:
+                pages.put(item,timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce_pages():
+        try:
+            page_count = 0
+            next_link  = resume_link
+            from_cache = cache is not None and resume_link is None
+            while page_count < api_limit:
+                page_key  = ResponseCache.key(factory_id,api_name,f"page{resume_pages+page_count+1}") if cache is not None else None
+                page_json = cache.get(page_key) if from_cache else None
+                if page_json is not None:
+                    metrics.increment('cache_hits')
+                elif controller is not None and not controller.allow():
+                    break
+                else:
+                    from_cache = False
+                    if controller is None:
+                        response = call_with_backoff(pager._get_next,next_link,limiter=limiter,metrics=metrics)
+                    else:
+                        response = call_observed(controller,pager._get_next,next_link,limiter=limiter,metrics=metrics)
+                    page_json  = response.json()
+                    metrics.add_volume('api_fetch',len(page_json['value']),len(response.content))
+                    if cache is not None:
+                        cache.put(page_key,page_json)
+                page_count += 1
+                next_link  = page_json.get('nextLink')
+                page_state.update({'pages' : resume_pages+page_count, 'complete' : next_link is None})
+                if not put_page(((page_json['value'],next_link) if with_links else page_json['value'],None)):
+                    return
+                if next_link is None:
+                    break
+            logging.info(f"Total pages scanned : {page_count}")
+            put_page((end_marker,None))
+        except Exception as e:
+            put_page((None,e))
+
+    producer = threading.Thread(target=produce_pages,name=f"adf-pages-{factory_name}",daemon=True)
+    producer.start()
+    try:
+        while True:
+            page,error = pages.get()
+            if error is not None:
+                raise error
+            if page is end_marker:
+                break
+            yield page
+    finally:
+        stop.set()
@@ -0,0 +1,159 @@
+'''
+#   ^           _
+#  /_\  |\  /| |_
+# /   \ | \/ | |_
+#
+
+Name : checkpoint
+Desc : Checkpoints of extractions that the function timeout may interrupt (T_ADF_META_EXTRACT_CHECKPOINT), one row per API,
+       factory and stage table. While an extraction streams to its stage table, the spool is loaded every
+       AME_CHECKPOINT_FLUSH_ROWS rows or AME_CHECKPOINT_FLUSH_SECONDS seconds and the progress covered by the staged rows is
+       saved with it : the nextLink and page count of a factory listing, or the pipeline runs whose activities are staged.
+       The next invocation that finds the checkpoint IN_PROGRESS keeps the staged rows and resumes from there instead of
+       calling the API again. Checkpoints older than AME_CHECKPOINT_MAX_AGE_MINUTES are started over.
+Deployment      : Terraform
+Functions    : 1.  ExtractCheckpoint      | Checkpoint of one extraction : load, begin, mark / save progress, complete.
+               2.  generate_checkpointed  | Pass batches through, marking the progress each one covers on the checkpoint.
+               3.  get_checkpoint         | Checkpoint of a request, or None when disabled (payload "checkpoint" / AME_CHECKPOINT_ENABLED).
+'''
+import sys
+import json
+import time
+import logging
+from .common_variables import *
+from .common_functions import execute_snowflake_sql,get_exception_message
+
+CHECKPOINT_TABLE = f"{AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{T_ADF_META_EXTRACT_CHECKPOINT}"
+CURRENT_TS       = "to_timestamp_ntz(convert_timezone('UTC', current_timestamp()))"
+
+
+class ExtractCheckpoint:
+
+    def __init__(self,api_name:str,factory_name:str,stage_table:str,load_mode:str=None,flush_rows:int=CHECKPOINT_FLUSH_ROWS,
+                 flush_seconds:float=CHECKPOINT_FLUSH_SECONDS):
+        self.api_name       = api_name
+        self.factory_name   = factory_name
+        self.stage_table    = stage_table
+        self.load_mode      = load_mode
+        self.flush_rows     = flush_rows
+        self.flush_seconds  = flush_seconds
+        self.resumed        = False
+        self.claim_id       = None
+        self.progress       = {}    # saved with the rows staged so far
+        self.staged_rows    = 0
+        self.staged_batches = 0     # flushes of the spool into the stage table
+        self._marked        = {}    # progress of the batches spooled since the last flush
+        self._unflushed     = 0
+        self._flushed_at    = time.monotonic()
+
+    def _key(self)->tuple:
+        return (self.api_name,self.factory_name,self.stage_table)
+
+    ## Read the checkpoint. resumed is set when it is IN_PROGRESS for the same load mode and recent enough to resume. ########
+    def load(self)->dict:
+        select_sql = f'''select STATE, LOAD_MODE, CLAIM_ID, PROGRESS, STAGED_ROWS, STAGED_BATCHES,
+                         datediff(minute, ETL_UPDATE_TS, {CURRENT_TS}) from {CHECKPOINT_TABLE}
+                         where API_NAME = %s and FACTORY_NAME = %s and STAGE_TABLE = %s'''
+        execution_result = execute_snowflake_sql(select_sql,self._key())
+        if execution_result['status_code'] != 200 or not execution_result['message']:
+            return execution_result
+        state,load_mode,claim_id,progress,staged_rows,staged_batches,age_minutes = execution_result['message'][0]
+        if state != CHECKPOINT_IN_PROGRESS:
+            return execution_result
+        if load_mode != self.load_mode or age_minutes > CHECKPOINT_MAX_AGE_MINUTES:
+            logging.warning(f"Checkpoint of {self.api_name} ({load_mode}, {age_minutes} min old) is not resumed. Starting over.")
+            return execution_result
+        self.resumed        = True
+        self.claim_id       = claim_id
+        self.progress       = json.loads(progress) if progress else {}
+        self.staged_rows    = staged_rows or 0
+        self.staged_batches = staged_batches or 0
+        logging.info(f"Resuming {self.api_name} of {self.factory_name} : {self.staged_rows} rows staged in {self.staged_batches} batches")
+        return execution_result
+
+    ## Start the extraction over : the caller has truncated the stage table. ##################################################
+    def begin(self,claim_id:str=None,progress:dict=None)->dict:
+        self.resumed        = False
+        self.claim_id       = claim_id
+        self.progress       = {}
+        self.staged_rows    = 0
+        self.staged_batches = 0
+        self._marked        = dict(progress or {})
+        begin_sql = f'''
+            MERGE into {CHECKPOINT_TABLE} tgt
+            USING ( select %s as API_NAME, %s as FACTORY_NAME, %s as STAGE_TABLE, %s as LOAD_MODE, %s as CLAIM_ID ) src
+            ON tgt.API_NAME = src.API_NAME and tgt.FACTORY_NAME = src.FACTORY_NAME and tgt.STAGE_TABLE = src.STAGE_TABLE
+
+            WHEN matched THEN UPDATE SET
+            tgt.STATE = '{CHECKPOINT_IN_PROGRESS}', tgt.LOAD_MODE = src.LOAD_MODE, tgt.CLAIM_ID = src.CLAIM_ID, tgt.PROGRESS = null,
+            tgt.STAGED_ROWS = 0, tgt.STAGED_BATCHES = 0, tgt.STARTED_TS = {CURRENT_TS}, tgt.ETL_UPDATE_TS = {CURRENT_TS}
+
+            WHEN NOT matched THEN INSERT (API_NAME,FACTORY_NAME,STAGE_TABLE,STATE,LOAD_MODE,CLAIM_ID,STAGED_ROWS,STAGED_BATCHES,
+                                          STARTED_TS,ETL_INSERT_TS,ETL_UPDATE_TS)
+            VALUES (src.API_NAME,src.FACTORY_NAME,src.STAGE_TABLE,'{CHECKPOINT_IN_PROGRESS}',src.LOAD_MODE,src.CLAIM_ID,0,0,
+                    {CURRENT_TS},{CURRENT_TS},{CURRENT_TS})
+        '''
+        return execute_snowflake_sql(begin_sql,self._key()+(self.load_mode,claim_id))
+
+    ## Progress covered by the batches produced so far. Takes effect with the next save. ######################################
+    def mark(self,progress:dict):
+        self._marked.update(progress)
+
+    ## Whether the spool is due for a flush, with rows more rows spooled
+    def due(self,rows:int)->bool:
+        self._unflushed += rows
+        return self._unflushed >= self.flush_rows or time.monotonic() - self._flushed_at >= self.flush_seconds
+
+    ## Record staged_rows more rows in the stage table and the progress marked up to them ######################################
+    def save(self,staged_rows:int)->dict:
+        self.progress.update(self._marked)
+        self._marked         = {}
+        self._unflushed      = 0
+        self._flushed_at     = time.monotonic()
+        self.staged_rows    += staged_rows
+        self.staged_batches += 1 if staged_rows else 0
+        save_sql = f'''update {CHECKPOINT_TABLE} set PROGRESS = parse_json(%s), STAGED_ROWS = %s, STAGED_BATCHES = %s, ETL_UPDATE_TS = {CURRENT_TS}
+                       where API_NAME = %s and FACTORY_NAME = %s and STAGE_TABLE = %s'''
+        execution_result = execute_snowflake_sql(save_sql,(json.dumps(self.progress),self.staged_rows,self.staged_batches)+self._key())
+        if execution_result['status_code'] == 200:
+            logging.info(f"Checkpoint saved : {self.staged_rows} rows staged in {self.staged_batches} batches")
+        return execution_result
+
+    ## The staged rows are in the target table : nothing is left to resume
+    def complete(self)->dict:
+        complete_sql = f'''update {CHECKPOINT_TABLE} set STATE = '{CHECKPOINT_COMPLETE}', ETL_UPDATE_TS = {CURRENT_TS}
+                           where API_NAME = %s and FACTORY_NAME = %s and STAGE_TABLE = %s'''
+        return execute_snowflake_sql(complete_sql,self._key())
+
+    def summary(self)->dict:
+        return {'resumed' : self.resumed, 'staged_rows' : self.staged_rows, 'staged_batches' : self.staged_batches}
+
+
+## Pass batches through, marking get_progress() on the checkpoint as each batch is handed over. The producer is suspended ####
+## right after the batch, so the progress describes exactly the rows produced up to and including it. Once the producer is
+## exhausted the final progress is marked too (eg. trailing empty pages).
+def generate_checkpointed(batches:object,checkpoint:ExtractCheckpoint,get_progress)->object:
+    for batch in batches:
+        checkpoint.mark(get_progress())
+        yield batch
+    checkpoint.mark(get_progress())
+
+
+## Checkpoint of a request (payload "checkpoint", defaults to AME_CHECKPOINT_ENABLED), read from the control table. ##########
+## Returns the checkpoint as message, None when checkpoints are disabled.
+def get_checkpoint(payload:dict,api_name:str,stage_table:str,load_mode:str=None)->dict:
+    try:
+        function_name = sys._getframe().f_code.co_name
+        checkpoint    = None
+        enabled       = payload.get('checkpoint')
+        if enabled if enabled is not None else CHECKPOINT_ENABLED:
+            checkpoint = ExtractCheckpoint(api_name,payload.get('factory_name'),stage_table,load_mode)
+            execution_result = checkpoint.load()
+            if execution_result['status_code'] != 200:
+                return execution_result
+        return {"status" : 'Success', "status_code":200,"function_name" : function_name , "message" :  checkpoint }
+    except Exception as e:
+        error_message = str(e)
+        function_name = sys._getframe().f_code.co_name
+        output_error = get_exception_message(function_name ,error_message)
+        return output_error
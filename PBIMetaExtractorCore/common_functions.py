@@ -10,21 +10,40 @@
     Last updated    : 3/11/2021
     Deployment      : Terraform
     Updated by   : Thomas Mathew.
-    Functions    : 1.  execute_snowflake_sql | Execute Snowflake SQL and return all records as list of tuples.     
+    Functions    : 1.  execute_snowflake_sql | Execute Snowflake SQL on a pooled connection and return all records as list of tuples.
                    2.  dict_clean            | Cleans a dictionary data structure by replacing Pythonic "None" with string 'None' to avoid DB insert failures
                    3.  convert_to_hhmiss     | Converts milliseconds to hh:mi:ss format for readability.
-                   4.  get_adf_client        | Authenticate ADF and return ADF Client object.
+                   4.  get_adf_client        | Return the worker's cached ADF Client object, authenticating on first use.
+                   5.  stream_to_snowflake   | Load rows of a generator into a table through a Parquet spool, in batches of LOAD_BATCH_SIZE rows.
+                   6.  spool_to_snowflake    | Spool batches as Arrow/Parquet and load them with one PUT/COPY INTO, parsing JSON columns straight into VARIANT.
+                   7.  to_json_column        | Replaces None with 'None' (as dict_clean) in one walk and serializes to JSON, with orjson when installed.
+                   8.  stream_frames_to_snowflake | Load DataFrames of a generator into a table, for columnar transforms.
+                   9.  convert_to_hhmiss_column / to_timestamp_column | Vectorized duration and timestamp formatting of a column.
+                   10. get_merge_sql         | MERGE of a stage table into its target on key columns, updating only changed rows.
+                   11. load_spool            | PUT/COPY one spool run into a table. spool_to_snowflake flushes a run per checkpoint.
+                   12. stream_snowflake_sql  | Yield the records of a query, fetched in batches of SNW_FETCH_BATCH_SIZE, for large result sets.
+                   13. replace_snapshot_table| Full refresh of a snapshot table : build a shadow table and swap it with the live one.
+                   14. get_factory_resource_id | Resource ID of a factory, the prefix of the IDs of its datasets, pipelines ...
 '''
 import os
 import sys
+import json
+import re
+import time
+import threading
 import logging
+import numpy
 import pandas
-import snowflake
 from .common_variables import *
-from snowflake.connector.pandas_tools import write_pandas
-#from azure.mgmt.datafactory import DataFactoryManagementClient
-from azure.mgmt.powerbiembedded import PowerBIEmbeddedManagementClient
+from .snowflake_pool import SNOWFLAKE_POOL
+from .instrumentation import StageMetrics
+from .parquet_spool import ParquetSpool,rows_to_arrow,frame_to_arrow,copy_spool_into_snowflake,cleanup_spool
+from azure.mgmt.datafactory import DataFactoryManagementClient
 from azure.common.credentials import ServicePrincipalCredentials
+try:
+    import orjson # Optional fast JSON encoder
+except ImportError:
+    orjson = None
 
 # Get the credentials from Application Settings/ Key Vault.
 AME_SNW_USERNAME = os.environ["AME_SNW_USERNAME"]
@@ -39,13 +58,14 @@ TENANT    = os.environ["AME_TENANT"]
 SUBSCRIPTION_ID    = os.environ["AME_SUBSCRIPTION_ID"]
 
 
-## Common Exception Message# #################################################################################################
-def df_dedup(df:object)->object:
+## Remove duplicate records. With key_columns, only the key is compared (the keep row of each key is kept), which avoids
+## hashing large JSON columns; without, whole rows are compared.
+def df_dedup(df:object,key_columns:list=None,keep:str='first')->object:
     logging.info("Removing duplicate records in a dataframe")
-    count_before_dedup = df.count()[0]
+    count_before_dedup = len(df)
     logging.info(f"Count before removing duplicates : {count_before_dedup}")
-    df_dedup = df.drop_duplicates()
-    count_after_dedup = df_dedup.count()[0]
+    df_dedup = df.drop_duplicates(subset=key_columns,keep=keep)
+    count_after_dedup = len(df_dedup)
     logging.info(f"Count after removing duplicates : {count_after_dedup}")
     return df_dedup
 
@@ -59,12 +79,43 @@ def get_exception_message(function_name:str,error_message:str)->dict:
     logging.error(output_error)
     return output_error
 
+## Service principal credentials per tenant, created once and shared by every client of the worker ########################
+## adal caches the token inside the credentials; it is renewed here before it expires so no request waits on AAD.
+ADF_CREDENTIALS      = {}
+ADF_CREDENTIALS_LOCK = threading.Lock()
+def get_adf_credentials(tenant:str=TENANT)->object:
+    with ADF_CREDENTIALS_LOCK:
+        credentials = ADF_CREDENTIALS.get(tenant)
+        if credentials is None:
+            logging.info(f"Acquiring AAD token for tenant {tenant}")
+            credentials = ServicePrincipalCredentials(client_id=CLIENT_ID, secret=SECRET, tenant=tenant)
+            ADF_CREDENTIALS[tenant] = credentials
+        elif float(credentials.token.get('expires_on',0)) - time.time() < AAD_TOKEN_REFRESH_MARGIN_SECONDS:
+            logging.info(f"Refreshing AAD token for tenant {tenant}")
+            credentials.set_token()
+    return credentials
+
+## Management clients, keyed by (client class, subscription, tenant) and reused across warm invocations ###################
+## keep_alive keeps the HTTP sessions of a client open between requests, so connections are reused too. Do not close them.
+MGMT_CLIENTS      = {}
+MGMT_CLIENTS_LOCK = threading.Lock()
+def get_mgmt_client(client_class:type,subscription_id:str,tenant:str)->object:
+    credentials = get_adf_credentials(tenant)
+    key = (client_class.__name__,subscription_id,tenant)
+    with MGMT_CLIENTS_LOCK:
+        client = MGMT_CLIENTS.get(key)
+        if client is None:
+            client = client_class(credentials, subscription_id)
+            if hasattr(client,'config'): # msrest clients. azure-core clients keep their session open by default.
+                client.config.keep_alive = True
+            MGMT_CLIENTS[key] = client
+    return client
+
 ## Authenticate and get datafactory client object ############################################################################
-#def get_adf_client()->object:
+def get_adf_client(subscription_id:str=SUBSCRIPTION_ID,tenant:str=TENANT)->object:
     try:
 
-        credentials = ServicePrincipalCredentials(client_id=CLIENT_ID, secret=SECRET, tenant=TENANT)
-        adf_client  = DataFactoryManagementClient(credentials, SUBSCRIPTION_ID)
+        adf_client  = get_mgmt_client(DataFactoryManagementClient,subscription_id,tenant)
         
         return adf_client
     except Exception as e:
@@ -73,12 +124,16 @@ def get_exception_message(function_name:str,error_message:str)->dict:
         output_error = get_exception_message(function_name ,error_message)
         return output_error
 
+## Resource ID of a factory. The IDs of its datasets, pipelines ... start with it followed by '/'. ##########################
+def get_factory_resource_id(rg:str,factory_name:str,subscription_id:str=SUBSCRIPTION_ID)->str:
+    return f"/subscriptions/{subscription_id}/resourceGroups/{rg}/providers/Microsoft.DataFactory/factories/{factory_name}"
+
 ## Authenticate and get powerBI client object ############################################################################
-def get_pbi_client()->object:
+def get_pbi_client(subscription_id:str=SUBSCRIPTION_ID,tenant:str=TENANT)->object:
     try:
+        from azure.mgmt.powerbiembedded import PowerBIEmbeddedManagementClient # No extractor uses it; kept out of the cold start.
 
-        credentials = ServicePrincipalCredentials(client_id=CLIENT_ID, secret=SECRET, tenant=TENANT)
-        pbi_client  = PowerBIEmbeddedManagementClient(credentials, subscription_id)
+        pbi_client  = get_mgmt_client(PowerBIEmbeddedManagementClient,subscription_id,tenant)
         
         return pbi_client
     except Exception as e:
@@ -87,31 +142,27 @@ def get_pbi_client()->object:
         output_error = get_exception_message(function_name ,error_message)
         return output_error
 ## Execute Snowflake SQL #####################################################################################################
-def execute_snowflake_sql(sql:str)->list:
+## With metrics, the query ID and duration of the statement are recorded under label. ####################################
+def execute_snowflake_sql(sql:str,params:object=None,metrics:StageMetrics=None,label:str=None)->list:
     try:
-        ctx = snowflake.connector.connect(
+        started = time.perf_counter()
+        with SNOWFLAKE_POOL.connection() as ctx:
+            with ctx.cursor() as cs:
 
-            user        = AME_SNW_USERNAME,
-            password    = AME_SNW_PASSWORD,
-            account     = AME_SNW_ACCOUNT,
-            database    = AME_SNW_DATABASE,
-            schema      = AME_SNW_SCHEMA,
-            warehouse   = AME_SNW_WAREHOUSE
+                logging.info('Executing SQL : ')
+                logging.info(sql)
 
-            )
-        cs = ctx.cursor()
-    
-        logging.info('Executing SQL : ')
-        logging.info(sql)
-
-        ### Execute the Snowflake SQL
-        out=cs.execute(sql)
-        value = out.fetchall()
+                ### Execute the Snowflake SQL
+                out=cs.execute(sql,params)
+                value = out.fetchall()
+                query_id = cs.sfqid
+        record_statement(label,query_id,time.perf_counter() - started,len(value),metrics)
 
         function_name = sys._getframe().f_code.co_name
         status        = 'Success'
         status_code   = 200
-        output_success = {"status" : status, "status_code":status_code,"function_name" : function_name , "message" :  value }
+        output_success = {"status" : status, "status_code":status_code,"function_name" : function_name , "message" :  value ,
+                          "query_id" : query_id }
 
         return output_success
 
@@ -120,39 +171,194 @@ def execute_snowflake_sql(sql:str)->list:
         function_name = sys._getframe().f_code.co_name
         output_error = get_exception_message(function_name ,error_message)
         return output_error
-     
-    finally:
-        ctx.close()
-     
+
+
+## Yield the records of a query, fetched SNW_FETCH_BATCH_SIZE at a time, so large result sets are not held twice in memory ###
+## (list of tuples and the structure built from it). The connection is held while the records are consumed; errors raise.
+def stream_snowflake_sql(sql:str,params:object=None,batch_size:int=SNW_FETCH_BATCH_SIZE,metrics:StageMetrics=None,
+                         label:str=None)->object:
+    started = time.perf_counter()
+    rows    = 0
+    with SNOWFLAKE_POOL.connection() as ctx:
+        with ctx.cursor() as cs:
+            logging.info('Executing SQL : ')
+            logging.info(sql)
+            cs.execute(sql,params)
+            for record in fetch_in_batches(cs,batch_size):
+                rows += 1
+                yield record
+            query_id = cs.sfqid
+    record_statement(label,query_id,time.perf_counter() - started,rows,metrics)
+
+## Records of an executed cursor, fetchmany batch_size at a time
+def fetch_in_batches(cs:object,batch_size:int=SNW_FETCH_BATCH_SIZE)->object:
+    while True:
+        records = cs.fetchmany(batch_size)
+        if not records:
+            return
+        yield from records
+
+## Log the query ID and duration of a statement, and record them on metrics when given
+def record_statement(label:str,query_id:str,seconds:float,rows:int=0,metrics:StageMetrics=None):
+    logging.info(f"Query ID {query_id} ({label or 'sql'}) : {rows} rows in {seconds*1000:.1f} ms")
+    if metrics is not None:
+        metrics.add_statement(label or 'sql',query_id,seconds,rows)
+
 
 ## Write to Snowflake ##################################################################################################
-def write_to_snowflake(df:object,table_name:str)->int:
+## The DataFrame is staged as Parquet and loaded with COPY INTO, parsing variant_columns into VARIANT during the load.
+def write_to_snowflake(df:object,table_name:str,variant_columns:list=None)->int:
+    df_count = 0
+    df_count = df.count()[0]
+    logging.info(f'Appending {df_count} records into {table_name}')
+    execution_result = stream_frames_to_snowflake([df],table_name,variant_columns)
+    if execution_result['status_code'] != 200:
+        return execution_result
+    logging.info(f"Impacted rows : {execution_result['message']}")
+    return execution_result['message'] # Return impacted rows
+
+## Stage table of a load. With a stage_suffix (set per factory by fan-out requests) a dedicated copy of the stage table ####
+## is used, so concurrent extractions do not truncate or merge each other's rows. Returns the table name as message.
+def prepare_stage_table(stage_table:str,stage_suffix:str=None)->dict:
+    function_name = sys._getframe().f_code.co_name
+    if not stage_suffix:
+        return {"status" : 'Success', "status_code":200,"function_name" : function_name , "message" :  stage_table }
+    suffixed_table = f"{stage_table}_{re.sub('[^A-Z0-9_]','_',stage_suffix.upper())}"
+    sql = f"CREATE TRANSIENT TABLE IF NOT EXISTS {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{suffixed_table} LIKE {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{stage_table}"
+    execution_result = execute_snowflake_sql(sql)
+    if execution_result['status_code'] != 200:
+        return execution_result
+    return {"status" : 'Success', "status_code":200,"function_name" : function_name , "message" :  suffixed_table }
+
+## MERGE of a stage table (one row per key) into its target table ###########################################################
+## Matched rows are updated only when one of change_columns differs (all non key columns by default). ETL_INSERT_* are kept
+## and ETL_UPDATE_TS is the merge time.
+def get_merge_sql(target_table:str,stage_table:str,key_columns:list,columns:list,change_columns:list=None)->str:
+    update_columns = [column for column in columns if column not in key_columns and column not in ('ETL_INSERT_TS','ETL_INSERT_ID','ETL_UPDATE_TS')]
+    change_columns = change_columns or [column for column in update_columns if column != 'ETL_UPDATE_ID']
+    merge_sql=f'''
+        MERGE into {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{target_table} tgt
+        USING
+        {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{stage_table} src
+        ON {' and '.join(f"tgt.{column}=src.{column}" for column in key_columns)}
+
+        WHEN  matched AND ({' OR '.join(f"tgt.{column} IS DISTINCT FROM src.{column}" for column in change_columns)}) THEN UPDATE SET
+        {', '.join(f"tgt.{column}=src.{column}" for column in update_columns)},
+        tgt.ETL_UPDATE_TS=to_timestamp_ntz(convert_timezone('UTC', current_timestamp()))
+
+        WHEN NOT matched THEN INSERT ({', '.join(columns)}) VALUES(
+        {', '.join(f"src.{column}" for column in columns)} )
+    '''
+    return merge_sql
+
+## Full refresh of a snapshot table (pipelines, linked services, datasets) with the rows of select_sql ######################
+## The rows are inserted into a shadow copy of the table (same columns, defaults, clustering and grants) and the shadow is
+## swapped with the live table in one metadata operation, so readers see the previous snapshot until the swap and the
+## build does not lock the live table. The previous snapshot is dropped after the swap. SWAP needs ownership of the table :
+## with AME_SNAPSHOT_SWAP_ENABLED false the table is replaced with INSERT OVERWRITE. Returns the rows loaded as message.
+def replace_snapshot_table(table_name:str,columns:list,select_sql:str,metrics:StageMetrics=None)->dict:
+    live_table   = f"{AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{table_name}"
+    shadow_table = f"{live_table}{SNAPSHOT_SHADOW_SUFFIX}"
+    if not SNAPSHOT_SWAP_ENABLED:
+        execution_result = execute_snowflake_sql(f"INSERT OVERWRITE INTO {live_table} ({','.join(columns)}) {select_sql}",metrics=metrics,label='replace')
+        if execution_result['status_code'] == 200:
+            execution_result['message'] = execution_result['message'][0][0]
+        return execution_result
+
+    statements = [(f"CREATE OR REPLACE TABLE {shadow_table} LIKE {live_table} COPY GRANTS",'shadow_create'),
+                  (f"INSERT INTO {shadow_table} ({','.join(columns)}) {select_sql}",'shadow_load'),
+                  (f"ALTER TABLE {live_table} SWAP WITH {shadow_table}",'swap'),
+                  (f"DROP TABLE IF EXISTS {shadow_table}",'shadow_drop')]
+    loaded_rows = 0
+    for sql,label in statements:
+        execution_result = execute_snowflake_sql(sql,metrics=metrics,label=label)
+        if execution_result['status_code'] != 200:
+            return execution_result
+        if label == 'shadow_load':
+            loaded_rows = execution_result['message'][0][0]
+    logging.info(f"Swapped {live_table} with a snapshot of {loaded_rows} rows")
+    execution_result['message'] = loaded_rows
+    return execution_result
+
+## Group rows of a generator into lists of batch_size rows ##############################################################
+def generate_batches(rows:object,batch_size:int)->object:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+## Stream rows to Snowflake ##############################################################################################
+## Rows are converted to Arrow batch by batch as the generator produces them, so at most one batch is held in memory.
+def stream_to_snowflake(rows:object,table_name:str,columns:list,batch_size:int=LOAD_BATCH_SIZE,variant_columns:list=None,
+                        metrics:StageMetrics=None,checkpoint:object=None)->dict:
+    return spool_to_snowflake(generate_batches(rows,batch_size),lambda batch : rows_to_arrow(batch,columns),table_name,variant_columns,metrics,checkpoint)
+
+## Stream DataFrames to Snowflake ########################################################################################
+## For producers that build each batch as a DataFrame (columnar transforms).
+def stream_frames_to_snowflake(frames:object,table_name:str,variant_columns:list=None,metrics:StageMetrics=None,checkpoint:object=None)->dict:
+    return spool_to_snowflake(frames,frame_to_arrow,table_name,variant_columns,metrics,checkpoint)
+
+## Spool batches to Snowflake ###########################################################################################
+## Every batch is converted to Arrow with to_arrow (arrow_build stage) and written to a Parquet spool run (spool stage) as
+## it is produced. The run is then loaded with one PUT and one COPY INTO (load stage). The spool path is returned for replay.
+## With a checkpoint (checkpoint.py), the run is also loaded whenever the checkpoint is due, and the checkpoint saved, so
+## that an interrupted invocation keeps what it staged. A new run is started after each flush.
+def spool_to_snowflake(batches:object,to_arrow:object,table_name:str,variant_columns:list=None,metrics:StageMetrics=None,
+                       checkpoint:object=None)->dict:
     try:
-      
-        ctx = snowflake.connector.connect(
-
-            user        = AME_SNW_USERNAME,
-            password    = AME_SNW_PASSWORD,
-            account     = AME_SNW_ACCOUNT,
-            database    = AME_SNW_DATABASE,
-            schema      = AME_SNW_SCHEMA,
-            warehouse   = AME_SNW_WAREHOUSE
-
-            )
-        df_count = 0
-        df_count = df.count()[0]
-        logging.info(f'Appending {df_count} records into {table_name}')
-        success, nchunks, nrows, _ = write_pandas(ctx, df, table_name)
-        logging.info(f"Impacted rows : {nrows}")    
-        return nrows # Return impacted rows
+        metrics = metrics or StageMetrics()
+        cleanup_spool()
+        impacted_rows = 0
+        spool = ParquetSpool(table_name)
+        try:
+            for batch in batches:
+                with metrics.stage('arrow_build') as volume:
+                    table = to_arrow(batch)
+                    volume['rows'] = table.num_rows
+                with metrics.stage('spool') as volume:
+                    spool.write(table)
+                    volume['rows'] = table.num_rows
+                if checkpoint is not None and checkpoint.due(table.num_rows):
+                    spool.close()
+                    loaded_rows = load_spool(spool,table_name,variant_columns,metrics)
+                    impacted_rows += loaded_rows
+                    execution_result = checkpoint.save(loaded_rows)
+                    if execution_result['status_code'] != 200:
+                        return execution_result
+                    spool = ParquetSpool(table_name)
+        finally:
+            spool.close()
+        loaded_rows = load_spool(spool,table_name,variant_columns,metrics)
+        impacted_rows += loaded_rows
+        if checkpoint is not None:
+            execution_result = checkpoint.save(loaded_rows)
+            if execution_result['status_code'] != 200:
+                return execution_result
+        logging.info(f"Impacted rows : {impacted_rows}")
+
+        function_name = sys._getframe().f_code.co_name
+        output_success = {"status" : 'Success', "status_code":200,"function_name" : function_name , "message" :  impacted_rows , "spool_path" : spool.path }
+        return output_success
     except Exception as e:
         error_message = str(e)
         function_name = sys._getframe().f_code.co_name
         output_error = get_exception_message(function_name ,error_message)
         return output_error
 
-    logging.info("Closing Snowflake connection.")
-    ctx.close()
+## PUT/COPY a closed spool run into the table (load stage). Returns the loaded row count.
+def load_spool(spool:ParquetSpool,table_name:str,variant_columns:list=None,metrics:StageMetrics=None)->int:
+    metrics = metrics or StageMetrics()
+    logging.info(f'Spooled {spool.rows} records for {table_name} into {spool.path}')
+    with metrics.stage('load') as volume:
+        with SNOWFLAKE_POOL.connection() as ctx:
+            loaded_rows = copy_spool_into_snowflake(ctx,spool.path,table_name,variant_columns)
+        volume['rows']  = loaded_rows
+        volume['bytes'] = spool.bytes
+    return loaded_rows
 
 ## Dictionary cleaner #####################################################################################################
 def dict_clean(items):
@@ -169,6 +375,41 @@ def dict_clean(items):
         output_error = get_exception_message(function_name ,error_message)
         return output_error
 
+## Replace None values of dictionaries with the string 'None' in a single walk. Same output as dict_clean. ##############
+def sanitize_none(obj:object)->object:
+    if isinstance(obj,dict):
+        return {key : 'None' if value is None else sanitize_none(value) for key,value in obj.items()}
+    if isinstance(obj,(list,tuple)):
+        return [sanitize_none(value) for value in obj]
+    return obj
+
+## Serialize a semi-structured API attribute to a JSON string for a VARIANT column. Empty values become {}. ##############
+def to_json_column(obj:object)->str:
+    if obj is None or obj == 'None':
+        obj = {}
+    else:
+        obj = sanitize_none(obj)
+    if orjson is not None:
+        return orjson.dumps(obj,option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(obj,separators=(',',':'))
+
+## Vectorized convert_to_hhmiss of a column of milliseconds (None is 0) ##################################################
+TWO_DIGITS = numpy.array([f"{number:02d}" for number in range(100)],dtype=object)
+def convert_to_hhmiss_column(milliseconds:list)->object:
+    seconds = (numpy.nan_to_num(numpy.array(milliseconds,dtype='float64'))//1000).astype('int64')
+    hours,seconds   = numpy.divmod(seconds,3600)
+    minutes,seconds = numpy.divmod(seconds,60)
+    hours_text = TWO_DIGITS[numpy.minimum(hours,99)]
+    if (hours > 99).any():
+        hours_text[hours > 99] = hours[hours > 99].astype(str)
+    return hours_text + ':' + TWO_DIGITS[minutes] + ':' + TWO_DIGITS[seconds]
+
+## ISO timestamp strings (UTC, microseconds) of a column of timezone aware datetimes. None becomes the default string. ##
+def to_timestamp_column(values:list,default:str)->object:
+    epoch_seconds = numpy.array([numpy.nan if value is None else value.timestamp() for value in values],dtype='float64')
+    timestamps    = numpy.round(numpy.nan_to_num(epoch_seconds)*1e6).astype('int64').astype('datetime64[us]')
+    return numpy.where(numpy.isnan(epoch_seconds),default,numpy.datetime_as_string(timestamps,unit='us')).astype(object)
+
 ## Convert milliseconds to hh:mi:ss format #################################################################################
 def convert_to_hhmiss(milliseconds):
     try:
@@ -7,8 +7,8 @@
     Common variable declaration and value assignment. Get the value from Az Function properties.
 '''
 import os
-import pytz
 import datetime
+import tempfile
 
 AVAILABLE_API_LIST=['GetPipelines','GetTriggers','GetPipelineRuns','GetActivityRuns','GetTriggerRuns','GetLinkedServices','GetDatasets']
 
@@ -25,12 +25,98 @@ AME_SECRET              = os.environ["AME_SECRET"]
 AME_TENANT              = os.environ["AME_TENANT"]
 AME_SUBSCRIPTION_ID     = os.environ["AME_SUBSCRIPTION_ID"]
 
+## Snowflake connection pool
+SNW_POOL_MAX_SIZE           = int(os.environ.get("AME_SNW_POOL_MAX_SIZE", 4))
+SNW_POOL_PING_AFTER_SECONDS = int(os.environ.get("AME_SNW_POOL_PING_AFTER_SECONDS", 60))
+SNW_FETCH_BATCH_SIZE        = int(os.environ.get("AME_SNW_FETCH_BATCH_SIZE", 10000))   ## Rows per fetchmany of a result set
+
+## ADF API limits
+ADF_API_RATE_PER_MIN        = int(os.environ.get("AME_ADF_API_RATE_PER_MIN", 999))   ## ADF Limit is 1000 / min
+ADF_API_MAX_WORKERS         = int(os.environ.get("AME_ADF_API_MAX_WORKERS", 8))
+ADF_API_MAX_RETRIES         = int(os.environ.get("AME_ADF_API_MAX_RETRIES", 5))
+ADF_API_PREFETCH_PAGES      = int(os.environ.get("AME_ADF_API_PREFETCH_PAGES", 4))
+
+## Time budget of an invocation (HTTP triggers time out after 230s). The API fetch stops early to keep LOAD_RESERVE_SECONDS
+## for the load and merge of what was fetched.
+TIME_BUDGET_SECONDS         = float(os.environ.get("AME_TIME_BUDGET_SECONDS", 200))
+LOAD_RESERVE_SECONDS        = float(os.environ.get("AME_LOAD_RESERVE_SECONDS", 45))
+
+## AAD tokens of the cached management clients are renewed when they expire within this margin
+AAD_TOKEN_REFRESH_MARGIN_SECONDS = int(os.environ.get("AME_AAD_TOKEN_REFRESH_MARGIN_SECONDS", 300))
+
+## Fan out requests
+FAN_OUT_MAX_PARALLELISM     = int(os.environ.get("AME_FAN_OUT_MAX_PARALLELISM", 4))
+
+## Extraction requests served at once by the async entry points of a worker (extractors.py)
+EXTRACTION_MAX_CONCURRENCY  = int(os.environ.get("AME_EXTRACTION_MAX_CONCURRENCY", 8))
+
+## Durable Functions activity runs orchestration
+DURABLE_CHUNK_SIZE          = int(os.environ.get("AME_DURABLE_CHUNK_SIZE", 100))
+DURABLE_MAX_CHUNKS          = int(os.environ.get("AME_DURABLE_MAX_CHUNKS", 9))     ## 9 x 100 pipeline runs per round stays under 1000 ADF calls / min
+DURABLE_MAX_ROUNDS          = int(os.environ.get("AME_DURABLE_MAX_ROUNDS", 500))
+DURABLE_ROUND_INTERVAL_SECONDS = int(os.environ.get("AME_DURABLE_ROUND_INTERVAL_SECONDS", 60))
+
+## Windowed extraction of run histories (pipeline runs, trigger runs). Windows that return more than one page are split
+## into sub-windows sized by the observed run density and queried concurrently.
+RUN_WINDOW_TARGET_RUNS      = int(os.environ.get("AME_RUN_WINDOW_TARGET_RUNS", 100))      ## ADF returns up to 100 runs per page
+RUN_WINDOW_MIN_SECONDS      = int(os.environ.get("AME_RUN_WINDOW_MIN_SECONDS", 60))       ## Smaller windows follow continuation tokens
+RUN_WINDOW_MAX_SECONDS      = int(os.environ.get("AME_RUN_WINDOW_MAX_SECONDS", 21600))    ## Initial windows are at most 6 hours
+RUN_WINDOW_MAX_SPLIT        = 16
+
+## Snowflake load
+LOAD_BATCH_SIZE             = int(os.environ.get("AME_LOAD_BATCH_SIZE", 5000))
+SOFT_DELETE_BATCH_SIZE      = 1000
+## Full refresh of snapshot tables (ID/NAME/TYPE/PROPERTIES/ETAG) : built in a shadow table and swapped with the live one.
+## Set to false where the Snowflake role does not own the table, to replace it with INSERT OVERWRITE instead.
+SNAPSHOT_SWAP_ENABLED       = os.environ.get("AME_SNAPSHOT_SWAP_ENABLED", "true").lower() == "true"
+SNAPSHOT_SHADOW_SUFFIX      = '_SHADOW'
+
+## Parquet spool of Snowflake loads. Spool runs are kept for replay until they expire or the spool exceeds its size limit.
+SPOOL_DIR                   = os.environ.get("AME_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "ame_spool"))
+SPOOL_COMPRESSION           = os.environ.get("AME_SPOOL_COMPRESSION", "zstd")
+SPOOL_COMPRESSION_LEVEL     = int(os.environ.get("AME_SPOOL_COMPRESSION_LEVEL", 3))
+SPOOL_ROW_GROUP_SIZE        = int(os.environ.get("AME_SPOOL_ROW_GROUP_SIZE", 50000))
+SPOOL_FILE_ROWS             = int(os.environ.get("AME_SPOOL_FILE_ROWS", 200000))   ## Files are PUT in parallel and loaded in parallel by COPY
+SPOOL_PUT_PARALLEL          = int(os.environ.get("AME_SPOOL_PUT_PARALLEL", 8))
+SPOOL_RETENTION_HOURS       = float(os.environ.get("AME_SPOOL_RETENTION_HOURS", 24))
+SPOOL_MAX_MB                = float(os.environ.get("AME_SPOOL_MAX_MB", 512))
+
+## On-disk cache of ADF API responses. Activity runs of completed pipeline runs are kept until evicted by size.
+RESPONSE_CACHE_ENABLED      = os.environ.get("AME_RESPONSE_CACHE_ENABLED", "false").lower() == "true"
+RESPONSE_CACHE_DIR          = os.environ.get("AME_RESPONSE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "ame_response_cache"))
+RESPONSE_CACHE_TTL_SECONDS  = int(os.environ.get("AME_RESPONSE_CACHE_TTL_SECONDS", 900))
+RESPONSE_CACHE_MAX_MB       = float(os.environ.get("AME_RESPONSE_CACHE_MAX_MB", 256))
+RESPONSE_CACHE_EVICT_EVERY  = 200    ## puts between evictions
+
+## Checkpoints of extractions interrupted by the function timeout (checkpoint.py). Staged rows are loaded into the stage table
+## and the progress they cover is saved every CHECKPOINT_FLUSH_ROWS rows or CHECKPOINT_FLUSH_SECONDS seconds.
+CHECKPOINT_ENABLED          = os.environ.get("AME_CHECKPOINT_ENABLED", "true").lower() == "true"
+CHECKPOINT_FLUSH_ROWS       = int(os.environ.get("AME_CHECKPOINT_FLUSH_ROWS", 50000))
+CHECKPOINT_FLUSH_SECONDS    = int(os.environ.get("AME_CHECKPOINT_FLUSH_SECONDS", 60))
+CHECKPOINT_MAX_AGE_MINUTES  = int(os.environ.get("AME_CHECKPOINT_MAX_AGE_MINUTES", 120))   ## Older checkpoints are started over
+CHECKPOINT_IN_PROGRESS      = 'IN_PROGRESS'
+CHECKPOINT_COMPLETE         = 'COMPLETE'
+
+## Activity extraction frontier states
+FRONTIER_PENDING                = 'PENDING'
+FRONTIER_IN_PROGRESS            = 'IN_PROGRESS'
+FRONTIER_DONE                   = 'DONE'
+FRONTIER_CLAIM_TIMEOUT_MINUTES  = int(os.environ.get("AME_FRONTIER_CLAIM_TIMEOUT_MINUTES", 15))
+FRONTIER_UPDATE_BATCH_SIZE      = 1000
+FRONTIER_POLL_OVERLAP_MINUTES   = int(os.environ.get("AME_FRONTIER_POLL_OVERLAP_MINUTES", 5))   ## Re-read window before the last poll of a run
+FRONTIER_ENQUEUE_OVERLAP_MINUTES = int(os.environ.get("AME_FRONTIER_ENQUEUE_OVERLAP_MINUTES", 60)) ## Longer than a GetPipelineRuns invocation
+NON_TERMINAL_ACTIVITY_STATUSES  = ['InProgress','Queued']
+NON_TERMINAL_PIPELINE_STATUSES  = ['InProgress','Queued','Canceling']
+
 ## Table names
 T_ADF_META_PIPELINES           = 'T_ADF_META_PIPELINES'
 T_ADF_META_PIPELINE_RUNS       = 'T_ADF_META_PIPELINE_RUNS'
 T_ADF_META_PIPELINE_RUNS_STG   = 'T_ADF_META_PIPELINE_RUNS_STG'
 T_ADF_META_ACTIVITY_RUNS       = 'T_ADF_META_ACTIVITY_RUNS'
 T_ADF_META_ACTIVITY_RUNS_STG   = 'T_ADF_META_ACTIVITY_RUNS_STG'
+T_ADF_META_ACTIVITY_FRONTIER   = 'T_ADF_META_ACTIVITY_FRONTIER'
+T_ADF_META_EXTRACT_CHECKPOINT  = 'T_ADF_META_EXTRACT_CHECKPOINT'
+T_ADF_META_RUN_WATERMARK       = 'T_ADF_META_RUN_WATERMARK'
 T_ADF_META_TRIGGER_RUNS        = 'T_ADF_META_TRIGGER_RUNS'
 T_ADF_META_TRIGGER_RUNS_STG    = 'T_ADF_META_TRIGGER_RUNS_STG'
 T_ADF_META_TRIGGER_MASTER      = 'T_ADF_META_TRIGGER_MASTER'
@@ -39,6 +125,7 @@ T_ADF_META_SCHEDULE_TRIGGER    = 'T_ADF_META_SCHEDULE_TRIGGER'
 T_ADF_META_TUMBLINGWINDOW_TRIGGER ='T_ADF_META_TUMBLINGWINDOW_TRIGGER'
 T_ADF_META_LINKED_SERVICES   = 'T_ADF_META_LINKED_SERVICES'
 T_ADF_META_DATASETS  = 'T_ADF_META_DATASETS'
+T_ADF_META_DATASETS_STG  = 'T_ADF_META_DATASETS_STG'
 
 
 ## Columns 
@@ -76,7 +163,8 @@ COLUMNS_T_ADF_META_PIPELINE_RUNS =       ['ADDITIONAL_PROPERTIES','RUN_ID','RUN_
                                             'PIPELINE_NAME', 'PARAMETERS','RUN_DIMENSIONS','INVOKED_BY',
                                             'LAST_UPDATED','RUN_START','RUN_END',
                                             'DURATION_IN_MS','DURATION_HH_MI_SS','STATUS','MESSAGE',
-                                            'ETL_INSERT_TS','ETL_UPDATE_TS','ETL_INSERT_ID','ETL_UPDATE_ID'
+                                            'ETL_INSERT_TS','ETL_UPDATE_TS','ETL_INSERT_ID','ETL_UPDATE_ID',
+                                            'FACTORY_NAME'
                                             ]
 
 
@@ -90,7 +178,8 @@ COLUMNS_T_ADF_META_ACTIVITY_RUNS =  ['ADDITIONAL_PROPERTIES','PIPELINE_NAME','PI
 COLUMNS_T_ADF_META_TRIGGER_RUNS =   ['ADDITIONAL_PROPERTIES','TRIGGER_RUN_ID','TRIGGER_NAME','TRIGGER_TYPE',
                     'TRIGGER_RUN_TIMESTAMP', 'STATUS','PROPERTIES','TRIGGERED_PIPELINES',
                     'RUN_DIMENSION','DEPENDENCY_STATUS',
-                    'ETL_INSERT_TS','ETL_UPDATE_TS','ETL_INSERT_ID','ETL_UPDATE_ID'
+                    'ETL_INSERT_TS','ETL_UPDATE_TS','ETL_INSERT_ID','ETL_UPDATE_ID',
+                    'FACTORY_NAME'
                     ]
 
 COLUMNS_T_ADF_META_LINKED_SERVICES  = ['ID','NAME','TYPE','PROPERTIES','ETAG', 
@@ -100,9 +189,20 @@ COLUMNS_T_ADF_META_LINKED_SERVICES  = ['ID','NAME','TYPE','PROPERTIES','ETAG',
 COLUMNS_T_ADF_META_DATASETS  = ['ID','NAME','TYPE','PROPERTIES','ETAG', 
                                           'ETL_INSERT_TS','ETL_UPDATE_TS','ETL_INSERT_ID','ETL_UPDATE_ID' ]
 
+## Semi-structured columns loaded straight into VARIANT
+VARIANT_COLUMNS_T_ADF_META_ACTIVITY_RUNS = ['ADDITIONAL_PROPERTIES','INPUT','OUTPUT','ERROR']
+KEY_COLUMNS_T_ADF_META_ACTIVITY_RUNS     = ['PIPELINE_RUN_ID','ACTIVITY_RUN_ID']
+VARIANT_COLUMNS_T_ADF_META_DATASETS      = ['PROPERTIES']
+VARIANT_COLUMNS_T_ADF_META_PIPELINE_RUNS = ['ADDITIONAL_PROPERTIES','PARAMETERS','RUN_DIMENSIONS','INVOKED_BY']
+KEY_COLUMNS_T_ADF_META_PIPELINE_RUNS     = ['RUN_ID']
+VARIANT_COLUMNS_T_ADF_META_TRIGGER_RUNS  = ['ADDITIONAL_PROPERTIES','PROPERTIES','TRIGGERED_PIPELINES','RUN_DIMENSION','DEPENDENCY_STATUS']
+KEY_COLUMNS_T_ADF_META_TRIGGER_RUNS      = ['TRIGGER_RUN_ID']
+
 ## Date and User ID parameters
-TZ          = pytz.timezone('UTC')
-ETL_TIME    = datetime.datetime.now(TZ).isoformat()
 ETL_ID      = os.environ["AME_SNW_USERNAME"]
 
+## Audit timestamp (UTC, ISO 8601) of an invocation. Taken once per invocation, since a warm worker serves many.
+def get_etl_time()->str:
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
 
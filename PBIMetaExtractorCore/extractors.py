@@ -0,0 +1,61 @@
+'''
+#   ^           _
+#  /_\  |\  /| |_
+# /   \ | \/ | |_
+#
+
+Name : extractors
+Desc : Extractors deployed with the function, by api_name, and the executor they run on. An extractor module (and with it
+       pandas, pyarrow, the ADF SDK models and the Snowflake connector) is imported on the first request for its API, not
+       at cold start, so invalid requests and the other APIs do not pay for it. Keep this module free of heavy imports.
+Deployment      : Terraform
+Functions    : 1.  LazyExtractors | Read only api_name -> extractor mapping that imports the extractor module on first use.
+               2.  run_blocking   | Await a blocking extraction on the worker's extraction executor, off the event loop.
+'''
+import asyncio
+import importlib
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from .common_variables import EXTRACTION_MAX_CONCURRENCY
+
+
+class LazyExtractors(Mapping):
+
+    def __init__(self,modules:dict):
+        self.modules = modules     # api_name -> (module, function)
+        self._loaded = {}
+
+    def __getitem__(self,api_name:str)->object:
+        if api_name not in self._loaded:
+            module_name,function_name = self.modules[api_name]
+            module = importlib.import_module(f".{module_name}",__package__)  # The import lock makes this thread safe.
+            self._loaded[api_name] = getattr(module,function_name)
+        return self._loaded[api_name]
+
+    def __iter__(self):
+        return iter(self.modules)
+
+    def __len__(self)->int:
+        return len(self.modules)
+
+
+## Extractors deployed with this function, by api_name.
+EXTRACTORS = LazyExtractors({
+    'GetDatasets'     : ('get_datasets','get_datasets'),
+    'GetActivityRuns' : ('get_activity_runs','get_activity_runs'),
+    'GetPipelineRuns' : ('get_pipeline_runs','get_pipeline_runs'),
+    'GetTriggerRuns'  : ('get_trigger_runs','get_trigger_runs')
+})
+
+
+## Extractions of async entry points run on this executor, so the event loop of the worker keeps accepting requests while
+## they wait on ADF and Snowflake. At most EXTRACTION_MAX_CONCURRENCY extractions run at once; others wait without a thread.
+EXTRACTION_EXECUTOR = ThreadPoolExecutor(max_workers=EXTRACTION_MAX_CONCURRENCY,thread_name_prefix='extraction')
+async def run_blocking(fn,*args,context:object=None)->object:
+    def run_with_context():
+        ### Logs of the executor thread belong to the invocation (azure-functions thread_local_storage).
+        thread_local_storage = getattr(context,'thread_local_storage',None)
+        if thread_local_storage is not None:
+            thread_local_storage.invocation_id = context.invocation_id
+        return fn(*args)
+    return await asyncio.get_running_loop().run_in_executor(EXTRACTION_EXECUTOR,run_with_context)
@@ -0,0 +1,84 @@
+'''
+#   ^           _
+#  /_\  |\  /| |_
+# /   \ | \/ | |_
+#
+
+Name : fan_out
+Desc : Runs the extractors of a batch request for many factories concurrently. Every (factory, api_name) pair runs in
+       isolation : a failure is reported in its own result and does not stop the others. All pairs share the worker's
+       ADF credentials and Snowflake connection pool.
+Deployment      : Terraform
+'''
+import sys
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from .common_variables import *
+from .common_functions import get_adf_credentials,get_exception_message
+
+## Full loads replace the whole table, so they cannot run for more than one factory in a single request.
+FULL_LOAD_API_LIST = ['GetDatasets']
+
+
+## Run one extractor. Exceptions are turned into an error result so that they stay within the pair. #########################
+def run_extractor(extractors:dict,api_name:str,payload:dict)->dict:
+    try:
+        logging.info(f"Invoking {api_name} API for {payload.get('resource_group')}/{payload.get('factory_name')}")
+        return extractors[api_name](payload)
+    except Exception as e:
+        error_message = str(e)
+        function_name = sys._getframe().f_code.co_name
+        output_error = get_exception_message(function_name ,error_message)
+        return output_error
+
+
+## Entry Point ##############################################################################################################
+## payload : {"factories" : [{"factory_name" : .., "resource_group" : ..}, ..], "api_names" : [..] (defaults to [api_name]),
+##            "max_parallelism" : .., plus any extractor option, applied to every factory}
+## The pairs run on a pool of their own, inside one slot of the extraction executor, each with up to api_concurrency ADF calls.
+## max_parallelism is therefore capped at FAN_OUT_MAX_PARALLELISM, so a request cannot start an unbounded number of threads.
+def run_fan_out(payload:dict,extractors:dict)->dict:
+    try:
+        function_name   = sys._getframe().f_code.co_name
+        factories       = payload.get('factories')
+        api_names       = payload.get('api_names') or [payload.get('api_name')]
+        max_parallelism = min(max(int(payload.get('max_parallelism') or FAN_OUT_MAX_PARALLELISM),1),FAN_OUT_MAX_PARALLELISM)
+
+        invalid_api_names = [api_name for api_name in api_names if api_name not in extractors]
+        if invalid_api_names or not factories:
+            message = f"Invalid batch request. Provide factories and api_names from : {str(list(extractors))}"
+            return {"status" : 'Exception', "status_code":400,"function_name" : function_name , "message" :  message }
+
+        ### Authenticate once; every extractor reuses the same credentials.
+        get_adf_credentials()
+
+        results = {}
+        futures = []
+        with ThreadPoolExecutor(max_workers=max_parallelism) as executor:
+            for factory in factories:
+                factory_key = f"{factory.get('resource_group')}/{factory.get('factory_name')}"
+                results[factory_key] = {}
+                for api_name in api_names:
+                    if api_name in FULL_LOAD_API_LIST and len(factories) > 1 and payload.get('load_mode') != 'incremental':
+                        results[factory_key][api_name] = get_exception_message(function_name,f"{api_name} full load replaces the whole table. Use load_mode incremental for more than one factory.")
+                        continue
+                    ### Factory specific stage tables keep concurrent loads apart.
+                    factory_payload = {**payload, **factory, 'api_name' : api_name, 'stage_suffix' : factory.get('factory_name')}
+                    factory_payload.pop('factories',None)
+                    futures.append((factory_key,api_name,executor.submit(run_extractor,extractors,api_name,factory_payload)))
+
+        for factory_key,api_name,future in futures:
+            results[factory_key][api_name] = future.result()
+
+        failed = sum(1 for factory_result in results.values() for result in factory_result.values() if result.get('status_code') != 200)
+        logging.info(f"Fan out complete. Extractions : {sum(len(r) for r in results.values())} | Failed : {failed}")
+        status      = 'Success' if failed == 0 else 'Partial'
+        status_code = 200 if failed == 0 else 207
+        output_success = {"status" : status, "status_code":status_code,"function_name" : function_name , "message" :  results }
+        return output_success
+
+    except Exception as e:
+        error_message = str(e)
+        function_name = sys._getframe().f_code.co_name
+        output_error = get_exception_message(function_name ,error_message)
+        return output_error
@@ -10,8 +10,8 @@ Last updated    : 3/11/2021
 Deployment      : Terraform
 Last updated by : Thomas Mathew.
 '''
-import pytz
 import sys
+import uuid
 from datetime import date,datetime,timedelta
 import json
 import pandas
@@ -19,169 +19,330 @@ import logging
 from azure.mgmt.datafactory.models import *
 from .common_functions import get_adf_client
 from .common_variables import *
-from .common_functions import execute_snowflake_sql,get_adf_client,write_to_snowflake,get_exception_message,convert_to_hhmiss,dict_clean,df_dedup
+from .common_functions import execute_snowflake_sql,get_adf_client,prepare_stage_table,stream_frames_to_snowflake,get_exception_message,df_dedup
+from .common_functions import convert_to_hhmiss_column,to_timestamp_column,to_json_column,get_factory_resource_id
+from .adf_api import fetch_ordered,call_with_backoff,BatchController,get_batch_controller
+from .activity_frontier import enqueue_pending_runs,claim_pending_runs,complete_claimed_runs,select_completed_runs,count_pending_runs
+from .activity_frontier import select_claimed_runs
+from .checkpoint import ExtractCheckpoint,generate_checkpointed,get_checkpoint
+from .snowflake_statements import SnowflakeStatement,submit_snowflake_sql,wait_for_statements
+from .instrumentation import StageMetrics,export_metrics
+from .response_cache import ResponseCache,get_response_cache
 
 ### Entry point.
 def get_activity_runs(payload):
     try:
         function_name = sys._getframe().f_code.co_name
         logging.info("Inside get_activity_runs")
+        controller = get_batch_controller(payload)  # The time budget starts with the invocation.
         default_api_limit=999  ### ADF Limit is 1000 / min
         impacted_rows=0
 
         factory_name = payload.get('factory_name')
         rg           = payload.get('resource_group')
         api_limit    = payload.get('api_limit')
+        api_concurrency  = payload.get('api_concurrency')
+        batch_size       = payload.get('batch_size')
         watermark_offset = payload.get('watermark_offset')
         delta_days = watermark_offset
 
         if api_limit is None:
                 api_limit = default_api_limit
+        if api_concurrency is None:
+                api_concurrency = ADF_API_MAX_WORKERS
+        if batch_size is None:
+                batch_size = LOAD_BATCH_SIZE
 
+        execution_result = prepare_stage_table(T_ADF_META_ACTIVITY_RUNS_STG,payload.get('stage_suffix'))
+        sql_exec_status_code = execution_result['status_code']
+        if sql_exec_status_code != 200 :
+            logging.error('Exception in prepare_stage_table. Stopping activity execution.')
+            return execution_result
+        stage_table = execution_result['message']
 
-        merge_sql=f'''
-            MERGE into {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{T_ADF_META_ACTIVITY_RUNS}            tgt 
-            USING
-            ( select distinct * FROM {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{T_ADF_META_ACTIVITY_RUNS_STG}  ) src 
-            ON tgt.ACTIVITY_RUN_ID=src.ACTIVITY_RUN_ID and src.PIPELINE_RUN_ID = tgt.PIPELINE_RUN_ID
-                
-            WHEN  matched THEN UPDATE SET
-            tgt.ADDITIONAL_PROPERTIES=src.ADDITIONAL_PROPERTIES,
-            tgt.PIPELINE_NAME=src.PIPELINE_NAME,
-            tgt.PIPELINE_RUN_ID=src.PIPELINE_RUN_ID,
-            tgt.ACTIVITY_NAME=src.ACTIVITY_NAME,
-            tgt.ACTIVITY_TYPE=src.ACTIVITY_TYPE,
-            tgt.ACTIVITY_RUN_ID=src.ACTIVITY_RUN_ID ,
-            tgt.LINKED_SERVICE_NAME=src.LINKED_SERVICE_NAME ,
-            tgt.STATUS=src.STATUS ,
-            tgt.ACTIVITY_RUN_START=src.ACTIVITY_RUN_START,
-            tgt.ACTIVITY_RUN_END=src.ACTIVITY_RUN_END ,
-            tgt.DURATION_IN_MS=src.DURATION_IN_MS ,
-            tgt.DURATION_HH_MI_SS=src.DURATION_HH_MI_SS ,
-            tgt.INPUT=src.INPUT ,
-            tgt.OUTPUT=src.OUTPUT ,
-            tgt.ERROR=src.ERROR ,
-            tgt.ETL_UPDATE_TS=to_timestamp_ntz(convert_timezone('UTC', current_timestamp()))
-            
-            WHEN NOT matched THEN INSERT VALUES(
-            src.ADDITIONAL_PROPERTIES,
-            src.PIPELINE_NAME,
-            src.PIPELINE_RUN_ID,
-            src.ACTIVITY_NAME,
-            src.ACTIVITY_TYPE,
-            src.ACTIVITY_RUN_ID ,
-            src.LINKED_SERVICE_NAME ,
-            src.STATUS ,
-            src.ACTIVITY_RUN_START ,
-            src.ACTIVITY_RUN_END ,
-            src.DURATION_IN_MS ,
-            src.DURATION_HH_MI_SS ,
-            src.INPUT ,
-            src.OUTPUT ,
-            src.ERROR ,
-            src.ETL_INSERT_TS ,
-            src.ETL_UPDATE_TS ,
-            src.ETL_INSERT_ID ,
-            src.ETL_UPDATE_ID )
-        '''
-
+        adf_client   = get_adf_client()
+        metrics      = StageMetrics()
 
+        ######### GET DATE FILTER. The watermark query runs while new pipeline runs are queued below.
+        watermark = submit_snowflake_sql(ACTIVITY_WATERMARK_SQL,metrics=metrics,label='watermark')
 
-        adf_client   = get_adf_client()
+        ### Acitivty Runs are obtained by passing pipeline run id . There is an API-LIMIT of 1000/min at server side. Pipeline run-ids waiting
+        ### for extraction are kept in the frontier table and claimed in chunks of api_limit in the first come first serve fashion.
+        with metrics.stage('frontier_enqueue'):
+            execution_result = enqueue_pending_runs(factory_name)
+        sql_exec_status_code = execution_result['status_code']
+        if sql_exec_status_code != 200 :
+            logging.error('Exception in enqueue_pending_runs. Stopping activity execution.')
+            return execution_result
 
-        ######### GET DATE FILTER
-        tz = pytz.timezone('UTC')
-        execution_result = execute_snowflake_sql(f"select nvl(max(ETL_UPDATE_TS),to_timestamp_ntz(convert_timezone('UTC', current_timestamp()))) as previous_datetime from {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{T_ADF_META_ACTIVITY_RUNS}")
+        execution_result = get_activity_time_window(delta_days,watermark)
         sql_exec_status_code = execution_result['status_code']
         if sql_exec_status_code != 200 :
             logging.error('Exception in execute_snowflake_sql. Stopping activity execution.')
             return execution_result
-        max_date_obj = execution_result['message']
-        max_date = pytz.utc.localize(max_date_obj[0][0]) 
-        #max_date = max_date_obj[0][0] ####  ## Include timezone info to get rid msrestazure tz warning.
-        
-        previous_time = max_date -  timedelta(days=delta_days)
-        current_time = datetime.datetime.now(tz) + timedelta(days=0)
-
-        logging.info(f"Current time : {current_time} | Previous Time : {previous_time}")
+        previous_time,current_time = execution_result['message']
         ########
 
-        ### Acitivty Runs are obtained by passing pipeline run id . There is an API-LIMIT of 1000/min at server side and the below SQL will process a chunk of "500" (a default API limit) pipeline run-ids in the first come first serve fashion.
-
-        pp_extract_sql=f'''
-
-        select  p.run_id AS RUN_ID from {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{T_ADF_META_PIPELINE_RUNS}   p  left outer join {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{T_ADF_META_ACTIVITY_RUNS}  a
-        on p.run_id = a.pipeline_run_id where a.pipeline_run_id is null or a.status='InProgress' 
-        group by  p.run_id,P.ETL_UPDATE_TS
-        order by  P.ETL_UPDATE_TS ASC LIMIT {api_limit}
-
-        '''
-        logging.info(pp_extract_sql)
-        execution_result = execute_snowflake_sql(pp_extract_sql)
+        ### An invocation interrupted by the timeout resumes its claim : the pipeline runs whose activities it staged are not fetched again.
+        execution_result = get_checkpoint(payload,'GetActivityRuns',stage_table)
         sql_exec_status_code = execution_result['status_code']
         if sql_exec_status_code != 200 :
-            logging.error('Exception in execute_snowflake_sql. Stopping activity execution.')
+            logging.error('Exception in get_checkpoint. Stopping activity execution.')
             return execution_result
-        pipeline_runids = execution_result['message']
-        activity_generator_list = []
-        for tuples in pipeline_runids:
-            pp_run_id =  tuples[0] # select the element within tuple.
-            activity_generator = get_activity_detail(adf_client,rg,factory_name,pp_run_id,previous_time,current_time)
-            activity_generator_list.append(activity_generator)
-            
-        gen_activity_runs = generate_activity(activity_generator_list)
-        logging.info("Started fetching the Activity API..")
-        df_activity_runs = pandas.DataFrame(data=gen_activity_runs,columns=COLUMNS_T_ADF_META_ACTIVITY_RUNS)
-        #df_activity_runs = df_dedup(df_activity_runs)
-        count_of_df = df_activity_runs.count()[0]
-       
-        logging.info(f"Total count of records : {count_of_df}")
+        checkpoint = execution_result['message']
 
-        if count_of_df!=0:
-            ##################### ACTIVITY SNOWFLAKE LOAD
-            ###Truncate
-            logging.info(f'Truncating {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{T_ADF_META_ACTIVITY_RUNS_STG}')
-            execution_result = execute_snowflake_sql(f"TRUNCATE TABLE {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{T_ADF_META_ACTIVITY_RUNS_STG}")
+        pipeline_runids = None
+        if checkpoint is not None and checkpoint.resumed and checkpoint.claim_id:
+            claim_id = checkpoint.claim_id
+            with metrics.stage('frontier_claim'):
+                execution_result = select_claimed_runs(claim_id,factory_name,renew=True)
             sql_exec_status_code = execution_result['status_code']
             if sql_exec_status_code != 200 :
-                logging.warn('Exception in execute_snowflake_sql. Stopping activity execution.')
-                return execution_result 
-            ###Load
-            logging.info(f'Loading {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{T_ADF_META_ACTIVITY_RUNS_STG}')
-            impacted_rows = write_to_snowflake(df_activity_runs,T_ADF_META_ACTIVITY_RUNS_STG)
-            ##Update  variant
-            #logging.info(f"Impacted rows : {impacted_rows}")
-            logging.info(f'Updating variant columns in {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{T_ADF_META_ACTIVITY_RUNS_STG}')
-            sql=f'''update {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{T_ADF_META_ACTIVITY_RUNS_STG} set ADDITIONAL_PROPERTIES=parse_json(ADDITIONAL_PROPERTIES),
-                                    INPUT=parse_json(INPUT),
-                                    OUTPUT=parse_json(OUTPUT),
-                                    ERROR = parse_json(ERROR)
-                                '''
-            execution_result=execute_snowflake_sql(sql)
+                logging.error('Exception in select_claimed_runs. Stopping activity execution.')
+                return execution_result
+            if execution_result['message']:
+                processed_runids = set(checkpoint.progress.get('processed_run_ids',[]))
+                pipeline_runids  = [run_id for run_id in execution_result['message'] if run_id not in processed_runids]
+                last_polled      = execution_result['last_polled']
+                logging.info(f"Resumed claim {claim_id} : {len(processed_runids)} pipeline runs staged, {len(pipeline_runids)} left")
+            else:
+                ### The claim expired and was released by enqueue_pending_runs : the staged activities are extracted again.
+                logging.warning(f"Claim {claim_id} of the checkpoint expired. Starting over.")
+                checkpoint.resumed = False
+
+        if pipeline_runids is None:
+            claim_id = str(uuid.uuid4())
+            with metrics.stage('frontier_claim'):
+                execution_result = claim_pending_runs(api_limit,claim_id,factory_name)
             sql_exec_status_code = execution_result['status_code']
             if sql_exec_status_code != 200 :
-                logging.error('Exception in execute_snowflake_sql. Stopping activity execution.')
+                logging.error('Exception in claim_pending_runs. Stopping activity execution.')
                 return execution_result
-            updated_rows = execution_result['message'][0][0]
-            logging.info(f'Updated rows {updated_rows}')
+            pipeline_runids = execution_result['message']
+            last_polled     = execution_result['last_polled']
 
-            ###Merge
-            logging.info(f'Merge to {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{T_ADF_META_ACTIVITY_RUNS}')
-            execution_result=execute_snowflake_sql(merge_sql)
+        execution_result = load_activity_runs(adf_client,rg,factory_name,claim_id,pipeline_runids,previous_time,current_time,
+                                              stage_table,api_concurrency,batch_size,metrics,get_response_cache(payload),last_polled,controller,
+                                              checkpoint)
+        sql_exec_status_code = execution_result['status_code']
+        if sql_exec_status_code != 200 :
+            return execution_result
+        impacted_rows = execution_result['message']
+
+        ### Pipeline runs left for the next invocations, including the claimed ones that did not fit in the time budget.
+        execution_result = count_pending_runs(factory_name)
+        sql_exec_status_code = execution_result['status_code']
+        if sql_exec_status_code != 200 :
+            logging.error('Exception in count_pending_runs. Stopping activity execution.')
+            return execution_result
+        backlog = {**controller.summary(), 'pending_runs' : execution_result['message'],
+                   'checkpoint' : checkpoint.summary() if checkpoint is not None else None}
+        logging.info(f"Residual backlog : {backlog}")
+
+        status='Success'
+        message={f"Impacted rows on  {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{T_ADF_META_ACTIVITY_RUNS}":impacted_rows}
+        export_metrics(metrics,{'api_name' : 'GetActivityRuns', 'factory_name' : factory_name})
+        output_success = {"status" : status, "status_code":200,"function_name" : function_name , "message" :  message ,
+                          "backlog" : backlog, "metrics" : metrics.summary() }
+        return output_success
+    except Exception as e:
+        error_message = str(e)
+        function_name = sys._getframe().f_code.co_name
+        output_error = get_exception_message(function_name ,error_message)
+        return output_error
+
+
+## Activity run filter window : [max(ETL_UPDATE_TS) - watermark_offset days, now] ############################################
+## watermark is ACTIVITY_WATERMARK_SQL when it was submitted already, so that it runs alongside other statements.
+ACTIVITY_WATERMARK_SQL = f"select nvl(max(ETL_UPDATE_TS),to_timestamp_ntz(convert_timezone('UTC', current_timestamp()))) as previous_datetime from {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{T_ADF_META_ACTIVITY_RUNS}"
+def get_activity_time_window(delta_days:int,watermark:SnowflakeStatement=None)->dict:
+    execution_result = watermark.result() if watermark is not None else execute_snowflake_sql(ACTIVITY_WATERMARK_SQL)
+    if execution_result['status_code'] != 200 :
+        return execution_result
+    max_date_obj = execution_result['message']
+    max_date = max_date_obj[0][0].replace(tzinfo=datetime.timezone.utc) ## Include timezone info to get rid msrestazure tz warning.
+
+    previous_time = max_date -  timedelta(days=delta_days)
+    current_time = datetime.datetime.now(datetime.timezone.utc) + timedelta(days=0)
+
+    logging.info(f"Current time : {current_time} | Previous Time : {previous_time}")
+    execution_result['message'] = (previous_time,current_time)
+    return execution_result
+
+
+## MERGE of the stage table into T_ADF_META_ACTIVITY_RUNS #####################################################################
+## The stage table holds one row per (PIPELINE_RUN_ID, ACTIVITY_RUN_ID) : batches are deduplicated on the key before the load.
+## Activities already stored with the same status, end and duration are left untouched, so re-polled activities that did
+## not change do not rewrite the table.
+def get_activity_merge_sql(stage_table:str)->str:
+    merge_sql=f'''
+        MERGE into {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{T_ADF_META_ACTIVITY_RUNS}            tgt 
+        USING
+        {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{stage_table} src 
+        ON tgt.ACTIVITY_RUN_ID=src.ACTIVITY_RUN_ID and src.PIPELINE_RUN_ID = tgt.PIPELINE_RUN_ID
+            
+        WHEN  matched AND (tgt.STATUS IS DISTINCT FROM src.STATUS OR tgt.ACTIVITY_RUN_END IS DISTINCT FROM src.ACTIVITY_RUN_END
+                           OR tgt.DURATION_IN_MS IS DISTINCT FROM src.DURATION_IN_MS) THEN UPDATE SET
+        tgt.ADDITIONAL_PROPERTIES=src.ADDITIONAL_PROPERTIES,
+        tgt.PIPELINE_NAME=src.PIPELINE_NAME,
+        tgt.PIPELINE_RUN_ID=src.PIPELINE_RUN_ID,
+        tgt.ACTIVITY_NAME=src.ACTIVITY_NAME,
+        tgt.ACTIVITY_TYPE=src.ACTIVITY_TYPE,
+        tgt.ACTIVITY_RUN_ID=src.ACTIVITY_RUN_ID ,
+        tgt.LINKED_SERVICE_NAME=src.LINKED_SERVICE_NAME ,
+        tgt.STATUS=src.STATUS ,
+        tgt.ACTIVITY_RUN_START=src.ACTIVITY_RUN_START,
+        tgt.ACTIVITY_RUN_END=src.ACTIVITY_RUN_END ,
+        tgt.DURATION_IN_MS=src.DURATION_IN_MS ,
+        tgt.DURATION_HH_MI_SS=src.DURATION_HH_MI_SS ,
+        tgt.INPUT=src.INPUT ,
+        tgt.OUTPUT=src.OUTPUT ,
+        tgt.ERROR=src.ERROR ,
+        tgt.ETL_UPDATE_TS=to_timestamp_ntz(convert_timezone('UTC', current_timestamp()))
+        
+        WHEN NOT matched THEN INSERT VALUES(
+        src.ADDITIONAL_PROPERTIES,
+        src.PIPELINE_NAME,
+        src.PIPELINE_RUN_ID,
+        src.ACTIVITY_NAME,
+        src.ACTIVITY_TYPE,
+        src.ACTIVITY_RUN_ID ,
+        src.LINKED_SERVICE_NAME ,
+        src.STATUS ,
+        src.ACTIVITY_RUN_START ,
+        src.ACTIVITY_RUN_END ,
+        src.DURATION_IN_MS ,
+        src.DURATION_HH_MI_SS ,
+        src.INPUT ,
+        src.OUTPUT ,
+        src.ERROR ,
+        src.ETL_INSERT_TS ,
+        src.ETL_UPDATE_TS ,
+        src.ETL_INSERT_ID ,
+        src.ETL_UPDATE_ID )
+    '''
+    return merge_sql
+
+
+## Fetch, stage and merge the activity runs of the claimed pipeline runs, then close the claim on the frontier. ###############
+## With a checkpoint, the pipeline runs whose activities are staged are saved with every flush of the stage table. A resumed
+## checkpoint keeps the staged activities : pipeline_runids are then the claimed runs that were not staged yet.
+def load_activity_runs(adf_client,rg:str,factory_name:str,claim_id:str,pipeline_runids:list,previous_time:object,current_time:object,
+                       stage_table:str,api_concurrency:int=ADF_API_MAX_WORKERS,batch_size:int=LOAD_BATCH_SIZE,metrics:StageMetrics=None,
+                       cache:ResponseCache=None,last_polled:dict=None,controller:BatchController=None,
+                       checkpoint:ExtractCheckpoint=None)->dict:
+    try:
+        function_name = sys._getframe().f_code.co_name
+        impacted_rows = 0
+        metrics       = metrics or StageMetrics()
+        last_polled   = last_polled or {}
+        resumed       = checkpoint is not None and checkpoint.resumed
+        progress      = checkpoint.progress if resumed else {}
+        pending_runids   = set(progress.get('pending_run_ids',[]))
+        unpolled_runids  = set(progress.get('unpolled_run_ids',[]))   # Not read from ADF in this poll : failed fetches and cached responses.
+        processed_runids = set(progress.get('processed_run_ids',[]))
+        ### The runs of a resumed claim were polled up to the current time of the first invocation.
+        polled_ts = datetime.datetime.fromisoformat(progress['polled_ts']) if 'polled_ts' in progress else \
+                    current_time.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+        ### With the response cache, responses of completed pipeline runs are kept without expiry.
+        completed_runids = set()
+        lookup_activity  = None
+        if cache is not None:
+            execution_result = select_completed_runs(pipeline_runids)
+            if execution_result['status_code'] != 200 :
+                logging.error('Exception in select_completed_runs. Stopping activity execution.')
+                return execution_result
+            completed_runids = set(execution_result['message'])
+            lookup_activity  = lambda pp_run_id : get_cached_activity_runs(cache,rg,factory_name,pp_run_id,metrics,unpolled_runids)
+
+        ### Activity runs are fetched concurrently within the ADF rate limit and parsed in pipeline run order. Runs polled
+        ### before only ask for the activities updated since their last poll.
+        fetch_activity = lambda pp_run_id : fetch_activity_runs(adf_client,rg,factory_name,pp_run_id,
+                                                                get_poll_start(previous_time,last_polled.get(pp_run_id)),current_time,
+                                                                cache,pp_run_id in completed_runids,metrics)
+        ### With a controller, the claimed runs that would not be fetched within the time budget are skipped and released.
+        activity_responses = fetch_ordered(fetch_activity,pipeline_runids,max_workers=api_concurrency,metrics=metrics,lookup=lookup_activity,
+                                           controller=controller)
+        gen_activity_frames = generate_activity_frames(track_pending_runs(activity_responses,pending_runids,metrics,unpolled_runids,processed_runids),
+                                                       batch_size,metrics,get_etl_time())
+        if checkpoint is not None:
+            gen_activity_frames = generate_checkpointed(gen_activity_frames,checkpoint,
+                                                        lambda : {'processed_run_ids' : sorted(processed_runids), 'pending_run_ids' : sorted(pending_runids),
+                                                                  'unpolled_run_ids' : sorted(unpolled_runids)})
+
+        ##################### ACTIVITY SNOWFLAKE LOAD
+        truncate = None
+        if resumed:
+            ###Rows of a flush whose checkpoint was not saved belong to runs that are fetched again.
+            with metrics.stage('truncate'):
+                execution_result = delete_staged_runs(stage_table,pipeline_runids)
             sql_exec_status_code = execution_result['status_code']
             if sql_exec_status_code != 200 :
-                logging.error('Exception in execute_snowflake_sql. Stopping activity execution.')
+                logging.error('Exception in delete_staged_runs. Stopping activity execution.')
                 return execution_result
-            impacted_rows =execution_result['message'][0][0]
+        else:
+            ###Truncate. The TRUNCATE runs while the first activity runs are fetched : frames are held back until it completed.
+            logging.info(f'Truncating {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{stage_table}')
+            truncate = submit_snowflake_sql(f"TRUNCATE TABLE {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{stage_table}",metrics=metrics,label='truncate')
+            gen_activity_frames = wait_for_statements(gen_activity_frames,[truncate])
+            if checkpoint is not None:
+                execution_result = checkpoint.begin(claim_id,{'polled_ts' : polled_ts.isoformat()})
+                sql_exec_status_code = execution_result['status_code']
+                if sql_exec_status_code != 200 :
+                    logging.error('Exception in checkpoint begin. Stopping activity execution.')
+                    return execution_result
+        ###Load. Activity runs are fetched while earlier batches are written to the stage table. JSON columns are parsed into VARIANT by the load.
+        logging.info("Started fetching the Activity API..")
+        logging.info(f'Loading {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{stage_table}')
+        execution_result = stream_frames_to_snowflake(gen_activity_frames,stage_table,
+                                                      variant_columns=VARIANT_COLUMNS_T_ADF_META_ACTIVITY_RUNS,metrics=metrics,checkpoint=checkpoint)
+        if truncate is not None and truncate.result()['status_code'] != 200 :
+            logging.warn('Exception in execute_snowflake_sql. Stopping activity execution.')
+            return truncate.result()
+        sql_exec_status_code = execution_result['status_code']
+        if sql_exec_status_code != 200 :
+            logging.error('Exception in stream_frames_to_snowflake. Stopping activity execution.')
+            return execution_result
+        count_of_df = execution_result['message']
+
+        logging.info(f"Total count of records : {count_of_df}")
+
+        if count_of_df!=0 or (checkpoint is not None and checkpoint.staged_rows):
+            ###Merge
+            logging.info(f'Merge to {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{T_ADF_META_ACTIVITY_RUNS}')
+            with metrics.stage('merge') as volume:
+                execution_result=execute_snowflake_sql(get_activity_merge_sql(stage_table),metrics=metrics,label='merge')
+                sql_exec_status_code = execution_result['status_code']
+                if sql_exec_status_code != 200 :
+                    logging.error('Exception in execute_snowflake_sql. Stopping activity execution.')
+                    return execution_result
+                impacted_rows =execution_result['message'][0][0]
+                volume['rows'] = impacted_rows
             logging.info(f"Impacted rows after merge : {impacted_rows}")
-            logging.info("Completed successfully")
         else:
             logging.info("No records to load")
-            logging.info("Completed successfully")
-        
-        status='Success'
-        message={f"Impacted rows on  {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{T_ADF_META_ACTIVITY_RUNS}":impacted_rows}
-        output_success = {"status" : status, "status_code":200,"function_name" : function_name , "message" :  message }
+
+        ###Close the claim on the frontier. Skipped runs go back to PENDING as they were.
+        if controller is not None and controller.skipped:
+            logging.warning(f"Pipeline runs released for the next invocation : {len(controller.skipped)}")
+            pending_runids.update(controller.skipped)
+            unpolled_runids.update(controller.skipped)
+        with metrics.stage('frontier_complete'):
+            execution_result = complete_claimed_runs(claim_id,factory_name,pending_runids,polled_ts,unpolled_runids)
+        sql_exec_status_code = execution_result['status_code']
+        if sql_exec_status_code != 200 :
+            logging.error('Exception in complete_claimed_runs. Stopping activity execution.')
+            return execution_result
+        if checkpoint is not None:
+            execution_result = checkpoint.complete()
+            sql_exec_status_code = execution_result['status_code']
+            if sql_exec_status_code != 200 :
+                logging.error('Exception in checkpoint complete. Stopping activity execution.')
+                return execution_result
+        logging.info("Completed successfully")
+
+        output_success = {"status" : 'Success', "status_code":200,"function_name" : function_name , "message" :  impacted_rows }
         return output_success
     except Exception as e:
         error_message = str(e)
@@ -190,98 +351,199 @@ def get_activity_runs(payload):
         return output_error
 
 
+## Durable Functions : plan a round of chunks ##################################################################################
+## Queues new pipeline runs and claims up to max_chunks chunks of chunk_size pipeline runs, one frontier claim per chunk.
+def plan_activity_chunks(payload:dict)->dict:
+    try:
+        function_name = sys._getframe().f_code.co_name
+        chunk_size    = payload.get('chunk_size') or DURABLE_CHUNK_SIZE
+        max_chunks    = payload.get('max_chunks') or DURABLE_MAX_CHUNKS
 
+        execution_result = get_activity_time_window(payload.get('watermark_offset'))
+        if execution_result['status_code'] != 200 :
+            return execution_result
+        previous_time,current_time = execution_result['message']
 
- ## Yeild a single generator with the dictionary of triggers.
-def generate_activity(activity_generator_list:list)->object:
-    for gen in activity_generator_list:
-        for element in gen:
-            yield element
-
-
-def get_activity_detail(adf_client,rg,factory_name,runid:str,previous_time:object,current_time:object)->dict:
-    try:
-        filter_params = RunFilterParameters(last_updated_after=previous_time , last_updated_before=current_time)
-        activity_runs=adf_client.activity_runs.query_by_pipeline_run(rg,factory_name,runid,filter_params)
-
-        for run in activity_runs.value:
-            additional_properties = run.additional_properties
-            pipeline_name = run.pipeline_name
-            pipeline_run_id = run.pipeline_run_id
-            activity_name = run.activity_name
-            activity_type = run.activity_type
-            activity_run_id = run.activity_run_id
-            linked_service_name = run.linked_service_name
-            status = run.status
-            activity_run_start = run.activity_run_start
-            activity_run_end = run.activity_run_end
-            duration_in_ms = run.duration_in_ms
-            input = run.input
-            output = run.output
-            error = run.error
-
-
-            if activity_run_start is not None:
-                activity_run_start=activity_run_start.isoformat()
-            else:
-                activity_run_start='1900-01-01 00:00:00.000'
-            if activity_run_end is not None:
-                activity_run_end=activity_run_end.isoformat()
-            else:
-                activity_run_end='2999-01-01 00:00:00.000'
+        execution_result = enqueue_pending_runs(payload.get('factory_name'))
+        if execution_result['status_code'] != 200 :
+            return execution_result
 
-            derived_duration = convert_to_hhmiss(duration_in_ms)
+        chunks = []
+        while len(chunks) < max_chunks:
+            claim_id = str(uuid.uuid4())
+            execution_result = claim_pending_runs(chunk_size,claim_id,payload.get('factory_name'))
+            if execution_result['status_code'] != 200 :
+                return execution_result
+            if not execution_result['message']:
+                break
+            last_polled = {run_id : polled_ts.isoformat() for run_id,polled_ts in execution_result['last_polled'].items()}
+            chunks.append({"claim_id" : claim_id, "run_ids" : execution_result['message'], "last_polled" : last_polled})
+        logging.info(f"Planned chunks : {len(chunks)}")
+
+        message = {"previous_time" : previous_time.isoformat(), "current_time" : current_time.isoformat(), "chunks" : chunks}
+        output_success = {"status" : 'Success', "status_code":200,"function_name" : function_name , "message" :  message }
+        return output_success
+    except Exception as e:
+        error_message = str(e)
+        function_name = sys._getframe().f_code.co_name
+        output_error = get_exception_message(function_name ,error_message)
+        return output_error
 
-            ## Cleaning the dictionaries by replacing None with 'None' to avoid database failures. None is not
-            ## recognized in Snowflake.
-            dict_str = json.dumps(additional_properties)
-            additional_properties_clean = json.loads(dict_str, object_pairs_hook=dict_clean)
-            if additional_properties_clean=='None' or additional_properties_clean is None:
-                additional_properties_clean={}
 
-            dict_str = json.dumps(input)
-            input_clean = json.loads(dict_str, object_pairs_hook=dict_clean)
-            if input_clean=='None' or input_clean is None:
-                input_clean={}
-            
-            dict_str = json.dumps(output)
-            output_clean = json.loads(dict_str, object_pairs_hook=dict_clean)
-            if output_clean=='None' or output_clean is None:
-                output_clean={}
-
-            dict_str = json.dumps(error)
-            output_error = json.loads(dict_str, object_pairs_hook=dict_clean)
-            if output_error=='None' or output_error is None:
-                output_error={}
-
-            output = {
-
-                'ADDITIONAL_PROPERTIES' : str(additional_properties_clean),
-                'PIPELINE_NAME' : pipeline_name,
-                'PIPELINE_RUN_ID' : pipeline_run_id,
-                'ACTIVITY_NAME' : activity_name   ,
-                'ACTIVITY_TYPE' : activity_type,
-                'ACTIVITY_RUN_ID':activity_run_id,
-                'LINKED_SERVICE_NAME':linked_service_name,
-                'STATUS':status,
-                'ACTIVITY_RUN_START':activity_run_start,
-                'ACTIVITY_RUN_END':activity_run_end,
-                'DURATION_IN_MS':duration_in_ms,
-                'DURATION_HH_MI_SS':derived_duration,
-                'INPUT':str(input_clean),
-                'OUTPUT':str(output_clean),
-                'ERROR':str(error),
-                'ETL_INSERT_TS' : ETL_TIME,
-                'ETL_UPDATE_TS' : ETL_TIME,
-                'ETL_INSERT_ID':ETL_ID,
-                'ETL_UPDATE_ID':ETL_ID
-            
-            }
-            yield output
+## Durable Functions : extract one chunk ########################################################################################
+## Every chunk loads through its own stage table, so chunks of a round can run at the same time.
+def extract_activity_chunk(payload:dict)->dict:
+    try:
+        function_name = sys._getframe().f_code.co_name
+        stage_suffix  = f"{payload.get('factory_name')}_{payload.get('chunk_no')}"
+        execution_result = prepare_stage_table(T_ADF_META_ACTIVITY_RUNS_STG,stage_suffix)
+        if execution_result['status_code'] != 200 :
+            return execution_result
+        stage_table = execution_result['message']
+
+        previous_time = datetime.datetime.fromisoformat(payload.get('previous_time'))
+        current_time  = datetime.datetime.fromisoformat(payload.get('current_time'))
+        last_polled   = {run_id : datetime.datetime.fromisoformat(polled_ts) for run_id,polled_ts in (payload.get('last_polled') or {}).items()}
+        controller    = get_batch_controller(payload)
+        metrics       = StageMetrics()
+        execution_result = load_activity_runs(get_adf_client(),payload.get('resource_group'),payload.get('factory_name'),
+                                              payload.get('claim_id'),payload.get('run_ids'),previous_time,current_time,stage_table,
+                                              payload.get('api_concurrency') or ADF_API_MAX_WORKERS,payload.get('batch_size') or LOAD_BATCH_SIZE,metrics,
+                                              get_response_cache(payload),last_polled,controller)
+        if execution_result['status_code'] != 200 :
+            return execution_result
+        export_metrics(metrics,{'api_name' : 'GetActivityRuns', 'factory_name' : payload.get('factory_name')})
+        execution_result['message'] = {"chunk_no" : payload.get('chunk_no'), "pipeline_runs" : len(payload.get('run_ids')) - len(controller.skipped),
+                                       "impacted_rows" : execution_result['message'], "skipped_runs" : len(controller.skipped)}
+        execution_result['metrics'] = metrics.summary()
+        return execution_result
     except Exception as e:
         error_message = str(e)
         function_name = sys._getframe().f_code.co_name
         output_error = get_exception_message(function_name ,error_message)
-        yield output_error
+        return output_error
 
 
+## Delete the staged activities of run_ids ###################################################################################
+def delete_staged_runs(stage_table:str,run_ids:list)->dict:
+    execution_result = {"status" : 'Success', "status_code":200, "message" : 0}
+    run_ids = list(run_ids)
+    for start in range(0,len(run_ids),FRONTIER_UPDATE_BATCH_SIZE):
+        run_id_batch = run_ids[start:start+FRONTIER_UPDATE_BATCH_SIZE]
+        delete_sql = f'''delete from {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{stage_table}
+                         where PIPELINE_RUN_ID in ({','.join(['%s']*len(run_id_batch))})'''
+        execution_result = execute_snowflake_sql(delete_sql,run_id_batch)
+        if execution_result['status_code'] != 200:
+            return execution_result
+    return execution_result
+
+
+## Pass activity responses through, recording the pipeline runs that must be extracted again : failed fetches (also added
+## to failed_runids) and runs with activities that are still running. Every run passed on is added to processed_runids.
+def track_pending_runs(activity_responses:object,pending_runids:set,metrics:StageMetrics=None,failed_runids:set=None,
+                       processed_runids:set=None)->object:
+    metrics = metrics or StageMetrics()
+    for pp_run_id,activity_runs in activity_responses:
+        if processed_runids is not None:
+            processed_runids.add(pp_run_id)
+        if activity_runs is None:
+            pending_runids.add(pp_run_id)
+            if failed_runids is not None:
+                failed_runids.add(pp_run_id)
+            continue
+        metrics.add_volume('api_fetch',len(activity_runs.value))
+        if any(run.status in NON_TERMINAL_ACTIVITY_STATUSES for run in activity_runs.value):
+            pending_runids.add(pp_run_id)
+        yield activity_runs
+
+
+## Group the activity runs of the responses into DataFrames of at least batch_size rows. A pipeline run is never split, so
+## deduplicating each DataFrame on (PIPELINE_RUN_ID, ACTIVITY_RUN_ID) deduplicates the whole load.
+def generate_activity_frames(activity_responses:object,batch_size:int,metrics:StageMetrics,etl_time:str=None)->object:
+    etl_time = etl_time or get_etl_time()
+    runs = []
+    for activity_runs in activity_responses:
+        runs.extend(activity_runs.value)
+        if len(runs) >= batch_size:
+            yield get_activity_frame(runs,metrics,etl_time)
+            runs = []
+    if runs:
+        yield get_activity_frame(runs,metrics,etl_time)
+
+
+## Start of the filter window of a pipeline run : its last poll less AME_FRONTIER_POLL_OVERLAP_MINUTES, which covers
+## activities that ADF reports with some delay, or previous_time for a run that was never polled.
+def get_poll_start(previous_time:object,last_polled_ts:object)->object:
+    if last_polled_ts is None:
+        return previous_time
+    return last_polled_ts.replace(tzinfo=datetime.timezone.utc) - timedelta(minutes=FRONTIER_POLL_OVERLAP_MINUTES)
+
+
+## Query the activity runs of a single pipeline run. A long pipeline run has more activity runs than one response holds :
+## the continuation token is followed (one rate limited call per page) and the pages are returned as one response, so the
+## terminal state of the run is decided on all its activities. With a cache, the response is stored, permanently when the
+## pipeline run is completed and none of its activities is still running.
+def fetch_activity_runs(adf_client,rg,factory_name,runid:str,previous_time:object,current_time:object,
+                        cache:ResponseCache=None,pipeline_completed:bool=False,metrics:StageMetrics=None)->object:
+    filter_params = RunFilterParameters(last_updated_after=previous_time , last_updated_before=current_time)
+    activity_runs = adf_client.activity_runs.query_by_pipeline_run(rg,factory_name,runid,filter_params)
+    if activity_runs.continuation_token:
+        runs = list(activity_runs.value)
+        while activity_runs.continuation_token:
+            filter_params.continuation_token = activity_runs.continuation_token
+            activity_runs = call_with_backoff(adf_client.activity_runs.query_by_pipeline_run,rg,factory_name,runid,filter_params,metrics=metrics)
+            runs.extend(activity_runs.value)
+        activity_runs = ActivityRunsQueryResponse(value=runs)
+    if cache is not None:
+        permanent = pipeline_completed and not any(run.status in NON_TERMINAL_ACTIVITY_STATUSES for run in activity_runs.value)
+        cache.put(ResponseCache.key(get_factory_resource_id(rg,factory_name),'GetActivityRuns',runid),activity_runs.serialize(keep_readonly=True),permanent)
+    return activity_runs
+
+
+## Cached activity runs of a pipeline run, or None. Permanent entries are served whatever the filter window of the request.
+def get_cached_activity_runs(cache:ResponseCache,rg:str,factory_name:str,runid:str,metrics:StageMetrics=None,cached_runids:set=None)->object:
+    cached = cache.get(ResponseCache.key(get_factory_resource_id(rg,factory_name),'GetActivityRuns',runid))
+    if cached is None or cached.get('continuationToken'):   # Entries holding the first page only are fetched again.
+        return None
+    if metrics is not None:
+        metrics.increment('cache_hits')
+    if cached_runids is not None:
+        cached_runids.add(runid)
+    return ActivityRunsQueryResponse.deserialize(cached)
+
+
+## Transform activity runs into a DataFrame with the columns of T_ADF_META_ACTIVITY_RUNS. ###############################
+## Raw attributes are gathered into column lists; durations, sentinel timestamps and ETL audit columns are computed per column.
+def get_activity_frame(runs:list,metrics:StageMetrics=None,etl_time:str=None)->object:
+    metrics  = metrics or StageMetrics()
+    etl_time = etl_time or get_etl_time()
+    with metrics.stage('transform') as volume:
+        duration_in_ms = [run.duration_in_ms for run in runs]
+        columns = {
+            ## Dictionaries are cleaned by replacing None with 'None' to avoid database failures (None is not recognized in
+            ## Snowflake) and serialized as JSON so Snowflake can parse them.
+            'ADDITIONAL_PROPERTIES' : [to_json_column(run.additional_properties) for run in runs],
+            'PIPELINE_NAME'         : [run.pipeline_name for run in runs],
+            'PIPELINE_RUN_ID'       : [run.pipeline_run_id for run in runs],
+            'ACTIVITY_NAME'         : [run.activity_name for run in runs],
+            'ACTIVITY_TYPE'         : [run.activity_type for run in runs],
+            'ACTIVITY_RUN_ID'       : [run.activity_run_id for run in runs],
+            'LINKED_SERVICE_NAME'   : [run.linked_service_name for run in runs],
+            'STATUS'                : [run.status for run in runs],
+            'ACTIVITY_RUN_START'    : to_timestamp_column([run.activity_run_start for run in runs],'1900-01-01 00:00:00.000'),
+            'ACTIVITY_RUN_END'      : to_timestamp_column([run.activity_run_end for run in runs],'2999-01-01 00:00:00.000'),
+            'DURATION_IN_MS'        : duration_in_ms,
+            'DURATION_HH_MI_SS'     : convert_to_hhmiss_column(duration_in_ms),
+            'INPUT'                 : [to_json_column(run.input) for run in runs],
+            'OUTPUT'                : [to_json_column(run.output) for run in runs],
+            'ERROR'                 : [to_json_column(run.error) for run in runs],
+        }
+        df = pandas.DataFrame(columns)
+        df['ETL_INSERT_TS'] = etl_time
+        df['ETL_UPDATE_TS'] = etl_time
+        df['ETL_INSERT_ID'] = ETL_ID
+        df['ETL_UPDATE_ID'] = ETL_ID
+        ### The latest row of an activity run wins.
+        df = df_dedup(df,KEY_COLUMNS_T_ADF_META_ACTIVITY_RUNS,keep='last')
+        volume['rows'] = len(df)
+    return df[COLUMNS_T_ADF_META_ACTIVITY_RUNS]
@@ -13,11 +13,18 @@ Last updated by : Thomas Mathew.
 
 import sys
 import json
+import itertools
 import pandas
 import logging
 from .common_functions import get_adf_client
 from .common_variables import *
-from .common_functions import execute_snowflake_sql,get_adf_client,write_to_snowflake,get_exception_message,df_dedup
+from .common_functions import execute_snowflake_sql,get_adf_client,prepare_stage_table,spool_to_snowflake,get_exception_message,df_dedup
+from .common_functions import stream_snowflake_sql,replace_snapshot_table,get_factory_resource_id
+from .parquet_spool import rows_to_arrow
+from .adf_api import generate_factory_pages,get_batch_controller
+from .instrumentation import StageMetrics,timed_iter,export_metrics
+from .response_cache import get_response_cache
+from .checkpoint import ExtractCheckpoint,generate_checkpointed,get_checkpoint
 
 
 
@@ -27,85 +34,312 @@ def get_datasets(payload:dict)->dict:
     try : 
         function_name = sys._getframe().f_code.co_name
         logging.info(f"Inside {function_name}")
+        controller    = get_batch_controller(payload)  # The time budget starts with the invocation.
 
         factory_name = payload.get('factory_name')
         rg           = payload.get('resource_group')
         api_limit    = payload.get('api_limit')
+        batch_size   = payload.get('batch_size')
+        load_mode    = payload.get('load_mode')     # 'full' (default) or 'incremental'
     
 
-        dsobjlist = []
         default_api_limit = 500
-        page_count = 1
         status = 'Success'
 
         if api_limit is None:
             api_limit = default_api_limit
+        if batch_size is None:
+            batch_size = LOAD_BATCH_SIZE
    
         adf_client   = get_adf_client()
+        metrics      = StageMetrics()
 
-        dsobj           = adf_client.datasets.list_by_factory(rg,factory_name)._get_next()
-        dsobj_json      = dsobj.json()
-        nextLink        = dsobj_json['nextLink'] # For pagination
-        dsvalue         = dsobj_json['value']
-        dsobjlist.append(dsvalue)  # Get first element
-        
-        
-
-        logging.info("Invoking ADF Datasets API..") # Paginate
-        while 'nextLink' in dsobj_json and page_count < api_limit:
-            dsobj = adf_client.datasets.list_by_factory(rg,factory_name)._get_next(nextLink)
-            dsobj_json=dsobj.json()
-            dsvalue=dsobj_json['value']
-            dsobjlist.append(dsvalue)
-            if 'nextLink' in dsobj_json:
-                nextLink=dsobj_json['nextLink']
-            page_count+=1
-        logging.info(f"Total pages scanned : {page_count}")
-
-        gen_ds_list = parse_ds_object(dsobjlist)
-
-        # Create pandas dataframe
-        df = pandas.DataFrame(data = gen_ds_list, columns = COLUMNS_T_ADF_META_DATASETS)
-        #df = df_dedup(df)
-        ### Truncate
-        sql = f"TRUNCATE TABLE {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{T_ADF_META_DATASETS}"
-        execution_result = execute_snowflake_sql(sql)
+        ### Both load modes stage the listing first : the target table is only written once the whole listing is staged.
+        execution_result = prepare_stage_table(T_ADF_META_DATASETS_STG,payload.get('stage_suffix'))
         sql_exec_status_code = execution_result['status_code']
         if sql_exec_status_code != 200 :
-            logging.error('Exception in execute_snowflake_sql. Stopping activity execution.')
+            logging.error('Exception in prepare_stage_table. Stopping activity execution.')
             return execution_result
-        max_date_obj = execution_result['message']
+        stage_table = execution_result['message']
 
-        ### Load
-        impacted_rows = write_to_snowflake(df,T_ADF_META_DATASETS)
-
-        ### Update
-        sql = f"update {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{T_ADF_META_DATASETS} set PROPERTIES=parse_json(PROPERTIES)"
-        execution_result = execute_snowflake_sql(sql)
+        ### A listing interrupted by the timeout, the time budget or api_limit resumes from its checkpoint.
+        execution_result = get_checkpoint(payload,'GetDatasets',stage_table,load_mode or 'full')
         sql_exec_status_code = execution_result['status_code']
         if sql_exec_status_code != 200 :
-            logging.error('Exception in execute_snowflake_sql. Stopping activity execution.')
+            logging.error('Exception in get_checkpoint. Stopping activity execution.')
             return execution_result
+        checkpoint    = execution_result['message']
+        resumed       = checkpoint is not None and checkpoint.resumed
+        progress      = checkpoint.progress if resumed else {}
+        page_progress = {'pages' : progress.get('pages',0), 'next_link' : progress.get('next_link'), 'scan_complete' : progress.get('scan_complete',False)}
 
-        logging.info("Pipeline Runs load complete")
-        logging.info('Clossing the connection..')
+        logging.info("Invoking ADF Datasets API..") # Paginate. Pages are prefetched while earlier pages are parsed and loaded.
+        ### Cached pages are not served to the incremental load : a stale page would soft delete or miss changed datasets.
+        cache      = get_response_cache(payload) if load_mode != 'incremental' else None
+        page_state = {'pages' : page_progress['pages'], 'complete' : page_progress['scan_complete']}
+        if page_progress['scan_complete']:
+            dsobjlist = iter(())    # Every page is staged already, only the load is left.
+        else:
+            dsobjlist = generate_factory_pages(adf_client.datasets.list_by_factory,rg,factory_name,api_limit,page_state=page_state,metrics=metrics,
+                                               cache=cache,api_name='GetDatasets',controller=controller,
+                                               resume_link=page_progress['next_link'],resume_pages=page_progress['pages'],with_links=True)
+        first_page = next(dsobjlist,None) # Fail before the truncate if the API cannot be reached.
+        pages      = itertools.chain([first_page],dsobjlist) if first_page is not None else dsobjlist
+
+        if not resumed:
+            sql = f"TRUNCATE TABLE {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{stage_table}"
+            with metrics.stage('truncate'):
+                execution_result = execute_snowflake_sql(sql)
+            sql_exec_status_code = execution_result['status_code']
+            if sql_exec_status_code != 200 :
+                logging.error('Exception in execute_snowflake_sql. Stopping activity execution.')
+                return execution_result
+            if checkpoint is not None:
+                execution_result = checkpoint.begin()
+                sql_exec_status_code = execution_result['status_code']
+                if sql_exec_status_code != 200 :
+                    logging.error('Exception in checkpoint begin. Stopping activity execution.')
+                    return execution_result
+
+        ### Pages are transformed one at a time, so the transform stage does not include the wait for the next page.
+        etl_time   = get_etl_time()
+        parse_page = lambda page : list(timed_iter(parse_ds_object([page],etl_time),metrics,'transform'))
 
-        adf_client.close()
+        if load_mode == 'incremental':
+            execution_result = load_ds_incremental(pages,parse_page,rg,factory_name,page_state,page_progress,batch_size,stage_table,metrics,checkpoint)
+            sql_exec_status_code = execution_result['status_code']
+            if sql_exec_status_code != 200 :
+                logging.error('Exception in load_ds_incremental. Stopping activity execution.')
+                return execution_result
+            impacted_rows = execution_result['message']
+        else:
+            execution_result = load_ds_full(pages,parse_page,page_progress,batch_size,stage_table,metrics,checkpoint)
+            sql_exec_status_code = execution_result['status_code']
+            if sql_exec_status_code not in (200,206) :
+                logging.error('Exception in load_ds_full. Stopping activity execution.')
+                return execution_result
+            impacted_rows = execution_result['message']
+
+        logging.info("Pipeline Runs load complete")
         message = f"Impacted rows on {T_ADF_META_DATASETS} : {impacted_rows}"
-        output_success = {"status" : status, "status_code":200,"function_name" : function_name , "message" :  message }
+        ### A scan stopped by the time budget or api_limit is incomplete (206, Partial) : with a checkpoint the next invocation
+        ### resumes it, and the table is only replaced (full) or soft deleted from (incremental) once it completes.
+        backlog = {'stopped_early' : controller.stopped, 'pages' : page_state['pages'], 'scan_complete' : page_state['complete'],
+                   'checkpoint' : checkpoint.summary() if checkpoint is not None else None}
+        status      = status if page_state['complete'] else 'Partial'
+        status_code = 200 if page_state['complete'] else 206
+        export_metrics(metrics,{'api_name' : 'GetDatasets', 'factory_name' : factory_name})
+        output_success = {"status" : status, "status_code":status_code,"function_name" : function_name , "message" :  message ,
+                          "backlog" : backlog, "metrics" : metrics.summary() }
         return output_success
-    
+
     except Exception as e:
         error_message   = str(e)
         function_name   = sys._getframe().f_code.co_name
         output_error    = get_exception_message(function_name ,error_message)
         return output_error
-## END 
+## END
+
+## Stage the datasets of the pages ########################################################################################
+## Batches end on page boundaries, so the checkpoint saved with a flush always resumes on the page after the last staged one.
+def stage_ds_pages(pages:object,parse_page,page_progress:dict,batch_size:int,stage_table:str,metrics:StageMetrics,
+                   checkpoint:ExtractCheckpoint=None)->dict:
+    batches = generate_page_batches(pages,parse_page,batch_size,page_progress)
+    if checkpoint is not None:
+        batches = generate_checkpointed(batches,checkpoint,lambda : dict(page_progress))
+    return spool_to_snowflake(batches,lambda batch : rows_to_arrow(batch,COLUMNS_T_ADF_META_DATASETS),stage_table,
+                              VARIANT_COLUMNS_T_ADF_META_DATASETS,metrics,checkpoint)
+
+## Group the rows of whole pages ((page, nextLink) tuples) into batches of at least batch_size rows. page_progress is moved
+## past each page as its rows are batched.
+def generate_page_batches(pages:object,parse_page,batch_size:int,page_progress:dict)->list:
+    batch = []
+    for page,next_link in pages:
+        batch.extend(parse_page(page))
+        page_progress.update({'pages' : page_progress['pages']+1, 'next_link' : next_link, 'scan_complete' : next_link is None})
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+## Staged datasets, one row per ID : the pages of a flush whose checkpoint was not saved are staged again on resume.
+def get_staged_ds_sql(stage_table:str)->str:
+    return f"""select {','.join(COLUMNS_T_ADF_META_DATASETS)} from {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{stage_table}
+               qualify row_number() over (partition by ID order by ETL_UPDATE_TS desc) = 1"""
 
-# Transformation Logic
-def parse_ds_object(ds_obj_list:list)->dict:
+## Full load ###############################################################################################################
+## The staged listing replaces the table once every page is staged, swapped in as a whole (replace_snapshot_table). An
+## incomplete listing is never swapped in, as it would drop every unlisted dataset : the table is left as it is and the
+## result is Partial (206). With a checkpoint the next invocation resumes the listing, without one it starts over.
+def load_ds_full(pages:object,parse_page,page_progress:dict,batch_size:int,stage_table:str=T_ADF_META_DATASETS_STG,
+                 metrics:StageMetrics=None,checkpoint:ExtractCheckpoint=None)->dict:
     try:
-        for i in ds_obj_list:
+        function_name = sys._getframe().f_code.co_name
+        logging.info(f"Inside {function_name}")
+        metrics = metrics or StageMetrics()
+
+        ### Stage. Pages are fetched while earlier batches are written to the stage table. PROPERTIES is parsed into VARIANT by the load.
+        execution_result = stage_ds_pages(pages,parse_page,page_progress,batch_size,stage_table,metrics,checkpoint)
+        sql_exec_status_code = execution_result['status_code']
+        if sql_exec_status_code != 200 :
+            logging.error('Exception in stage_ds_pages. Stopping activity execution.')
+            return execution_result
+        logging.info(f"Datasets staged : {execution_result['message']} | Pages : {page_progress['pages']}")
+
+        if not page_progress['scan_complete']:
+            kept = 'kept for the next invocation' if checkpoint is not None else 'not loaded. Raise api_limit or time_budget_seconds'
+            logging.warning(f"Listing stopped after {page_progress['pages']} pages. {T_ADF_META_DATASETS} is not replaced; staged datasets are {kept}.")
+            output_partial = {"status" : 'Partial', "status_code":206,"function_name" : function_name , "message" :  0 }
+            return output_partial
+
+        ### Replace
+        with metrics.stage('replace') as volume:
+            execution_result = replace_snapshot_table(T_ADF_META_DATASETS,COLUMNS_T_ADF_META_DATASETS,get_staged_ds_sql(stage_table),metrics)
+            sql_exec_status_code = execution_result['status_code']
+            if sql_exec_status_code != 200 :
+                logging.error('Exception in replace_snapshot_table. Stopping activity execution.')
+                return execution_result
+            loaded_rows = execution_result['message']
+            volume['rows'] = loaded_rows
+
+        if checkpoint is not None:
+            execution_result = checkpoint.complete()
+            sql_exec_status_code = execution_result['status_code']
+            if sql_exec_status_code != 200 :
+                logging.error('Exception in checkpoint complete. Stopping activity execution.')
+                return execution_result
+
+        output_success = {"status" : 'Success', "status_code":200,"function_name" : function_name , "message" :  loaded_rows }
+        return output_success
+
+    except Exception as e:
+        error_message   = str(e)
+        function_name   = sys._getframe().f_code.co_name
+        output_error    = get_exception_message(function_name ,error_message)
+        return output_error
+
+## Incremental load ########################################################################################################
+## Only datasets whose ETAG differs from the stored one are staged and merged. Datasets missing from a complete scan of
+## the factory are soft deleted (IS_DELETED = TRUE). Soft deletes are skipped when the scan stopped at api_limit, and when
+## it was resumed from a checkpoint since the datasets seen by earlier invocations are not known. With a checkpoint, the
+## changed datasets of an incomplete scan stay staged and are merged once the scan completes.
+def load_ds_incremental(pages:object,parse_page,rg:str,factory_name:str,page_state:dict,page_progress:dict,batch_size:int,
+                        stage_table:str=T_ADF_META_DATASETS_STG,metrics:StageMetrics=None,checkpoint:ExtractCheckpoint=None)->dict:
+    try:
+        function_name = sys._getframe().f_code.co_name
+        logging.info(f"Inside {function_name}")
+        metrics = metrics or StageMetrics()
+
+        ### Stored ETAGs of the factory. Soft deleted datasets have no ETAG so that they are reloaded if they come back.
+        ### They are fetched in batches straight into the lookup, as large factories hold many datasets.
+        ### The factory is matched on its full resource ID (no wildcards, case insensitive as Azure resource IDs), so that
+        ### same-named factories of other resource groups or subscriptions are not taken for this one.
+        factory_prefix = get_factory_resource_id(rg,factory_name).lower() + '/'
+        sql = f"select ID, iff(IS_DELETED, null, ETAG) from {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{T_ADF_META_DATASETS} where startswith(lower(ID),%s)"
+        with metrics.stage('etag_lookup') as volume:
+            stored_etags = dict(stream_snowflake_sql(sql,(factory_prefix,),metrics=metrics,label='etag_lookup'))
+            volume['rows'] = len(stored_etags)
+        logging.info(f"Stored datasets : {len(stored_etags)}")
+
+        ### Stage the new and changed datasets
+        seen_ids = set()
+        parse_changed_page = lambda page : list(filter_changed_ds(parse_page(page),stored_etags,seen_ids))
+        execution_result = stage_ds_pages(pages,parse_changed_page,page_progress,batch_size,stage_table,metrics,checkpoint)
+        sql_exec_status_code = execution_result['status_code']
+        if sql_exec_status_code != 200 :
+            logging.error('Exception in stage_ds_pages. Stopping activity execution.')
+            return execution_result
+        changed_rows = checkpoint.staged_rows if checkpoint is not None else execution_result['message']
+        logging.info(f"Datasets scanned : {len(seen_ids)} | New or changed : {changed_rows}")
+
+        if not page_progress['scan_complete'] and checkpoint is not None:
+            logging.warning(f"Scan stopped after {page_progress['pages']} pages. Changed datasets are kept for the next invocation.")
+            output_success = {"status" : 'Success', "status_code":200,"function_name" : function_name , "message" :  {"merged" : 0, "soft_deleted" : 0} }
+            return output_success
+
+        ### Merge
+        merged_rows = 0
+        if changed_rows != 0:
+            merge_sql = f'''
+                MERGE into {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{T_ADF_META_DATASETS}            tgt
+                USING ( {get_staged_ds_sql(stage_table)} )            src
+                ON tgt.ID = src.ID
+
+                WHEN  matched THEN UPDATE SET
+                tgt.NAME=src.NAME,
+                tgt.TYPE=src.TYPE,
+                tgt.PROPERTIES=src.PROPERTIES,
+                tgt.ETAG=src.ETAG,
+                tgt.IS_DELETED=FALSE,
+                tgt.ETL_UPDATE_TS=to_timestamp_ntz(convert_timezone('UTC', current_timestamp())),
+                tgt.ETL_UPDATE_ID=src.ETL_UPDATE_ID
+
+                WHEN NOT matched THEN INSERT (ID,NAME,TYPE,PROPERTIES,ETAG,ETL_INSERT_TS,ETL_UPDATE_TS,ETL_INSERT_ID,ETL_UPDATE_ID,IS_DELETED)
+                VALUES(src.ID,src.NAME,src.TYPE,src.PROPERTIES,src.ETAG,src.ETL_INSERT_TS,src.ETL_UPDATE_TS,src.ETL_INSERT_ID,src.ETL_UPDATE_ID,FALSE)
+            '''
+            with metrics.stage('merge') as volume:
+                execution_result = execute_snowflake_sql(merge_sql)
+                sql_exec_status_code = execution_result['status_code']
+                if sql_exec_status_code != 200 :
+                    logging.error('Exception in execute_snowflake_sql. Stopping activity execution.')
+                    return execution_result
+                merged_rows = sum(execution_result['message'][0]) # rows inserted + rows updated
+                volume['rows'] = merged_rows
+
+        ### Soft delete
+        deleted_ids = []
+        if checkpoint is not None and checkpoint.resumed:
+            logging.warning("Scan resumed from a checkpoint. Skipping soft delete.")
+        elif page_state.get('complete'):
+            deleted_ids = [id for id,etag in stored_etags.items() if etag is not None and id not in seen_ids]
+        else:
+            logging.warning(f"Scan stopped after {page_state.get('pages')} pages (api_limit). Skipping soft delete.")
+        for start in range(0,len(deleted_ids),SOFT_DELETE_BATCH_SIZE):
+            id_batch = deleted_ids[start:start+SOFT_DELETE_BATCH_SIZE]
+            sql = f'''update {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{T_ADF_META_DATASETS}
+                      set IS_DELETED=TRUE, ETL_UPDATE_TS=to_timestamp_ntz(convert_timezone('UTC', current_timestamp())), ETL_UPDATE_ID=%s
+                      where ID in ({','.join(['%s']*len(id_batch))})'''
+            with metrics.stage('soft_delete') as volume:
+                execution_result = execute_snowflake_sql(sql,[ETL_ID]+id_batch)
+                volume['rows'] = len(id_batch)
+            sql_exec_status_code = execution_result['status_code']
+            if sql_exec_status_code != 200 :
+                logging.error('Exception in execute_snowflake_sql. Stopping activity execution.')
+                return execution_result
+        logging.info(f"Soft deleted datasets : {len(deleted_ids)}")
+
+        if checkpoint is not None:
+            execution_result = checkpoint.complete()
+            sql_exec_status_code = execution_result['status_code']
+            if sql_exec_status_code != 200 :
+                logging.error('Exception in checkpoint complete. Stopping activity execution.')
+                return execution_result
+
+        message = {"merged" : merged_rows, "soft_deleted" : len(deleted_ids)}
+        output_success = {"status" : 'Success', "status_code":200,"function_name" : function_name , "message" :  message }
+        return output_success
+
+    except Exception as e:
+        error_message   = str(e)
+        function_name   = sys._getframe().f_code.co_name
+        output_error    = get_exception_message(function_name ,error_message)
+        return output_error
+
+## Yield the datasets whose ETAG is not the stored one, recording every scanned dataset ID in seen_ids.
+def filter_changed_ds(gen_ds_list:object,stored_etags:dict,seen_ids:set)->dict:
+    for row in gen_ds_list:
+        if row.get('ID') is None:   # Transformation errors are logged by parse_ds_object.
+            continue
+        seen_ids.add(row['ID'])
+        if stored_etags.get(row['ID']) != row['ETAG']:
+            yield row
+
+# Transformation Logic. Pagination errors are raised to the loader, so a failed page is never loaded as a row.
+def parse_ds_object(ds_obj_list:list,etl_time:str=None)->dict:
+    etl_time = etl_time or get_etl_time()
+    for i in ds_obj_list:
+        try:
             for j in i:
                 id            = j['id']
                 name          = j['name']
@@ -118,15 +352,15 @@ def parse_ds_object(ds_obj_list:list)->dict:
                                 'TYPE'      :type,
                                 'PROPERTIES':properties,
                                 'ETAG'      :etag,
-                                'ETL_INSERT_TS' : ETL_TIME,
-                                'ETL_UPDATE_TS' : ETL_TIME,
+                                'ETL_INSERT_TS' : etl_time,
+                                'ETL_UPDATE_TS' : etl_time,
                                 'ETL_INSERT_ID' :ETL_ID,
                                 'ETL_UPDATE_ID' :ETL_ID
                             }
                 yield output
 
-    except Exception as e:
-        error_message = str(e)
-        function_name = sys._getframe().f_code.co_name
-        output_error = get_exception_message(function_name ,error_message)
-        yield output_error
\ No newline at end of file
+        except Exception as e:
+            error_message = str(e)
+            function_name = sys._getframe().f_code.co_name
+            output_error = get_exception_message(function_name ,error_message)
+            yield output_error
@@ -0,0 +1,97 @@
+'''
+#   ^           _
+#  /_\  |\  /| |_
+# /   \ | \/ | |_
+#
+
+Function        : get_trigger_runs
+Description     : Get trigger runs data from the Trigger Runs API (query_by_factory) and load to Snowflake. The filter window is
+                  split into concurrently queried sub-windows (run_windows), so multi-day backfills are not read page by page.
+Deployment      : Terraform
+'''
+import sys
+import pandas
+import logging
+from .common_variables import *
+from .common_functions import get_adf_client,prepare_stage_table,get_exception_message,get_merge_sql
+from .common_functions import to_timestamp_column,to_json_column
+from .run_windows import get_run_time_window,load_windowed_runs
+from .instrumentation import StageMetrics,export_metrics
+
+### Entry point.
+def get_trigger_runs(payload:dict)->dict:
+    try:
+        function_name = sys._getframe().f_code.co_name
+        logging.info(f"Inside {function_name}")
+        default_api_limit = 999  ### ADF Limit is 1000 / min
+
+        factory_name     = payload.get('factory_name')
+        rg               = payload.get('resource_group')
+        api_limit        = payload.get('api_limit') or default_api_limit
+        api_concurrency  = payload.get('api_concurrency') or ADF_API_MAX_WORKERS
+        batch_size       = payload.get('batch_size') or LOAD_BATCH_SIZE
+        watermark_offset = payload.get('watermark_offset')
+
+        execution_result = prepare_stage_table(T_ADF_META_TRIGGER_RUNS_STG,payload.get('stage_suffix'))
+        if execution_result['status_code'] != 200 :
+            logging.error('Exception in prepare_stage_table. Stopping trigger runs execution.')
+            return execution_result
+        stage_table = execution_result['message']
+
+        execution_result = get_run_time_window(T_ADF_META_TRIGGER_RUNS,'GetTriggerRuns',factory_name,watermark_offset)
+        if execution_result['status_code'] != 200 :
+            logging.error('Exception in get_run_time_window. Stopping trigger runs execution.')
+            return execution_result
+        previous_time,current_time = execution_result['message']
+
+        adf_client = get_adf_client()
+        metrics    = StageMetrics()
+        query_by_factory = lambda filter_params : adf_client.trigger_runs.query_by_factory(rg,factory_name,filter_params)
+        merge_sql = get_merge_sql(T_ADF_META_TRIGGER_RUNS,stage_table,KEY_COLUMNS_T_ADF_META_TRIGGER_RUNS,COLUMNS_T_ADF_META_TRIGGER_RUNS,
+                                  change_columns=['STATUS','TRIGGERED_PIPELINES','DEPENDENCY_STATUS','FACTORY_NAME'])
+        to_frame  = lambda runs,metrics,etl_time : get_trigger_run_frame(runs,metrics,etl_time,factory_name)
+        execution_result = load_windowed_runs(query_by_factory,previous_time,current_time,stage_table,'trigger_run_id',to_frame,
+                                              VARIANT_COLUMNS_T_ADF_META_TRIGGER_RUNS,merge_sql,api_concurrency,api_limit,batch_size,metrics,
+                                              'GetTriggerRuns',factory_name)
+        if execution_result['status_code'] not in (200,206) :
+            return execution_result
+
+        ### 206 (Partial) : api_limit stopped the scan. The runs read are merged and the next invocation continues from the watermark.
+        message = {f"Impacted rows on  {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{T_ADF_META_TRIGGER_RUNS}" : execution_result['message']['impacted_rows']}
+        export_metrics(metrics,{'api_name' : 'GetTriggerRuns', 'factory_name' : factory_name})
+        output_success = {"status" : execution_result['status'], "status_code":execution_result['status_code'],"function_name" : function_name ,
+                          "message" :  message , "windows" : execution_result['message']['windows'], "metrics" : metrics.summary() }
+        return output_success
+    except Exception as e:
+        error_message = str(e)
+        function_name = sys._getframe().f_code.co_name
+        output_error = get_exception_message(function_name ,error_message)
+        return output_error
+
+
+## Transform trigger runs into a DataFrame with the columns of T_ADF_META_TRIGGER_RUNS. ###################################
+## FACTORY_NAME scopes the watermark fallback of the filter window to the factory (run_windows).
+def get_trigger_run_frame(runs:list,metrics:StageMetrics=None,etl_time:str=None,factory_name:str=None)->object:
+    metrics  = metrics or StageMetrics()
+    etl_time = etl_time or get_etl_time()
+    with metrics.stage('transform') as volume:
+        columns = {
+            'ADDITIONAL_PROPERTIES' : [to_json_column(run.additional_properties) for run in runs],
+            'TRIGGER_RUN_ID'        : [run.trigger_run_id for run in runs],
+            'TRIGGER_NAME'          : [run.trigger_name for run in runs],
+            'TRIGGER_TYPE'          : [run.trigger_type for run in runs],
+            'TRIGGER_RUN_TIMESTAMP' : to_timestamp_column([run.trigger_run_timestamp for run in runs],'1900-01-01 00:00:00.000'),
+            'STATUS'                : [run.status for run in runs],
+            'PROPERTIES'            : [to_json_column(run.properties) for run in runs],
+            'TRIGGERED_PIPELINES'   : [to_json_column(run.triggered_pipelines) for run in runs],
+            'RUN_DIMENSION'         : [to_json_column(run.run_dimension) for run in runs],
+            'DEPENDENCY_STATUS'     : [to_json_column(run.dependency_status) for run in runs],
+        }
+        df = pandas.DataFrame(columns)
+        df['ETL_INSERT_TS'] = etl_time
+        df['ETL_UPDATE_TS'] = etl_time
+        df['ETL_INSERT_ID'] = ETL_ID
+        df['ETL_UPDATE_ID'] = ETL_ID
+        df['FACTORY_NAME']  = factory_name
+        volume['rows'] = len(df)
+    return df[COLUMNS_T_ADF_META_TRIGGER_RUNS]
@@ -0,0 +1,158 @@
+'''
+#   ^           _
+#  /_\  |\  /| |_
+# /   \ | \/ | |_
+#
+
+Name : instrumentation
+Desc : Stage timings and counters of one extraction. An extractor creates a StageMetrics and passes it to the functions it
+       calls, which record the API fetch, transform, Arrow build, spool, truncate, load and merge stages, and the query ID and
+       duration of Snowflake statements. The summary is returned in the output_success payload (key "metrics") and exported
+       as Application Insights custom metrics when APPLICATIONINSIGHTS_CONNECTION_STRING is set (opentelemetry-api and
+       azure-monitor-opentelemetry are in requirements.txt; the exporter is configured on the first export of the worker).
+Deployment      : Terraform
+Functions    : 1.  StageMetrics    | Thread safe duration histograms, rows and bytes per stage, and counters.
+               2.  timed_iter      | Pass the items of an iterator through, timing the time spent producing them as a stage.
+               3.  export_metrics  | Send the metrics of an extraction to Application Insights. No-op when OpenTelemetry is not installed.
+'''
+import os
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+try:
+    from opentelemetry import metrics as otel_metrics # Optional. Custom metrics export to Application Insights.
+except ImportError:
+    otel_metrics = None
+
+## Upper bounds (ms) of the duration histogram buckets.
+DURATION_BUCKETS_MS = [10,50,100,500,1000,5000,10000,60000]
+
+
+class StageMetrics:
+
+    def __init__(self):
+        self.started   = time.perf_counter()
+        self.durations = {}     # stage -> list of durations (ms)
+        self.rows      = {}
+        self.bytes     = {}
+        self.counters  = {}
+        self.statements = []    # Snowflake statements : label, query ID, duration and rows
+        self._lock     = threading.Lock()
+
+    ## Record one execution of a stage #########################################################################################
+    def record(self,stage:str,seconds:float,rows:int=0,bytes:int=0):
+        with self._lock:
+            self.durations.setdefault(stage,[]).append(seconds*1000)
+            self.rows[stage]  = self.rows.get(stage,0) + rows
+            self.bytes[stage] = self.bytes.get(stage,0) + bytes
+
+    ## Rows and bytes of a stage whose duration is recorded elsewhere
+    def add_volume(self,stage:str,rows:int=0,bytes:int=0):
+        with self._lock:
+            self.rows[stage]  = self.rows.get(stage,0) + rows
+            self.bytes[stage] = self.bytes.get(stage,0) + bytes
+
+    ## Record one Snowflake statement with its query ID
+    def add_statement(self,label:str,query_id:str,seconds:float,rows:int=0):
+        with self._lock:
+            self.statements.append({'label' : label, 'query_id' : query_id, 'duration_ms' : round(seconds*1000,1), 'rows' : rows})
+
+    def increment(self,counter:str,value:int=1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter,0) + value
+
+    ## Time the enclosed block as one execution of a stage. Rows and bytes can be set on the yielded dict. ####################
+    @contextmanager
+    def stage(self,stage:str):
+        volume  = {'rows' : 0, 'bytes' : 0}
+        started = time.perf_counter()
+        try:
+            yield volume
+        finally:
+            self.record(stage,time.perf_counter() - started,volume['rows'],volume['bytes'])
+
+    ## count, total, min, max, p50, p95 and histogram of the durations, rows and bytes of every stage, and the counters ######
+    def summary(self)->dict:
+        bucket_names = [f"<={bound}" for bound in DURATION_BUCKETS_MS] + [f">{DURATION_BUCKETS_MS[-1]}"]
+        with self._lock:
+            stages = {}
+            for stage,durations in self.durations.items():
+                ordered   = sorted(durations)
+                histogram = [0]*(len(DURATION_BUCKETS_MS)+1)
+                for duration in ordered:
+                    histogram[bisect.bisect_left(DURATION_BUCKETS_MS,duration)] += 1
+                stages[stage] = {
+                    'count'    : len(ordered),
+                    'total_ms' : round(sum(ordered),1),
+                    'min_ms'   : round(ordered[0],1),
+                    'max_ms'   : round(ordered[-1],1),
+                    'p50_ms'   : round(ordered[int(0.50*(len(ordered)-1))],1),
+                    'p95_ms'   : round(ordered[int(0.95*(len(ordered)-1))],1),
+                    'rows'     : self.rows[stage],
+                    'bytes'    : self.bytes[stage],
+                    'histogram_ms' : dict(zip(bucket_names,histogram))
+                }
+            return {'elapsed_ms' : round((time.perf_counter() - self.started)*1000,1), 'stages' : stages, 'counters' : dict(self.counters),
+                    'statements' : list(self.statements)}
+
+
+## Pass items through, recording the time spent inside the iterator (and the item count as rows) as one stage execution. ###
+## Wrap the innermost generator of a stage, so that the time spent by the consumer of the items is not counted.
+def timed_iter(items:object,metrics:StageMetrics,stage:str)->object:
+    iterator = iter(items)
+    seconds  = 0.0
+    rows     = 0
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                seconds += time.perf_counter() - started
+            rows += 1
+            yield item
+    finally:
+        metrics.record(stage,seconds,rows)
+
+
+## Application Insights export ############################################################################################
+OTEL_INSTRUMENTS      = {}
+OTEL_INSTRUMENTS_LOCK = threading.Lock()
+def get_otel_instruments()->dict:
+    with OTEL_INSTRUMENTS_LOCK:
+        if not OTEL_INSTRUMENTS:
+            if os.environ.get('APPLICATIONINSIGHTS_CONNECTION_STRING'):
+                try:
+                    from azure.monitor.opentelemetry import configure_azure_monitor  # Heavy : imported on the first export only.
+                    configure_azure_monitor(connection_string=os.environ['APPLICATIONINSIGHTS_CONNECTION_STRING'])
+                except ImportError:
+                    logging.warning("azure-monitor-opentelemetry is not installed. Metrics go to the configured OpenTelemetry exporter only.")
+            meter = otel_metrics.get_meter('PBIMetaExtractor')
+            OTEL_INSTRUMENTS.update({
+                'duration' : meter.create_histogram('ame.stage.duration',unit='ms',description='Duration of an extraction stage'),
+                'rows'     : meter.create_counter('ame.stage.rows',description='Rows processed by an extraction stage'),
+                'bytes'    : meter.create_counter('ame.stage.bytes',unit='By',description='Bytes processed by an extraction stage'),
+                'counter'  : meter.create_counter('ame.extraction.events',description='API calls, retries and throttled responses'),
+            })
+    return OTEL_INSTRUMENTS
+
+def export_metrics(metrics:StageMetrics,dimensions:dict):
+    if otel_metrics is None:
+        return
+    try:
+        instruments = get_otel_instruments()
+        with metrics._lock:
+            for stage,durations in metrics.durations.items():
+                attributes = {**dimensions, 'stage' : stage}
+                for duration in durations:
+                    instruments['duration'].record(duration,attributes)
+                instruments['rows'].add(metrics.rows[stage],attributes)
+                instruments['bytes'].add(metrics.bytes[stage],attributes)
+            for counter,value in metrics.counters.items():
+                instruments['counter'].add(value,{**dimensions, 'event' : counter})
+    except Exception as e:
+        logging.warning(f"Metrics export failed : {str(e)}")
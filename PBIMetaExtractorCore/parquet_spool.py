@@ -0,0 +1,149 @@
+'''
+#   ^           _
+#  /_\  |\  /| |_
+# /   \ | \/ | |_
+#
+
+Name : parquet_spool
+Desc : Arrow/Parquet staging of Snowflake loads. Batches are converted to Arrow tables and written as compressed Parquet
+       files (AME_SPOOL_COMPRESSION, row groups of AME_SPOOL_ROW_GROUP_SIZE rows) into a spool run directory
+       <AME_SPOOL_DIR>/<table>/<run>. The whole run is then uploaded with one PUT and loaded with one COPY INTO.
+       Spool runs are kept after the load (AME_SPOOL_RETENTION_HOURS, AME_SPOOL_MAX_MB) so that a load can be replayed
+       (replay_spool) or used as benchmark input (read_spool).
+Deployment      : Terraform
+Functions    : 1.  ParquetSpool              | Parquet writer of a spool run. Rolls over to a new file every AME_SPOOL_FILE_ROWS rows.
+               2.  rows_to_arrow / frame_to_arrow | Arrow table of a batch of row dicts / of a DataFrame.
+               3.  copy_spool_into_snowflake | PUT every file of a spool run and COPY them into a table, parsing JSON columns into VARIANT.
+               4.  cleanup_spool             | Remove spool runs older than the retention, then the oldest ones above the size limit.
+               5.  replay_spool / read_spool | Load a kept spool run into a table again / read it back as an Arrow table.
+'''
+import os
+import time
+import glob
+import uuid
+import shutil
+import logging
+import datetime
+import pyarrow
+import pyarrow.parquet
+from .common_variables import *
+from .snowflake_pool import SNOWFLAKE_POOL
+
+
+class ParquetSpool:
+
+    def __init__(self,table_name:str,spool_dir:str=SPOOL_DIR,file_rows:int=SPOOL_FILE_ROWS,row_group_size:int=SPOOL_ROW_GROUP_SIZE):
+        run_name            = f"{datetime.datetime.utcnow():%Y%m%dT%H%M%S}_{uuid.uuid4().hex[:8]}"
+        self.path           = os.path.join(spool_dir,table_name,run_name)
+        self.file_rows      = file_rows
+        self.row_group_size = row_group_size
+        self.files          = []
+        self.rows           = 0
+        self._writer        = None
+        self._writer_rows   = 0
+        os.makedirs(self.path,exist_ok=True)
+
+    def _open(self,schema:object):
+        file_path = os.path.join(self.path,f"part-{len(self.files):05d}.parquet")
+        self._writer = pyarrow.parquet.ParquetWriter(file_path,schema,compression=SPOOL_COMPRESSION,
+                                                     compression_level=SPOOL_COMPRESSION_LEVEL)
+        self._writer_rows = 0
+        self.files.append(file_path)
+
+    def _close_file(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    ## Append a batch. A batch whose types do not fit the open file (eg. a column that was all null) starts a new file. #####
+    def write(self,table:object):
+        if self._writer is not None and self._writer_rows + table.num_rows > self.file_rows:
+            self._close_file()
+        if self._writer is not None and not table.schema.equals(self._writer.schema):
+            try:
+                table = table.cast(self._writer.schema)
+            except (pyarrow.ArrowInvalid,pyarrow.ArrowNotImplementedError,ValueError):
+                self._close_file()
+        if self._writer is None:
+            self._open(table.schema)
+        self._writer.write_table(table,row_group_size=self.row_group_size)
+        self._writer_rows += table.num_rows
+        self.rows += table.num_rows
+
+    def close(self):
+        self._close_file()
+
+    @property
+    def bytes(self)->int:
+        return sum(os.path.getsize(file_path) for file_path in self.files)
+
+
+## Arrow table with the given columns of a batch of row dicts. Missing keys are null.
+def rows_to_arrow(rows:list,columns:list)->object:
+    return pyarrow.table({column : [row.get(column) for row in rows] for column in columns})
+
+def frame_to_arrow(df:object)->object:
+    return pyarrow.Table.from_pandas(df,preserve_index=False)
+
+
+## PUT every file of a spool run and COPY them into the table. Returns the loaded row count. ############################
+## Every attempt is PUT under its own stage path, so COPY never skips the files of a run as already loaded (load
+## metadata); force also loads files whose load metadata says so, for replays.
+def copy_spool_into_snowflake(ctx:object,spool_path:str,table_name:str,variant_columns:list=None,force:bool=False)->int:
+    file_paths = sorted(glob.glob(os.path.join(spool_path,'*.parquet')))
+    if not file_paths:
+        return 0
+    variant_columns = variant_columns or []
+    columns     = pyarrow.parquet.read_schema(file_paths[0]).names
+    stage_name  = f"{table_name}_LOAD_STAGE" # Temporary stage, dropped with the session.
+    stage_path  = f"{stage_name}/{os.path.basename(spool_path)}/{uuid.uuid4().hex[:8]}"
+    column_list = ','.join(f'"{column}"' for column in columns)
+    select_list = ','.join(f'parse_json($1:"{column}"::varchar)' if column in variant_columns else f'$1:"{column}"' for column in columns)
+    with ctx.cursor() as cs:
+        cs.execute(f"CREATE TEMPORARY STAGE IF NOT EXISTS {stage_name}")
+        put_path = os.path.join(spool_path,'*.parquet').replace('\\','/')
+        cs.execute(f"PUT 'file://{put_path}' @{stage_path} AUTO_COMPRESS=FALSE OVERWRITE=TRUE PARALLEL={SPOOL_PUT_PARALLEL}")
+        copy_sql = f'''COPY INTO {table_name} ({column_list})
+                        FROM (SELECT {select_list} FROM @{stage_path}/)
+                        FILE_FORMAT = (TYPE = PARQUET) PURGE = TRUE{' FORCE = TRUE' if force else ''}'''
+        logging.info(copy_sql)
+        copy_result = cs.execute(copy_sql).fetchall()
+        result_columns = [column[0].lower() for column in cs.description or []]
+    ### One row per file with its rows_loaded, or a single status row ("Copy executed with 0 files processed.").
+    if 'rows_loaded' not in result_columns:
+        logging.warning(f"No file loaded into {table_name} : {copy_result}")
+        return 0
+    rows_loaded = result_columns.index('rows_loaded')
+    return sum(row[rows_loaded] for row in copy_result)
+
+
+## Spool retention. Runs written to in the last SPOOL_ACTIVE_MINUTES minutes may still be loading and are never removed. ##
+SPOOL_ACTIVE_MINUTES = 60
+def cleanup_spool(spool_dir:str=SPOOL_DIR,retention_hours:float=SPOOL_RETENTION_HOURS,max_mb:float=SPOOL_MAX_MB):
+    runs = []
+    for run_path in glob.glob(os.path.join(spool_dir,'*','*')):
+        file_paths = glob.glob(os.path.join(run_path,'*'))
+        modified   = max([os.path.getmtime(run_path)] + [os.path.getmtime(file_path) for file_path in file_paths])
+        runs.append((modified,sum(os.path.getsize(file_path) for file_path in file_paths),run_path))
+    runs.sort()
+    total_bytes    = sum(run_bytes for _,run_bytes,_ in runs)
+    expired_before = time.time() - retention_hours*3600
+    active_after   = time.time() - SPOOL_ACTIVE_MINUTES*60
+    for modified,run_bytes,run_path in runs:
+        if modified < active_after and (modified < expired_before or total_bytes > max_mb*1024*1024):
+            logging.info(f"Removing spool run {run_path}")
+            shutil.rmtree(run_path,ignore_errors=True)
+            total_bytes -= run_bytes
+
+
+## Replay a kept spool run, eg. after the COPY or the merge that followed it failed ########################################
+def replay_spool(spool_path:str,table_name:str,variant_columns:list=None)->int:
+    with SNOWFLAKE_POOL.connection() as ctx:
+        return copy_spool_into_snowflake(ctx,spool_path,table_name,variant_columns,force=True)
+
+def read_spool(spool_path:str)->object:
+    tables = [pyarrow.parquet.read_table(file_path) for file_path in sorted(glob.glob(os.path.join(spool_path,'*.parquet')))]
+    try:
+        return pyarrow.concat_tables(tables,promote_options='default')
+    except TypeError:   # pyarrow < 14
+        return pyarrow.concat_tables(tables,promote=True)
@@ -0,0 +1,102 @@
+'''
+#   ^           _
+#  /_\  |\  /| |_
+# /   \ | \/ | |_
+#
+
+Name : response_cache
+Desc : Worker scoped on-disk cache of ADF API responses (SQLite database in AME_RESPONSE_CACHE_DIR), keyed by factory
+       resource ID, API and run ID / page number. Entries expire after AME_RESPONSE_CACHE_TTL_SECONDS, except permanent entries (the
+       activity runs of completed pipeline runs, which no longer change). The least recently used entries are evicted
+       once the cache grows beyond AME_RESPONSE_CACHE_MAX_MB. Enabled with AME_RESPONSE_CACHE_ENABLED or the
+       "response_cache" payload option.
+Deployment      : Terraform
+Functions    : 1.  ResponseCache        | Thread safe get / put of JSON responses with TTL and size based LRU eviction.
+               2.  get_response_cache   | Cache of the worker, or None when caching is disabled for the request.
+'''
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from .common_variables import *
+
+
+class ResponseCache:
+
+    def __init__(self,path:str,ttl_seconds:int=RESPONSE_CACHE_TTL_SECONDS,max_mb:float=RESPONSE_CACHE_MAX_MB):
+        self.path        = path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes   = max_mb*1024*1024
+        self._puts       = 0
+        self._lock       = threading.Lock()
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        self._db = sqlite3.connect(path,check_same_thread=False,isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute('''CREATE TABLE IF NOT EXISTS RESPONSES (CACHE_KEY TEXT PRIMARY KEY, BODY BLOB NOT NULL, SIZE INTEGER NOT NULL,
+                            IS_PERMANENT INTEGER NOT NULL, CREATED_TS REAL NOT NULL, ACCESSED_TS REAL NOT NULL)''')
+        self._db.execute("CREATE INDEX IF NOT EXISTS RESPONSES_ACCESSED ON RESPONSES (ACCESSED_TS)")
+        self.evict()
+
+    ## factory_id is the full resource ID of the factory (get_factory_resource_id) : same-named factories of other resource
+    ## groups or subscriptions do not share entries.
+    @staticmethod
+    def key(factory_id:str,api_name:str,item:object)->str:
+        return f"{factory_id.lower()}/{api_name}/{item}"
+
+    ## Cached JSON response, or None when missing or expired ##################################################################
+    def get(self,key:str)->object:
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT BODY,IS_PERMANENT,CREATED_TS FROM RESPONSES WHERE CACHE_KEY = ?",(key,)).fetchone()
+            if row is None:
+                return None
+            body,is_permanent,created_ts = row
+            if not is_permanent and created_ts < now - self.ttl_seconds:
+                self._db.execute("DELETE FROM RESPONSES WHERE CACHE_KEY = ?",(key,))
+                return None
+            self._db.execute("UPDATE RESPONSES SET ACCESSED_TS = ? WHERE CACHE_KEY = ?",(now,key))
+        return json.loads(body)
+
+    def put(self,key:str,response:object,permanent:bool=False):
+        body = json.dumps(response,default=str).encode('utf-8')
+        now  = time.time()
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO RESPONSES VALUES (?,?,?,?,?,?)",(key,body,len(body),int(permanent),now,now))
+            self._puts += 1
+            evict = self._puts % RESPONSE_CACHE_EVICT_EVERY == 0
+        if evict:
+            self.evict()
+
+    ## Drop expired entries, then the least recently used ones until the cache fits in max_mb ##############################
+    def evict(self):
+        with self._lock:
+            expired = self._db.execute("DELETE FROM RESPONSES WHERE IS_PERMANENT = 0 AND CREATED_TS < ?",(time.time() - self.ttl_seconds,)).rowcount
+            total_bytes = self._db.execute("SELECT COALESCE(SUM(SIZE),0) FROM RESPONSES").fetchone()[0]
+            evicted = 0
+            if total_bytes > self.max_bytes:
+                for key,size in self._db.execute("SELECT CACHE_KEY,SIZE FROM RESPONSES ORDER BY ACCESSED_TS").fetchall():
+                    if total_bytes <= self.max_bytes:
+                        break
+                    self._db.execute("DELETE FROM RESPONSES WHERE CACHE_KEY = ?",(key,))
+                    total_bytes -= size
+                    evicted += 1
+        if expired or evicted:
+            logging.info(f"Response cache : {expired} expired and {evicted} least recently used entries removed")
+
+
+RESPONSE_CACHE      = None
+RESPONSE_CACHE_LOCK = threading.Lock()
+
+## The worker's cache when enabled for the request (payload "response_cache", defaults to AME_RESPONSE_CACHE_ENABLED) ######
+def get_response_cache(payload:dict=None)->ResponseCache:
+    global RESPONSE_CACHE
+    enabled = (payload or {}).get('response_cache')
+    if not (RESPONSE_CACHE_ENABLED if enabled is None else enabled):
+        return None
+    with RESPONSE_CACHE_LOCK:
+        if RESPONSE_CACHE is None:
+            RESPONSE_CACHE = ResponseCache(os.path.join(RESPONSE_CACHE_DIR,'responses.sqlite'))
+    return RESPONSE_CACHE
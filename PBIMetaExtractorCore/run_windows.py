@@ -0,0 +1,248 @@
+'''
+#   ^           _
+#  /_\  |\  /| |_
+# /   \ | \/ | |_
+#
+
+Name : run_windows
+Desc : Time windowed extraction of the run history APIs (pipeline runs, trigger runs : query_by_factory). The filter window
+       [previous_time, current_time] is split into sub-windows that are queried concurrently within the ADF rate limit.
+       A window that returns a continuation token on its first page holds more runs than one page : it is split again
+       into sub-windows sized by the run density observed so far, down to AME_RUN_WINDOW_MIN_SECONDS, below which the
+       continuation tokens are followed. Runs are staged and merged like the other extractors.
+       The watermark of an API and factory (T_ADF_META_RUN_WATERMARK) is the end of the filter window read so far. Sub-windows
+       are read oldest first but complete in any order : when api_limit stops the scan, the watermark only moves to the end
+       of the contiguous completed sub-windows, so the next invocation continues from there and never skips a gap.
+Deployment      : Terraform
+Functions    : 1.  split_window           | Split a time window into equal sub-windows.
+               2.  generate_window_pages  | Query the sub-windows of a filter window concurrently and yield the runs of every page.
+               3.  generate_run_frames    | Group the runs of the pages into DataFrames, dropping runs already seen in another window.
+               4.  get_run_time_window    | Filter window of an API and factory : [watermark - watermark_offset days, now].
+               5.  load_windowed_runs     | Fetch, stage and merge the runs of a filter window, and move the watermark.
+               6.  save_run_watermark     | Move the watermark of an API and factory forward.
+'''
+import sys
+import math
+import heapq
+import logging
+import datetime
+from concurrent.futures import ThreadPoolExecutor,wait,FIRST_COMPLETED
+from azure.mgmt.datafactory.models import RunFilterParameters
+from .common_variables import *
+from .common_functions import execute_snowflake_sql,stream_frames_to_snowflake,get_exception_message
+from .adf_api import call_with_backoff,TokenBucket
+from .instrumentation import StageMetrics
+
+WATERMARK_TABLE = f"{AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{T_ADF_META_RUN_WATERMARK}"
+CURRENT_TS      = "to_timestamp_ntz(convert_timezone('UTC', current_timestamp()))"
+
+
+## Windows are (start, end, continuation token). ADF filters on start <= last updated <= end, so a run updated exactly on a
+## boundary is returned by both windows; generate_run_frames drops the second copy.
+def split_window(start:object,end:object,pieces:int)->list:
+    step = (end - start)/pieces
+    return [(start + step*piece, end if piece == pieces-1 else start + step*(piece+1), None) for piece in range(pieces)]
+
+
+## End of the contiguous part of [previous_time, ..] covered by the completed windows ((start, end) pairs). ################
+def get_completed_until(previous_time:object,completed:list)->object:
+    completed_until = previous_time
+    for start,end in sorted(completed):
+        if start > completed_until:
+            break
+        completed_until = max(completed_until,end)
+    return completed_until
+
+
+## Query every sub-window of [previous_time, current_time] and yield the runs of each page, in completion order. ##########
+## query_by_factory(filter_parameters) is the run history API of a factory. Windows are queried oldest first, so that a
+## scan stopped early covers a prefix of the filter window. At most api_limit calls are made; page_state is filled with the
+## calls made, the windows split, the windows left unread, the end of the contiguous completed windows (completed_until)
+## and whether every window was read to its end.
+def generate_window_pages(query_by_factory,previous_time:object,current_time:object,max_workers:int=ADF_API_MAX_WORKERS,
+                          api_limit:int=None,target_runs:int=RUN_WINDOW_TARGET_RUNS,min_window_seconds:int=RUN_WINDOW_MIN_SECONDS,
+                          limiter:TokenBucket=None,page_state:dict=None,metrics:StageMetrics=None)->list:
+    metrics    = metrics or StageMetrics()
+    page_state = page_state if page_state is not None else {}
+    page_state.update({'calls' : 0, 'splits' : 0, 'windows_left' : 0, 'completed_until' : previous_time, 'complete' : False})
+    total_seconds = max((current_time - previous_time).total_seconds(),1)
+    windows   = []    # heap of (start, sequence, window)
+    completed = []    # (start, end) of the windows read to their end
+    sequence  = 0
+    density   = {'runs' : 0, 'seconds' : 0.0}   # windows read in a single page
+
+    def push_windows(new_windows:list):
+        nonlocal sequence
+        for window in new_windows:
+            heapq.heappush(windows,(window[0],sequence,window))
+            sequence += 1
+
+    push_windows(split_window(previous_time,current_time,max(max_workers,math.ceil(total_seconds/RUN_WINDOW_MAX_SECONDS))))
+
+    def query_window(window:tuple)->object:
+        start,end,continuation_token = window
+        filter_params = RunFilterParameters(last_updated_after=start,last_updated_before=end,continuation_token=continuation_token)
+        return query_by_factory(filter_params)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = {}
+        while windows or in_flight:
+            while windows and len(in_flight) < max_workers and (api_limit is None or page_state['calls'] < api_limit):
+                window = heapq.heappop(windows)[2]
+                page_state['calls'] += 1
+                in_flight[executor.submit(call_with_backoff,query_window,window,limiter=limiter,metrics=metrics)] = window
+            if not in_flight:
+                page_state['windows_left']    = len(windows)
+                page_state['completed_until'] = get_completed_until(previous_time,completed)
+                logging.warning(f"api_limit reached with {len(windows)} windows left. Completed until {page_state['completed_until']}.")
+                return
+            done,_ = wait(in_flight,return_when=FIRST_COMPLETED)
+            for future in done:
+                start,end,continuation_token = in_flight.pop(future)
+                response = future.result()  # A failed window fails the extraction rather than leaving a gap.
+                seconds  = (end - start).total_seconds()
+                if response.continuation_token and continuation_token is None and seconds >= 2*min_window_seconds:
+                    ### More than one page : split by the density seen so far (at least twice this page) and drop this page.
+                    observed  = density['runs']/density['seconds'] if density['seconds'] else 0
+                    estimated = max(2*len(response.value),observed*seconds)
+                    pieces    = min(RUN_WINDOW_MAX_SPLIT,max(2,math.ceil(estimated/target_runs)),int(seconds//min_window_seconds))
+                    push_windows(split_window(start,end,pieces))
+                    page_state['splits'] += 1
+                    metrics.increment('run_window_splits')
+                    continue
+                if response.continuation_token:
+                    push_windows([(start,end,response.continuation_token)])
+                else:
+                    completed.append((start,end))
+                    if continuation_token is None:
+                        density['runs']    += len(response.value)
+                        density['seconds'] += seconds
+                metrics.add_volume('api_fetch',len(response.value))
+                yield response.value
+    page_state.update({'completed_until' : current_time, 'complete' : True})
+    logging.info(f"Run windows : {page_state}")
+
+
+## Group the runs of the pages into DataFrames of at least batch_size rows (to_frame(runs, metrics, etl_time)). ###########
+## Runs on a window boundary come twice; only the first copy of a key is kept, so the stage table holds one row per key.
+def generate_run_frames(pages:object,key_attribute:str,to_frame:object,batch_size:int,metrics:StageMetrics,etl_time:str=None)->object:
+    etl_time  = etl_time or get_etl_time()
+    seen_keys = set()
+    runs      = []
+    for page in pages:
+        for run in page:
+            key = getattr(run,key_attribute)
+            if key in seen_keys:
+                continue
+            seen_keys.add(key)
+            runs.append(run)
+        if len(runs) >= batch_size:
+            yield to_frame(runs,metrics,etl_time)
+            runs = []
+    if runs:
+        yield to_frame(runs,metrics,etl_time)
+
+
+## Filter window of api_name and factory_name : [watermark - watermark_offset days, now], in UTC #############################
+## Without a watermark yet, the newest ETL_UPDATE_TS of the factory in table_name is used (tables loaded before the watermark
+## table existed), else now.
+def get_run_time_window(table_name:str,api_name:str,factory_name:str,delta_days:int)->dict:
+    window_sql = f'''select coalesce((select max(WINDOW_END) from {WATERMARK_TABLE} where API_NAME = %s and FACTORY_NAME = %s),
+                                     (select max(ETL_UPDATE_TS) from {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{table_name} where FACTORY_NAME = %s),
+                                     {CURRENT_TS}) as previous_datetime'''
+    execution_result = execute_snowflake_sql(window_sql,(api_name,factory_name,factory_name))
+    if execution_result['status_code'] != 200 :
+        return execution_result
+    max_date_obj = execution_result['message']
+    max_date = max_date_obj[0][0].replace(tzinfo=datetime.timezone.utc) ## Include timezone info to get rid msrestazure tz warning.
+
+    previous_time = max_date - datetime.timedelta(days=delta_days or 0)
+    current_time  = datetime.datetime.now(datetime.timezone.utc)
+
+    logging.info(f"Current time : {current_time} | Previous Time : {previous_time}")
+    execution_result['message'] = (previous_time,current_time)
+    return execution_result
+
+
+## Move the watermark of api_name and factory_name to window_end (aware UTC datetime). It never moves back, so a slower ########
+## concurrent invocation of the same factory does not undo the progress of a faster one.
+def save_run_watermark(api_name:str,factory_name:str,window_end:object)->dict:
+    window_end = window_end.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    watermark_sql = f'''
+        MERGE into {WATERMARK_TABLE} tgt
+        USING ( select %s as API_NAME, %s as FACTORY_NAME, %s::timestamp_ntz as WINDOW_END ) src
+        ON tgt.API_NAME = src.API_NAME and tgt.FACTORY_NAME = src.FACTORY_NAME
+
+        WHEN matched THEN UPDATE SET
+        tgt.WINDOW_END = greatest(tgt.WINDOW_END, src.WINDOW_END), tgt.ETL_UPDATE_TS = {CURRENT_TS}
+
+        WHEN NOT matched THEN INSERT (API_NAME,FACTORY_NAME,WINDOW_END,ETL_INSERT_TS,ETL_UPDATE_TS)
+        VALUES (src.API_NAME,src.FACTORY_NAME,src.WINDOW_END,{CURRENT_TS},{CURRENT_TS})
+    '''
+    return execute_snowflake_sql(watermark_sql,(api_name,factory_name,window_end))
+
+
+## Fetch the runs of [previous_time, current_time] into stage_table and merge them with merge_sql. ###########################
+## Returns the impacted rows and the page_state of generate_window_pages. Every staged run is merged; the watermark of
+## api_name and factory_name then moves to the end of the contiguous completed windows. When api_limit stops the scan
+## before every window is read, the result is Partial (status_code 206) : the next invocation continues from there.
+def load_windowed_runs(query_by_factory,previous_time:object,current_time:object,stage_table:str,key_attribute:str,to_frame:object,
+                       variant_columns:list,merge_sql:str,api_concurrency:int=ADF_API_MAX_WORKERS,api_limit:int=None,
+                       batch_size:int=LOAD_BATCH_SIZE,metrics:StageMetrics=None,api_name:str=None,factory_name:str=None)->dict:
+    try:
+        function_name = sys._getframe().f_code.co_name
+        impacted_rows = 0
+        metrics       = metrics or StageMetrics()
+        page_state    = {}
+        pages  = generate_window_pages(query_by_factory,previous_time,current_time,api_concurrency,api_limit,page_state=page_state,metrics=metrics)
+        frames = generate_run_frames(pages,key_attribute,to_frame,batch_size,metrics,get_etl_time())
+
+        ###Truncate
+        logging.info(f'Truncating {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{stage_table}')
+        with metrics.stage('truncate'):
+            execution_result = execute_snowflake_sql(f"TRUNCATE TABLE {AME_SNW_DATABASE}.{AME_SNW_SCHEMA}.{stage_table}")
+        if execution_result['status_code'] != 200 :
+            return execution_result
+
+        ###Load. Windows are queried while earlier pages are written to the stage table.
+        execution_result = stream_frames_to_snowflake(frames,stage_table,variant_columns=variant_columns,metrics=metrics)
+        if execution_result['status_code'] != 200 :
+            logging.error('Exception in stream_frames_to_snowflake. Stopping run extraction.')
+            return execution_result
+        count_of_df = execution_result['message']
+        logging.info(f"Total count of records : {count_of_df}")
+
+        if count_of_df != 0:
+            ###Merge
+            with metrics.stage('merge') as volume:
+                execution_result = execute_snowflake_sql(merge_sql)
+                if execution_result['status_code'] != 200 :
+                    return execution_result
+                impacted_rows = execution_result['message'][0][0]
+                volume['rows'] = impacted_rows
+            logging.info(f"Impacted rows after merge : {impacted_rows}")
+        else:
+            logging.info("No records to load")
+
+        ###Watermark. Runs read beyond the contiguous completed windows are merged already and read again by the next invocation.
+        if api_name is not None and page_state['completed_until'] > previous_time:
+            execution_result = save_run_watermark(api_name,factory_name,page_state['completed_until'])
+            if execution_result['status_code'] != 200 :
+                return execution_result
+
+        if not page_state['complete']:
+            message = (f"api_limit reached with {page_state['windows_left']} windows left. Runs are merged and the watermark "
+                       f"moved to {page_state['completed_until']} : the next invocation continues from there.")
+            logging.warning(message)
+            output_partial = {"status" : 'Partial', "status_code":206,"function_name" : function_name ,
+                              "message" : {"impacted_rows" : impacted_rows, "windows" : page_state, "detail" : message}}
+            return output_partial
+
+        output_success = {"status" : 'Success', "status_code":200,"function_name" : function_name ,
+                          "message" : {"impacted_rows" : impacted_rows, "windows" : page_state}}
+        return output_success
+    except Exception as e:
+        error_message = str(e)
+        function_name = sys._getframe().f_code.co_name
+        output_error = get_exception_message(function_name ,error_message)
+        return output_error
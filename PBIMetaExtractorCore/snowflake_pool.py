@@ -0,0 +1,113 @@
+'''
+#   ^           _
+#  /_\  |\  /| |_
+# /   \ | \/ | |_
+#
+
+Name : snowflake_pool
+Desc : Worker scoped Snowflake connection pool. Connections are reused across statements and across warm
+       Azure Function invocations, health checked before reuse and closed on discard or at worker shutdown.
+Deployment      : Terraform
+'''
+import time
+import queue
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+import snowflake.connector
+from .common_variables import *
+
+
+class SnowflakeConnectionPool:
+
+    def __init__(self,max_size:int=SNW_POOL_MAX_SIZE,ping_after_seconds:int=SNW_POOL_PING_AFTER_SECONDS):
+        self.max_size           = max_size
+        self.ping_after_seconds = ping_after_seconds
+        self._idle              = queue.LifoQueue()   # Most recently used connection first, so idle ones age out.
+        self._slots             = threading.BoundedSemaphore(max_size)
+        self._closed            = False
+
+    ## Open a new Snowflake session ##########################################################################################
+    def _connect(self)->object:
+        logging.info("Opening Snowflake connection.")
+        return snowflake.connector.connect(
+
+            user        = AME_SNW_USERNAME,
+            password    = AME_SNW_PASSWORD,
+            account     = AME_SNW_ACCOUNT,
+            database    = AME_SNW_DATABASE,
+            schema      = AME_SNW_SCHEMA,
+            warehouse   = AME_SNW_WAREHOUSE,
+            client_session_keep_alive = True
+
+            )
+
+    ## A connection idle for longer than ping_after_seconds is pinged before it is handed out ###############################
+    def _is_healthy(self,ctx:object,idle_since:float)->bool:
+        if ctx.is_closed():
+            return False
+        if time.monotonic() - idle_since < self.ping_after_seconds:
+            return True
+        try:
+            with ctx.cursor() as cs:
+                cs.execute("select 1").fetchone()
+            return True
+        except Exception as e:
+            logging.warning(f"Discarding unhealthy Snowflake connection : {str(e)}")
+            return False
+
+    def _discard(self,ctx:object):
+        try:
+            logging.info("Closing Snowflake connection.")
+            ctx.close()
+        except Exception as e:
+            logging.warning(f"Error while closing Snowflake connection : {str(e)}")
+
+    ## Borrow a connection. Blocks when max_size connections are already lent out. ###########################################
+    def acquire(self)->object:
+        self._slots.acquire()
+        try:
+            while True:
+                try:
+                    ctx,idle_since = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._connect()
+                if self._is_healthy(ctx,idle_since):
+                    return ctx
+                self._discard(ctx)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self,ctx:object):
+        try:
+            if self._closed or ctx.is_closed():
+                self._discard(ctx)
+            else:
+                self._idle.put((ctx,time.monotonic()))
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        ctx = self.acquire()
+        try:
+            yield ctx
+        finally:
+            self.release(ctx)
+
+    ## Close every idle connection. Lent out connections are closed when they are released. ##################################
+    def close_all(self):
+        self._closed = True
+        while True:
+            try:
+                ctx,_ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(ctx)
+
+
+## One pool per Function worker process. Module state survives between warm invocations.
+SNOWFLAKE_POOL = SnowflakeConnectionPool()
+atexit.register(SNOWFLAKE_POOL.close_all)
@@ -0,0 +1,96 @@
+'''
+#   ^           _
+#  /_\  |\  /| |_
+# /   \ | \/ | |_
+#
+
+Name : snowflake_statements
+Desc : Asynchronous Snowflake statements. A statement is submitted with the connector's execute_async and its pooled
+       connection is released right away, so the query runs in Snowflake while the invocation goes on (eg. the stage
+       TRUNCATE while ADF is read). The result is collected later by query ID, on any pooled connection, and fetched
+       SNW_FETCH_BATCH_SIZE rows at a time. Submit only statements that do not depend on each other; a statement that needs
+       the result of another is submitted once that result is collected.
+Deployment      : Terraform
+Functions    : 1.  SnowflakeStatement    | Submitted statement : query ID, and its execution_result once completed.
+               2.  submit_snowflake_sql  | Submit a statement without waiting for it.
+               3.  wait_for_statements   | Pass items through, holding the first one back until the statements completed.
+'''
+import sys
+import time
+import logging
+from .common_variables import *
+from .snowflake_pool import SNOWFLAKE_POOL
+from .instrumentation import StageMetrics
+from .common_functions import get_exception_message,fetch_in_batches,record_statement
+
+
+class SnowflakeStatement:
+
+    def __init__(self,sql:str,params:object=None,metrics:StageMetrics=None,label:str=None):
+        self.sql       = sql
+        self.params    = params
+        self.metrics   = metrics
+        self.label     = label
+        self.query_id  = None
+        self.submitted = None
+        self._result   = None    # execution_result, once completed or when the submission failed
+
+    ## Submit the statement. A failed submission is returned by result(). ###################################################
+    def submit(self)->object:
+        try:
+            self.submitted = time.perf_counter()
+            with SNOWFLAKE_POOL.connection() as ctx:
+                with ctx.cursor() as cs:
+                    logging.info('Submitting SQL : ')
+                    logging.info(self.sql)
+                    self.query_id = cs.execute_async(self.sql,self.params)['queryId']
+            logging.info(f"Query ID {self.query_id} ({self.label or 'sql'}) submitted")
+        except Exception as e:
+            self._result = get_exception_message('submit_snowflake_sql',str(e))
+        return self
+
+    ## Wait for the statement and return its execution_result, with the records as message as execute_snowflake_sql. ########
+    def result(self)->dict:
+        if self._result is None:
+            self._result = self._collect()
+        return self._result
+
+    def _collect(self)->dict:
+        try:
+            with SNOWFLAKE_POOL.connection() as ctx:
+                with ctx.cursor() as cs:
+                    cs.get_results_from_sfqid(self.query_id)    # Fetching waits for the query and raises its error.
+                    value = list(fetch_in_batches(cs))
+            record_statement(self.label,self.query_id,time.perf_counter() - self.submitted,len(value),self.metrics)
+            return {"status" : 'Success', "status_code":200,"function_name" : 'execute_snowflake_sql' , "message" :  value ,
+                    "query_id" : self.query_id }
+        except Exception as e:
+            error_message = f"Query ID {self.query_id} : {str(e)}"
+            function_name = sys._getframe().f_code.co_name
+            output_error = get_exception_message(function_name ,error_message)
+            return output_error
+
+
+## Submit a statement without waiting for it. Collect its execution_result with result(). ###################################
+def submit_snowflake_sql(sql:str,params:object=None,metrics:StageMetrics=None,label:str=None)->SnowflakeStatement:
+    return SnowflakeStatement(sql,params,metrics,label).submit()
+
+
+## Pass items through, holding the first one back until statements completed (eg. rows are only loaded into a stage table ###
+## once its TRUNCATE is done). Without items, the statements are waited for once the items are exhausted. A failed
+## statement raises, which stops the consumer of the items.
+def wait_for_statements(items:object,statements:list)->object:
+    waited = False
+    for item in items:
+        if not waited:
+            raise_failed_statements(statements)
+            waited = True
+        yield item
+    if not waited:
+        raise_failed_statements(statements)
+
+def raise_failed_statements(statements:list):
+    for statement in statements:
+        execution_result = statement.result()
+        if execution_result['status_code'] != 200:
+            raise RuntimeError(execution_result['message'])